@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+from django.db.models import F, Q
+from django.utils.timezone import now
+
+import mail.api.utils as utils
+from mail.api.models import Mailbox
+from mail.api.scheduler import poll_mailbox
+
+
+logger = logging.getLogger(__name__)
+
+
+def _run_in_db_thread(func, *args):
+    close_old_connections()
+    return func(*args)
+
+
+class AsyncPollingScheduler(object):
+    """
+    Polls due mailboxes from a single event loop.
+
+    IMAP mailboxes are polled by `AsyncImapTransport` sessions, at most
+    `concurrency` at once and `per_host` per server. Their messages go in
+    batches through a bounded queue to `db_workers` threads writing them
+    with `Mailbox.process_incoming_messages`; a session waits for its
+    batch to be written and commits it on the server before it goes on
+    fetching. Other transports are
+    polled by `poll_mailbox` on up to `sync_concurrency` threads. Either
+    way a mailbox is only polled while this holds its fetch lease.
+    """
+    def __init__(self, concurrency, per_host, queue_size, sync_concurrency, db_workers=4, tick=1):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.queue_size = queue_size
+        self.db_workers = db_workers
+        self.tick = tick
+        self.batch_size = utils.get_settings()['ingest_batch_size']
+        self.executor = ThreadPoolExecutor(
+            max_workers=db_workers, thread_name_prefix='mail-poll-db'
+        )
+        self.sync_executor = ThreadPoolExecutor(
+            max_workers=sync_concurrency, thread_name_prefix='mail-poll'
+        )
+        self.in_flight = {}
+        self.hosts = {}
+        self.queue = None
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.main())
+        finally:
+            loop.close()
+            self.sync_executor.shutdown(wait=True)
+            self.executor.shutdown(wait=True)
+
+    async def main(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        writers = [asyncio.ensure_future(self.write()) for _ in range(self.db_workers)]
+        try:
+            while True:
+                await self.run_pending()
+                await asyncio.sleep(self.tick)
+        finally:
+            tasks = writers + list(self.in_flight.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def db(self, func, *args):
+        """Runs the blocking `func` on a database thread."""
+        return asyncio.get_event_loop().run_in_executor(
+            self.executor, functools.partial(_run_in_db_thread, func, *args)
+        )
+
+    def get_due_mailboxes(self, limit, exclude):
+        return list(Mailbox.active_mailboxes.exclude(uri=None).exclude(
+            pk__in=exclude
+        ).filter(
+            Q(next_polling=None) | Q(next_polling__lte=now())
+        ).order_by(
+            F('next_polling').asc(nulls_first=True)
+        )[:limit])
+
+    async def run_pending(self):
+        free = self.concurrency - len(self.in_flight)
+        if free <= 0:
+            return
+
+        mailboxes = await self.db(self.get_due_mailboxes, free, list(self.in_flight))
+        for mailbox in mailboxes:
+            task = asyncio.ensure_future(self.poll(mailbox))
+            task.add_done_callback(functools.partial(self._done, mailbox.pk))
+            self.in_flight[mailbox.pk] = task
+
+    def _done(self, mailbox_id, task):
+        del self.in_flight[mailbox_id]
+
+    async def poll(self, mailbox):
+        connection = mailbox.get_async_connection()
+        if connection is None:
+            await asyncio.get_event_loop().run_in_executor(
+                self.sync_executor, poll_mailbox, mailbox.pk
+            )
+            return
+
+        token = await self.db(mailbox.acquire_fetch_lease)
+        if token is None:
+            logger.info("Mailbox %s is being fetched elsewhere, skipping", mailbox.pk)
+            return
+
+        since = mailbox.last_polling
+        mails_count, failed = 0, False
+        try:
+            async with self.get_host_slot(mailbox.location):
+                await connection.connect(mailbox.username, mailbox.password)
+                try:
+                    mails_count = await self.fetch(mailbox, connection, token)
+                finally:
+                    await connection.close()
+        except asyncio.CancelledError:
+            await self.db(mailbox.release_fetch_lease, token)
+            raise
+        except Exception:
+            logger.exception("Polling mailbox %s failed", mailbox.pk)
+            failed = True
+        try:
+            await self.db(
+                self.finish, mailbox, connection.sync_state, mails_count, since, failed, token
+            )
+        except Exception:
+            logger.exception("Scheduling mailbox %s failed", mailbox.pk)
+
+    def get_host_slot(self, host):
+        slot = self.hosts.get(host)
+        if slot is None:
+            slot = self.hosts[host] = asyncio.Semaphore(self.per_host)
+        return slot
+
+    async def fetch(self, mailbox, connection, token):
+        mails_count = 0
+        batch = []
+        async for message in connection.get_message(mailbox.get_fetching_condition()):
+            batch.append(message)
+            if len(batch) >= self.batch_size:
+                mails_count += await self.store(mailbox, connection, batch, token)
+                batch = []
+        if batch:
+            mails_count += await self.store(mailbox, connection, batch, token)
+        # Messages skipped after the last batch
+        await connection.commit()
+        return mails_count
+
+    async def store(self, mailbox, connection, messages, token):
+        """Writes `messages`, then flags them on the server and
+        checkpoints the sync state past them."""
+        mails_count = await self.ingest(mailbox, messages, token)
+        await connection.commit()
+        # Checkpoint, so that an interrupted poll resumes from here
+        await self.db(self.checkpoint, mailbox, dict(connection.sync_state))
+        return mails_count
+
+    async def ingest(self, mailbox, messages, token):
+        """Queues `messages` for writing and waits until they are written.
+
+        Returns the number of mails stored.
+
+        """
+        written = asyncio.get_event_loop().create_future()
+        await self.queue.put((mailbox, messages, token, written))
+        return await written
+
+    async def write(self):
+        while True:
+            mailbox, messages, token, written = await self.queue.get()
+            try:
+                mails_count = await self.db(self.write_messages, mailbox, messages, token)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not written.done():
+                    written.set_exception(e)
+            else:
+                if not written.done():
+                    written.set_result(mails_count)
+            finally:
+                self.queue.task_done()
+
+    def write_messages(self, mailbox, messages, token):
+        if not mailbox.renew_fetch_lease(token):
+            raise RuntimeError("Fetch lease of mailbox %s lapsed" % mailbox.pk)
+        mails = mailbox.process_incoming_messages(messages)
+        mailbox._register_contacts(mails)
+        return len(mails)
+
+    def checkpoint(self, mailbox, sync_state):
+        mailbox.set_sync_state(sync_state)
+        mailbox.save(update_fields=['sync_state'])
+
+    def finish(self, mailbox, sync_state, mails_count, since, failed, token):
+        try:
+            if not failed:
+                mailbox.set_sync_state(sync_state)
+                mailbox.last_polling = now()
+                mailbox.save(update_fields=['sync_state', 'last_polling'])
+            mailbox.schedule_next_polling(mails_count, since=since, failed=failed)
+        finally:
+            mailbox.release_fetch_lease(token)
@@ -0,0 +1,372 @@
+import re
+import itertools
+import threading
+
+from collections import OrderedDict
+from datetime import timedelta
+from email.utils import parsedate_to_datetime
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils.timezone import is_naive, make_aware, now, utc
+
+import mail.api.utils as utils
+from mail.api.models import Chain, Folder, Mail, PendingReference
+
+
+REFERENCE_RE = re.compile(r'<[^<>\s]+>')
+SUBJECT_PREFIX_RE = re.compile(
+    r'^(\s*(\[[^\]]*\]|(re|fwd?|aw|sv|antw)(\[\d+\])?\s*:))+', re.IGNORECASE
+)
+REPLY_PREFIX_RE = re.compile(r'(re|fwd?|aw|sv|antw)(\[\d+\])?\s*:', re.IGNORECASE)
+
+# Only the nearest ancestors of long threads are looked up
+MAX_REFERENCES = 20
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def normalize_subject(subject):
+    """Returns `subject` without reply prefixes and list tags, and
+    whether it had a reply or forward prefix."""
+    subject = subject or ''
+    match = SUBJECT_PREFIX_RE.match(subject)
+    prefix = match.group(0) if match else ''
+    normalized = ' '.join(subject[len(prefix):].split()).lower()
+    return normalized[0:255], bool(REPLY_PREFIX_RE.search(prefix))
+
+
+def get_in_reply_to(message):
+    value = message['in-reply-to']
+    if not value:
+        return None
+    value = str(value)
+    match = REFERENCE_RE.search(value)
+    if match:
+        return match.group(0)[0:255]
+    return value.strip()[0:255] or None
+
+
+def get_date(message):
+    """Returns the ``Date`` of `message`, or now if it has none."""
+    try:
+        date = parsedate_to_datetime(message['date'])
+    except (TypeError, ValueError, IndexError):
+        return now()
+    if is_naive(date):
+        date = make_aware(date, utc)
+    return date
+
+
+def get_references(message):
+    """Returns Message-IDs referenced by `message`, nearest ancestor last."""
+    references = []
+    for value in message.get_all('references', []):
+        references.extend(
+            message_id[0:255] for message_id in REFERENCE_RE.findall(str(value))
+        )
+    in_reply_to = get_in_reply_to(message)
+    if in_reply_to:
+        references.append(in_reply_to)
+
+    unique = []
+    for message_id in reversed(references):
+        if message_id not in unique:
+            unique.append(message_id)
+    return unique[:MAX_REFERENCES][::-1]
+
+
+class ChainCache(object):
+    """
+    Bounded map of Message-ID to the ids of its mail and chain.
+
+    Least recently used entries are evicted first.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, message_ids):
+        found = {}
+        with self._lock:
+            for message_id in message_ids:
+                entry = self._entries.get(message_id)
+                if entry is not None:
+                    self._entries.move_to_end(message_id)
+                    found[message_id] = entry
+        return found
+
+    def set_many(self, entries):
+        with self._lock:
+            for message_id, entry in entries.items():
+                self._entries[message_id] = entry
+                self._entries.move_to_end(message_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, message_ids):
+        with self._lock:
+            for message_id in message_ids:
+                self._entries.pop(message_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def get_chain_cache():
+    """Returns the process-wide Message-ID to chain cache."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ChainCache(utils.get_settings()['chain_cache_size'])
+    return _cache
+
+
+class ChainResolver(object):
+    """
+    Assigns incoming mails of `mailbox` to chains.
+
+    A mail joins the chain of the nearest message it references through
+    ``References`` or ``In-Reply-To``. Failing that, a reply joins a recent
+    chain of the mailbox with the same normalized subject, and any other
+    mail starts a new chain. References to messages that have not arrived
+    yet are kept for `relink_chains`.
+
+    Mails fetched from Gmail join the chain of their Gmail thread instead,
+    in any mailbox of the same account, and are only linked to the
+    message they reply to.
+    """
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+        self.cache = get_chain_cache()
+        self.new_chains = []
+        self._mails = []
+        self._replies = []
+        self._pending = []
+
+    def resolve(self, records):
+        """Sets the chain and parent of the unsaved mails in `records`,
+        a list of ``(mail, message)`` pairs.
+
+        `new_chains` must be inserted before the mails, and `link` called
+        once they are saved.
+
+        """
+        references = [
+            [] if msg.gmail_thread_id else get_references(message)
+            for msg, message in records
+        ]
+        subjects = [normalize_subject(msg.subject) for msg, _ in records]
+        dates = [get_date(message) for _, message in records]
+
+        message_ids = set(itertools.chain.from_iterable(references))
+        message_ids.update(
+            get_in_reply_to(message) for msg, message in records if msg.gmail_thread_id
+        )
+        message_ids.discard(None)
+        known = self._get_known(message_ids)
+        by_subject = self._get_chains_by_subject(set(
+            subject for (msg, _), (subject, is_reply), refs in zip(records, subjects, references)
+            if subject and (is_reply or refs) and not msg.gmail_thread_id
+        ), dates)
+        by_thread = self._get_chains_by_thread(set(
+            msg.gmail_thread_id for msg, _ in records if msg.gmail_thread_id
+        ))
+
+        batch = {}
+        for (msg, message), refs, (subject, is_reply), date in zip(
+                records, references, subjects, dates):
+            in_reply_to = get_in_reply_to(message)
+            missing = refs
+            if msg.gmail_thread_id:
+                chain_id = by_thread.get(msg.gmail_thread_id)
+                if chain_id is not None:
+                    msg.chain_id = chain_id
+                else:
+                    msg.chain = Chain(subject=subject or None)
+                    self.new_chains.append(msg.chain)
+                    by_thread[msg.gmail_thread_id] = msg.chain_id
+                if in_reply_to in batch:
+                    # Linked in `link`, once the parent has a key
+                    self._replies.append((msg, batch[in_reply_to]))
+                elif in_reply_to in known:
+                    msg.in_reply_to_id = known[in_reply_to][0]
+            else:
+                for index in reversed(range(len(refs))):
+                    message_id = refs[index]
+                    if message_id in batch:
+                        parent = batch[message_id]
+                        msg.chain_id = parent.chain_id
+                        if message_id == in_reply_to:
+                            # Linked in `link`, once the parent has a key
+                            self._replies.append((msg, parent))
+                    elif message_id in known:
+                        mail_id, msg.chain_id = known[message_id]
+                        if message_id == in_reply_to:
+                            msg.in_reply_to_id = mail_id
+                    else:
+                        continue
+                    missing = refs[index + 1:]
+                    break
+                else:
+                    chain_id = None
+                    if subject and (is_reply or refs):
+                        chain_id = self._find_chain_by_subject(by_subject, subject, date)
+                    if chain_id is not None:
+                        msg.chain_id = chain_id
+                    else:
+                        msg.chain = Chain(subject=subject or None)
+                        self.new_chains.append(msg.chain)
+
+            self._pending.extend(
+                (msg, message_id, message_id == in_reply_to) for message_id in missing
+            )
+            if subject:
+                by_subject.setdefault(subject, []).append((date, msg.chain_id))
+            if msg.message_id:
+                batch[msg.message_id] = msg
+            self._mails.append(msg)
+
+    def link(self):
+        """Finishes `resolve` once its mails are saved."""
+        for msg, parent in self._replies:
+            msg.in_reply_to = parent
+
+        PendingReference.objects.bulk_create([
+            PendingReference(mail=msg, message_id=message_id, in_reply_to=in_reply_to)
+            for msg, message_id, in_reply_to in self._pending
+        ])
+
+        entries = dict(
+            (msg.message_id, (msg.pk, msg.chain_id))
+            for msg in self._mails if msg.message_id
+        )
+        transaction.on_commit(lambda: self.cache.set_many(entries))
+
+    def _get_known(self, message_ids):
+        """Returns mail and chain ids of stored messages by Message-ID."""
+        known = self.cache.get_many(message_ids)
+        if known:
+            # Cached mails may have been deleted since, and their chains
+            # merged away by `relink_chains`; take both from the table
+            current = dict(Mail.objects.filter(
+                pk__in=set(mail_id for mail_id, _ in known.values())
+            ).exclude(chain=None).values_list('pk', 'chain_id'))
+            stale, moved = [], {}
+            for message_id, (mail_id, chain_id) in list(known.items()):
+                if mail_id not in current:
+                    stale.append(message_id)
+                    del known[message_id]
+                elif current[mail_id] != chain_id:
+                    known[message_id] = moved[message_id] = (mail_id, current[mail_id])
+            self.cache.discard(stale)
+            self.cache.set_many(moved)
+
+        missing = message_ids.difference(known)
+        if missing:
+            # Latest processed mail wins
+            stored = dict(
+                (message_id, (mail_id, chain_id))
+                for message_id, mail_id, chain_id in Mail.objects.filter(
+                    message_id__in=missing
+                ).exclude(chain=None).order_by('processed').values_list(
+                    'message_id', 'id', 'chain_id'
+                )
+            )
+            self.cache.set_many(stored)
+            known.update(stored)
+        return known
+
+    def _get_chains_by_thread(self, thread_ids):
+        """Returns chain ids of stored mails of this mailbox's Gmail
+        account by Gmail thread id."""
+        if not thread_ids:
+            return {}
+        return dict(Mail.objects.filter(
+            mailbox__in=self.mailbox.get_account_mailbox_ids(), gmail_thread_id__in=thread_ids
+        ).exclude(chain=None).order_by('processed').values_list(
+            'gmail_thread_id', 'chain_id'
+        ))
+
+    def _get_chains_by_subject(self, subjects, dates):
+        """Returns ``(date, chain id)`` of mails in this mailbox by
+        normalized subject, oldest first."""
+        if not subjects:
+            return {}
+        window = self._get_subject_window()
+        mails = Mail.objects.filter(
+            mailbox=self.mailbox,
+            chain__subject__in=subjects,
+            date__gte=min(dates) - window,
+            date__lte=max(dates) + window,
+        ).order_by('date').values_list('chain__subject', 'date', 'chain_id')
+
+        by_subject = {}
+        for subject, date, chain_id in mails:
+            by_subject.setdefault(subject, []).append((date, chain_id))
+        return by_subject
+
+    def _find_chain_by_subject(self, by_subject, subject, date):
+        window = self._get_subject_window()
+        for mail_date, chain_id in reversed(by_subject.get(subject, [])):
+            if abs(date - mail_date) <= window:
+                return chain_id
+        return None
+
+    def _get_subject_window(self):
+        return timedelta(days=utils.get_settings()['chain_subject_window'])
+
+
+def merge_chains(source_id, target_id):
+    """Moves mails and folders of chain `source_id` into `target_id`."""
+    Mail.objects.filter(chain_id=source_id).update(chain_id=target_id)
+    target = Chain.objects.get(pk=target_id)
+    target.folders.add(*Folder.objects.filter(chains=source_id))
+    Chain.objects.filter(pk=source_id).delete()
+
+
+def relink_chains(limit=1000):
+    """Links mails to referenced messages that arrived after them.
+
+    Returns the number of references resolved. References still missing
+    after ``DJANGO_MAILBOX_CHAIN_RELINK_WINDOW`` days are dropped.
+
+    """
+    window = utils.get_settings()['chain_relink_window']
+    PendingReference.objects.filter(
+        created__lt=now() - timedelta(days=window)
+    ).delete()
+
+    arrived = Mail.objects.filter(
+        message_id=OuterRef('message_id')
+    ).exclude(chain=None)
+    references = list(PendingReference.objects.annotate(
+        arrived=Exists(arrived)
+    ).filter(arrived=True).order_by('created')[:limit])
+
+    for reference in references:
+        with transaction.atomic():
+            _resolve_reference(reference)
+    return len(references)
+
+
+def _resolve_reference(reference):
+    mail = Mail.objects.select_for_update().get(pk=reference.mail_id)
+    parent = Mail.objects.filter(
+        message_id=reference.message_id
+    ).exclude(chain=None).order_by('processed').last()
+
+    if parent is not None and parent.pk != mail.pk:
+        if mail.chain_id is None:
+            Mail.objects.filter(pk=mail.pk).update(chain_id=parent.chain_id)
+        elif mail.chain_id != parent.chain_id:
+            merge_chains(mail.chain_id, parent.chain_id)
+        if reference.in_reply_to and mail.in_reply_to_id is None:
+            Mail.objects.filter(pk=mail.pk).update(in_reply_to=parent)
+    reference.delete()
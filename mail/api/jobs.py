@@ -0,0 +1,112 @@
+import time
+import logging
+import threading
+
+from datetime import timedelta
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils.timezone import now
+
+from mail.api.models import FetchJob, MailboxFetch
+
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Returns the process-wide pool fetching mailboxes in the background."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Fetches queued by a previous process are not in this pool
+            fail_stale_fetches()
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.MAIL_FETCH_CONCURRENCY,
+                thread_name_prefix='mail-fetch',
+            )
+    return _executor
+
+
+def fail_stale_fetches():
+    """Marks fetches left pending or running for longer than
+    ``MAIL_FETCH_TIMEOUT`` seconds as failed, and finishes their jobs.
+
+    The pool queuing fetches lives in memory, so a fetch whose worker
+    was restarted would otherwise never leave its state.
+
+    """
+    stale = MailboxFetch.objects.filter(
+        status__in=[MailboxFetch.PENDING, MailboxFetch.RUNNING],
+        job__created__lt=now() - timedelta(seconds=settings.MAIL_FETCH_TIMEOUT),
+    )
+    job_ids = set(stale.values_list('job_id', flat=True))
+    if not job_ids:
+        return 0
+
+    failed = stale.update(status=MailboxFetch.FAILED, error='Interrupted by a worker restart')
+    FetchJob.objects.filter(pk__in=job_ids, finished=None).exclude(
+        mailboxes__status__in=[MailboxFetch.PENDING, MailboxFetch.RUNNING]
+    ).update(finished=now())
+    return failed
+
+
+def start_fetch_job(mailboxes, owner=None):
+    """Creates a job fetching every given mailbox and queues its fetches.
+
+    Returns the job right away; progress is recorded on its
+    `MailboxFetch` rows as the fetches finish.
+
+    """
+    job = FetchJob.objects.create(owner=owner)
+    fetches = MailboxFetch.objects.bulk_create(
+        MailboxFetch(job=job, mailbox=mailbox) for mailbox in mailboxes
+    )
+
+    if not fetches:
+        job.finished = now()
+        job.save(update_fields=['finished'])
+        return job
+
+    def submit():
+        executor = get_executor()
+        for fetch in fetches:
+            executor.submit(run_mailbox_fetch, fetch.pk)
+
+    transaction.on_commit(submit)
+    return job
+
+
+def run_mailbox_fetch(fetch_id):
+    close_old_connections()
+    try:
+        fetch = MailboxFetch.objects.select_related('mailbox').get(pk=fetch_id)
+        fetch.status = MailboxFetch.RUNNING
+        fetch.started = now()
+        fetch.save(update_fields=['status', 'started'])
+
+        started = time.monotonic()
+        try:
+            fetch.mails_received, fetch.contacts_added = fetch.mailbox.fetch_new_mail()
+            fetch.status = MailboxFetch.DONE
+        except Exception as e:
+            logger.exception("Fetching mailbox %s failed", fetch.mailbox_id)
+            fetch.status = MailboxFetch.FAILED
+            fetch.error = str(e)
+        fetch.duration = time.monotonic() - started
+        fetch.save(update_fields=[
+            'status', 'mails_received', 'contacts_added', 'error', 'duration'
+        ])
+
+        FetchJob.objects.filter(pk=fetch.job_id, finished=None).exclude(
+            mailboxes__status__in=[MailboxFetch.PENDING, MailboxFetch.RUNNING]
+        ).update(finished=now())
+    except Exception:
+        logger.exception("Mailbox fetch %s failed", fetch_id)
+    finally:
+        connection.close()
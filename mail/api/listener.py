@@ -0,0 +1,90 @@
+import logging
+import threading
+
+from django.db import close_old_connections, connection as db_connection
+
+from mail.api.models import Mailbox
+from mail.api.transports.imap import IDLE_TIMEOUT
+
+
+logger = logging.getLogger(__name__)
+
+
+class MailboxListener(threading.Thread):
+    """
+    Keeps a mailbox connection open and ingests mail as soon as it arrives.
+
+    IMAP servers announcing IDLE push EXISTS notifications over a single
+    long-lived connection; every other transport is polled every
+    `poll_interval` seconds. Connection failures are retried with an
+    exponential backoff.
+    """
+    min_reconnect_delay = 1
+    max_reconnect_delay = 300
+
+    def __init__(self, mailbox_id, idle_timeout=IDLE_TIMEOUT, poll_interval=60):
+        super(MailboxListener, self).__init__(
+            name='mailbox-listener-%s' % mailbox_id, daemon=True
+        )
+        self.mailbox_id = mailbox_id
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        delay = self.min_reconnect_delay
+        while not self.stopped.is_set():
+            try:
+                self.listen()
+                delay = self.min_reconnect_delay
+            except Mailbox.DoesNotExist:
+                logger.warning("Mailbox %s was removed, stop listening", self.mailbox_id)
+                break
+            except Exception as e:
+                logger.exception("Listener for mailbox %s failed: %s", self.mailbox_id, e)
+                self.stopped.wait(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+            finally:
+                db_connection.close()
+
+    def listen(self):
+        close_old_connections()
+        mailbox = Mailbox.active_mailboxes.get(pk=self.mailbox_id)
+        connection = mailbox.get_connection()
+        if connection is None:
+            self.stop()
+            return
+
+        if not getattr(connection, 'supports_idle', False):
+            self.poll(mailbox, connection)
+            return
+
+        try:
+            while not self.stopped.is_set():
+                self.ingest(mailbox, connection)
+                connection.idle(self.idle_timeout)
+        finally:
+            connection.close()
+
+    def poll(self, mailbox, connection):
+        try:
+            self.ingest(mailbox, connection)
+        finally:
+            # Only IDLE connections are kept open by the listener; later
+            # polls take IMAP sessions from the connection pool
+            if hasattr(connection, 'close'):
+                connection.close()
+        while not self.stopped.wait(self.poll_interval):
+            close_old_connections()
+            self.ingest(mailbox)
+
+    def ingest(self, mailbox, connection=None):
+        mails_count, new_contacts = mailbox.fetch_new_mail(connection=connection)
+        if mails_count:
+            logger.info(
+                "Mailbox %s received %s mails, %s contacts added",
+                mailbox.id, mails_count, new_contacts
+            )
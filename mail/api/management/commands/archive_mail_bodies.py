@@ -0,0 +1,94 @@
+import time
+import uuid
+import base64
+import logging
+
+from datetime import timedelta
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, models, transaction
+from django.utils.timezone import now
+
+import mail.api.utils as utils
+from mail.api.models import Mail
+
+
+logger = logging.getLogger(__name__)
+
+
+def archive_mail_bodies(age, batch_size, after=0):
+    """Moves the bodies of up to `batch_size` mails older than `age`,
+    with a primary key above `after`, to cold storage.
+
+    Returns the number of mails archived and the last primary key seen.
+    Rows locked by a concurrent write are skipped, as are drafts and
+    outgoing mails, which are still edited and sent from their body.
+
+    """
+    cutoff = now() - age
+    saved = []
+    try:
+        with transaction.atomic():
+            mails = list(Mail.objects.select_for_update(skip_locked=True).filter(
+                models.Q(date__lt=cutoff) | models.Q(date=None, processed__lt=cutoff),
+                models.Q(body_data__isnull=False) | models.Q(encoded=True),
+                outgoing=False, draft=False, pk__gt=after,
+            ).order_by('pk').only('pk', 'body', 'body_data', 'encoded', 'cold_body')[:batch_size])
+            if not mails:
+                return 0, after
+            for mail in mails:
+                if mail.body_data is not None:
+                    data = bytes(mail.body_data)
+                else:
+                    data = utils.compress_body(base64.b64decode(mail.body.encode('ascii')))
+                mail.cold_body.save('%s.body' % uuid.uuid4(), ContentFile(data), save=False)
+                saved.append(mail.cold_body)
+                mail.body = ''
+                mail.body_data = None
+                mail.encoded = False
+            Mail.objects.bulk_update(mails, ['body', 'body_data', 'encoded', 'cold_body'])
+    except BaseException:
+        for cold_body in saved:
+            cold_body.delete(save=False)
+        raise
+    return len(mails), mails[-1].pk
+
+
+class Command(BaseCommand):
+    help = "Move the bodies of old mails out of the database to the " \
+           "file storage, in batches, while the service is running."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--age', type=int, default=None,
+            help="Days after which a body is archived; "
+                 "DJANGO_MAILBOX_COLD_BODY_AGE by default.",
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help="Mails archived per transaction.",
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help="Seconds to wait between batches.",
+        )
+
+    def handle(self, *args, **options):
+        age = options['age']
+        if age is None:
+            age = utils.get_settings()['cold_body_age']
+        archived, last = 0, 0
+        try:
+            while True:
+                close_old_connections()
+                count, last = archive_mail_bodies(
+                    timedelta(days=age), options['batch_size'], after=last
+                )
+                if not count:
+                    break
+                archived += count
+                time.sleep(options['sleep'])
+        except KeyboardInterrupt:
+            pass
+        logger.info("Archived %s mail bodies", archived)
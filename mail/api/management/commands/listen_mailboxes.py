@@ -0,0 +1,63 @@
+import time
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from mail.api.listener import MailboxListener
+from mail.api.models import Mailbox
+from mail.api.transports.imap import IDLE_TIMEOUT
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Listen to all active mailboxes and ingest new mail as it arrives " \
+           "(IMAP IDLE where supported, polling otherwise)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--idle-timeout', type=int, default=IDLE_TIMEOUT,
+            help="Seconds to stay in IDLE before re-issuing it.",
+        )
+        parser.add_argument(
+            '--poll-interval', type=int, default=60,
+            help="Seconds between polls for servers without IDLE.",
+        )
+        parser.add_argument(
+            '--refresh-interval', type=int, default=60,
+            help="Seconds between checks for added or deactivated mailboxes.",
+        )
+
+    def handle(self, *args, **options):
+        listeners = {}
+
+        try:
+            while True:
+                close_old_connections()
+                active = set(
+                    Mailbox.active_mailboxes.exclude(uri=None).values_list('id', flat=True)
+                )
+
+                for mailbox_id in set(listeners) - active:
+                    listeners.pop(mailbox_id).stop()
+
+                for mailbox_id in active:
+                    listener = listeners.get(mailbox_id)
+                    if listener is None or not listener.is_alive():
+                        listener = MailboxListener(
+                            mailbox_id,
+                            idle_timeout=options['idle_timeout'],
+                            poll_interval=options['poll_interval'],
+                        )
+                        listener.start()
+                        listeners[mailbox_id] = listener
+
+                logger.info("Listening to %s mailboxes", len(listeners))
+                time.sleep(options['refresh_interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for listener in listeners.values():
+                listener.stop()
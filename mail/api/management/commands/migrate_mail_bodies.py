@@ -0,0 +1,63 @@
+import time
+import base64
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, transaction
+
+import mail.api.utils as utils
+from mail.api.models import Mail
+
+
+logger = logging.getLogger(__name__)
+
+
+def migrate_mail_bodies(batch_size, after=0):
+    """Moves the base64 bodies of up to `batch_size` mails with a primary
+    key above `after` to compressed `body_data`.
+
+    Returns the number of mails converted and the last primary key seen.
+    Rows locked by a concurrent write are skipped.
+
+    """
+    with transaction.atomic():
+        mails = list(Mail.objects.select_for_update(skip_locked=True).filter(
+            pk__gt=after, encoded=True, body_data=None
+        ).order_by('pk').only('pk', 'body', 'encoded')[:batch_size])
+        if not mails:
+            return 0, after
+        for mail in mails:
+            mail.body_data = utils.compress_body(base64.b64decode(mail.body.encode('ascii')))
+            mail.body = ''
+            mail.encoded = False
+        Mail.objects.bulk_update(mails, ['body', 'body_data', 'encoded'])
+    return len(mails), mails[-1].pk
+
+
+class Command(BaseCommand):
+    help = "Convert base64 mail bodies to compressed binary ones, " \
+           "in batches, while the service is running."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help="Mails converted per transaction.",
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help="Seconds to wait between batches.",
+        )
+
+    def handle(self, *args, **options):
+        converted, last = 0, 0
+        try:
+            while True:
+                close_old_connections()
+                count, last = migrate_mail_bodies(options['batch_size'], after=last)
+                if not count:
+                    break
+                converted += count
+                time.sleep(options['sleep'])
+        except KeyboardInterrupt:
+            pass
+        logger.info("Converted %s mail bodies", converted)
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mail.api.aioscheduler import AsyncPollingScheduler
+from mail.api.scheduler import PollingScheduler
+
+
+class Command(BaseCommand):
+    help = "Poll active mailboxes at intervals adapted to their mail arrival rate."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int, default=settings.MAIL_POLLING_CONCURRENCY,
+            help="Maximum number of mailboxes polled at once.",
+        )
+        parser.add_argument(
+            '--asyncio', action='store_true',
+            help="Poll IMAP mailboxes from an event loop instead of threads; "
+                 "other mailboxes still take up to --concurrency threads.",
+        )
+        parser.add_argument(
+            '--async-concurrency', type=int, default=settings.MAIL_ASYNC_POLLING_CONCURRENCY,
+            help="Maximum number of IMAP mailboxes polled at once with --asyncio.",
+        )
+        parser.add_argument(
+            '--per-host', type=int, default=settings.MAIL_ASYNC_POLLING_PER_HOST,
+            help="Maximum number of IMAP sessions to one server with --asyncio.",
+        )
+
+    def handle(self, *args, **options):
+        if options['asyncio']:
+            scheduler = AsyncPollingScheduler(
+                options['async_concurrency'],
+                per_host=options['per_host'],
+                queue_size=settings.MAIL_ASYNC_POLLING_QUEUE_SIZE,
+                sync_concurrency=options['concurrency'],
+            )
+        else:
+            scheduler = PollingScheduler(options['concurrency'])
+        try:
+            scheduler.run()
+        except KeyboardInterrupt:
+            pass
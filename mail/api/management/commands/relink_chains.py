@@ -0,0 +1,37 @@
+import time
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from mail.api.chains import relink_chains
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Link mails to referenced messages that arrived after them, " \
+           "merging their chains."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=int, default=0,
+            help="Seconds between passes; a single pass is run when 0.",
+        )
+        parser.add_argument(
+            '--limit', type=int, default=1000,
+            help="Maximum number of references resolved per pass.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            while True:
+                close_old_connections()
+                resolved = relink_chains(limit=options['limit'])
+                logger.info("Resolved %s pending references", resolved)
+                if not options['interval']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,63 @@
+import time
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, models, transaction
+
+from mail.api.models import Mail
+
+
+logger = logging.getLogger(__name__)
+
+
+def strip_mail_bodies(batch_size, after=0):
+    """Empties the bodies of up to `batch_size` mails with a primary key
+    above `after` whose original message is stored.
+
+    Returns the number of mails stripped and the last primary key seen.
+    Rows locked by a concurrent write are skipped.
+
+    """
+    with transaction.atomic():
+        mails = list(Mail.objects.select_for_update(skip_locked=True).filter(
+            pk__gt=after
+        ).exclude(
+            models.Q(eml='') | models.Q(eml=None)
+        ).exclude(
+            body='', body_data=None
+        ).order_by('pk').only('pk')[:batch_size])
+        if not mails:
+            return 0, after
+        Mail.objects.filter(pk__in=[mail.pk for mail in mails]).update(
+            body='', body_data=None, encoded=False
+        )
+    return len(mails), mails[-1].pk
+
+
+class Command(BaseCommand):
+    help = "Drop the bodies of mails whose original message is stored, " \
+           "in batches, while the service is running."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help="Mails stripped per transaction.",
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help="Seconds to wait between batches.",
+        )
+
+    def handle(self, *args, **options):
+        stripped, last = 0, 0
+        try:
+            while True:
+                close_old_connections()
+                count, last = strip_mail_bodies(options['batch_size'], after=last)
+                if not count:
+                    break
+                stripped += count
+                time.sleep(options['sleep'])
+        except KeyboardInterrupt:
+            pass
+        logger.info("Stripped %s mail bodies", stripped)
@@ -0,0 +1,37 @@
+import time
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from mail.api.uploads import upload_staged_blobs
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Upload attachment payloads left in the staging area " \
+           "to the file storage."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=int, default=0,
+            help="Seconds between passes; a single pass is run when 0.",
+        )
+        parser.add_argument(
+            '--limit', type=int, default=1000,
+            help="Maximum number of payloads uploaded per pass.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            while True:
+                close_old_connections()
+                uploaded = upload_staged_blobs(limit=options['limit'])
+                logger.info("Uploaded %s staged attachments", uploaded)
+                if not options['interval']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
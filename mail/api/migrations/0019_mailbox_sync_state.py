@@ -0,0 +1,19 @@
+# Generated by Django 2.2.6 on 2026-10-18 08:43
+
+from django.db import migrations
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_auto_20221107_2056'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailbox',
+            name='sync_state',
+            field=jsonfield.fields.JSONField(help_text='Incremental sync state per remote folder: UIDVALIDITY and the highest UID already ingested.', null=True),
+        ),
+    ]
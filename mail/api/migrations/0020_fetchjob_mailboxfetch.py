@@ -0,0 +1,43 @@
+# Generated by Django 2.2.6 on 2026-10-18 08:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0019_mailbox_sync_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FetchJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, primary_key=True, serialize=False)),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='Finished')),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+        migrations.CreateModel(
+            name='MailboxFetch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=16, verbose_name='Status')),
+                ('mails_received', models.IntegerField(default=0, verbose_name='Mails received')),
+                ('contacts_added', models.IntegerField(default=0, verbose_name='Contacts added')),
+                ('error', models.TextField(blank=True, null=True, verbose_name='Error')),
+                ('started', models.DateTimeField(blank=True, null=True, verbose_name='Started')),
+                ('duration', models.FloatField(blank=True, help_text='Seconds', null=True, verbose_name='Duration')),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mailboxes', to='api.FetchJob')),
+                ('mailbox', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.Mailbox')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
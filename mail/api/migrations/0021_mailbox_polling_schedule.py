@@ -0,0 +1,33 @@
+# Generated by Django 2.2.6 on 2026-10-18 08:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_fetchjob_mailboxfetch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailbox',
+            name='arrival_rate',
+            field=models.FloatField(default=0, help_text='Moving average of incoming messages per second.', verbose_name='Arrival rate'),
+        ),
+        migrations.AddField(
+            model_name='mailbox',
+            name='next_polling',
+            field=models.DateTimeField(blank=True, help_text='The time this mailbox is due to be polled by the scheduler.', null=True, verbose_name='Next polling'),
+        ),
+        migrations.AddField(
+            model_name='mailbox',
+            name='polling_failures',
+            field=models.IntegerField(default=0, help_text='Number of polls failed in a row.', verbose_name='Polling failures'),
+        ),
+        migrations.AddField(
+            model_name='mailbox',
+            name='polling_interval',
+            field=models.FloatField(blank=True, help_text='Seconds', null=True, verbose_name='Polling interval'),
+        ),
+    ]
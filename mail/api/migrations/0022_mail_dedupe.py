@@ -0,0 +1,31 @@
+# Generated by Django 2.2.6 on 2026-10-18 08:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0021_mailbox_polling_schedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mail',
+            name='content_hash',
+            field=models.CharField(blank=True, help_text='SHA-256 of the original message, kept for messages without Message-ID', max_length=64, null=True, verbose_name='Content hash'),
+        ),
+        migrations.AlterField(
+            model_name='mail',
+            name='message_id',
+            field=models.CharField(blank=True, db_index=True, max_length=255, null=True, verbose_name='Message ID'),
+        ),
+        migrations.AddIndex(
+            model_name='mail',
+            index=models.Index(fields=['mailbox', 'message_id'], name='api_mail_mailbox_32561c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mail',
+            index=models.Index(fields=['mailbox', 'content_hash'], name='api_mail_mailbox_b4f5c1_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.6 on 2026-10-18 08:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0022_mail_dedupe'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chain',
+            name='subject',
+            field=models.CharField(blank=True, db_index=True, help_text='Normalized subject of the first message', max_length=255, null=True, verbose_name='Subject'),
+        ),
+        migrations.CreateModel(
+            name='PendingReference',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_id', models.CharField(db_index=True, max_length=255, verbose_name='Message ID')),
+                ('in_reply_to', models.BooleanField(default=False)),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('mail', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pending_references', to='api.Mail')),
+            ],
+        ),
+    ]
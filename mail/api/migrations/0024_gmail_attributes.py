@@ -0,0 +1,31 @@
+# Generated by Django 2.2.6 on 2026-10-18 09:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0023_chain_threading'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mail',
+            name='gmail_message_id',
+            field=models.CharField(blank=True, help_text='X-GM-MSGID of messages fetched from Gmail', max_length=32, null=True, verbose_name='Gmail message ID'),
+        ),
+        migrations.AddField(
+            model_name='mail',
+            name='gmail_thread_id',
+            field=models.CharField(blank=True, help_text='X-GM-THRID of messages fetched from Gmail', max_length=32, null=True, verbose_name='Gmail thread ID'),
+        ),
+        migrations.AddIndex(
+            model_name='mail',
+            index=models.Index(fields=['mailbox', 'gmail_message_id'], name='api_mail_mailbox_c8e9a3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mail',
+            index=models.Index(fields=['mailbox', 'gmail_thread_id'], name='api_mail_mailbox_946bd1_idx'),
+        ),
+    ]
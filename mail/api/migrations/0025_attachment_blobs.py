@@ -0,0 +1,39 @@
+# Generated by Django 2.2.6 on 2026-10-18 09:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+import mail.api.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0024_gmail_attributes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AttachmentBlob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64, unique=True, verbose_name='Content hash')),
+                ('document', models.FileField(max_length=255, upload_to=mail.api.utils.get_attachment_blob_save_path, verbose_name='Document')),
+                ('size', models.BigIntegerField(default=0, verbose_name='Size')),
+                ('references', models.IntegerField(default=0, verbose_name='References')),
+            ],
+            options={
+                'verbose_name': 'Attachment blob',
+                'verbose_name_plural': 'Attachment blobs',
+            },
+        ),
+        migrations.AlterField(
+            model_name='attachment',
+            name='document',
+            field=models.FileField(max_length=255, upload_to=mail.api.utils.get_attachment_save_path, verbose_name='Document'),
+        ),
+        migrations.AddField(
+            model_name='attachment',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='attachments', to='api.AttachmentBlob', verbose_name='Blob'),
+        ),
+    ]
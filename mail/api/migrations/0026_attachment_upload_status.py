@@ -0,0 +1,29 @@
+# Generated by Django 2.2.6 on 2026-10-18 09:23
+
+from django.db import migrations, models
+import mail.api.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0025_attachment_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachmentblob',
+            name='staged_path',
+            field=models.CharField(blank=True, default='', max_length=255, verbose_name='Staged path'),
+        ),
+        migrations.AddField(
+            model_name='attachmentblob',
+            name='upload_status',
+            field=models.CharField(choices=[('stored', 'Stored'), ('staged', 'Staged')], default='stored', max_length=16, verbose_name='Upload status'),
+        ),
+        migrations.AlterField(
+            model_name='attachmentblob',
+            name='document',
+            field=models.FileField(blank=True, max_length=255, upload_to=mail.api.utils.get_attachment_blob_save_path, verbose_name='Document'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.6 on 2026-10-18 09:24
+
+from django.db import migrations, models
+
+
+def mark_outgoing_built(apps, schema_editor):
+    # Every outgoing mail saved so far was built on its first save, or
+    # recorded from a message that was already sent
+    Mail = apps.get_model("api", "Mail")
+    Mail.objects.filter(outgoing=True).update(built=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0026_attachment_upload_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mail',
+            name='body_data',
+            field=models.BinaryField(blank=True, null=True, verbose_name='Body data'),
+        ),
+        migrations.AddField(
+            model_name='mail',
+            name='built',
+            field=models.BooleanField(default=False, help_text='True once an outgoing message has been built from its HTML body', verbose_name='Built'),
+        ),
+        migrations.RunPython(mark_outgoing_built, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.6 on 2026-10-18 09:28
+
+from django.db import migrations, models
+import mail.api.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0027_mail_body_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mail',
+            name='cold_body',
+            field=models.FileField(blank=True, max_length=255, null=True, upload_to=mail.api.utils.get_cold_body_save_path, verbose_name='Cold body'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.6 on 2026-10-18 09:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0028_mail_cold_body'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fetchjob',
+            name='owner',
+            field=models.IntegerField(default=None, null=True, verbose_name='Owner'),
+        ),
+    ]
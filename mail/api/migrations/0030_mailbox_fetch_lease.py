@@ -0,0 +1,23 @@
+# Generated by Django 2.2.6 on 2026-10-18 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0029_fetchjob_owner'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailbox',
+            name='fetch_lease',
+            field=models.CharField(blank=True, help_text='Token of the fetch currently holding this mailbox.', max_length=32, null=True, verbose_name='Fetch lease'),
+        ),
+        migrations.AddField(
+            model_name='mailbox',
+            name='fetch_lease_expires',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Fetch lease expires'),
+        ),
+    ]
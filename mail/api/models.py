@@ -5,11 +5,12 @@ import re
 import os
 import sys
 import six
-import gzip
 import uuid
 import email
 import base64
 import logging
+import itertools
+import collections
 import os.path
 import mimetypes
 
@@ -19,7 +20,6 @@ from email.message import EmailMessage
 from email import utils as email_utils
 
 from jsonfield import JSONField
-from tempfile import NamedTemporaryFile
 from email.encoders import encode_quopri
 from email.encoders import encode_base64
 from quopri import encode as encode_quopri
@@ -33,16 +33,28 @@ from six.moves.urllib.parse import parse_qs, unquote, urlparse
 
 import django
 
+from datetime import timedelta
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from django.conf import settings as django_settings
 from django.core.files.base import ContentFile, File
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 from django.utils.timezone import now
 
 import mail.api.utils as utils
+from mail.api.pipeline import prepare_message, prepare_raw_message, get_parse_executor, \
+    discard_parse_executor
 from mail.api.signals import message_received
+from mail.api.storage import get_cold_body_cache
 from mail.api.transports import Pop3Transport, ImapTransport, \
     MaildirTransport, MboxTransport, BabylTransport, MHTransport, \
-    MMDFTransport, GmailImapTransport, OUTGOING
+    MMDFTransport, GmailImapTransport, AsyncImapTransport, OUTGOING
+from mail.api.transports.base import discard_raw_file
+from mail.api.transports.gmail import get_gmail_attributes
+from mail.api.transports.pool import get_connection_pool
 
 logger = logging.getLogger(__name__)
 
@@ -56,6 +68,10 @@ class ModelApiError(Exception):
 
 class Chain(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    subject = models.CharField(
+        _(u'Subject'), max_length=255, blank=True, null=True, db_index=True,
+        help_text=_(u'Normalized subject of the first message')
+    )
 
 
 # @todo: OPTIMIZZZZZEEEE !!!!!!!
@@ -71,7 +87,19 @@ class Mail(models.Model):
     )
 
     subject = models.CharField(_(u'Subject'), max_length=255, blank=True, null=True)
-    message_id = models.CharField(_(u'Message ID'), max_length=255, blank=True, null=True)
+    message_id = models.CharField(_(u'Message ID'), max_length=255, blank=True, null=True, db_index=True)
+    content_hash = models.CharField(
+        _(u'Content hash'), max_length=64, blank=True, null=True,
+        help_text=_(u'SHA-256 of the original message, kept for messages without Message-ID')
+    )
+    gmail_message_id = models.CharField(
+        _(u'Gmail message ID'), max_length=32, blank=True, null=True,
+        help_text=_(u'X-GM-MSGID of messages fetched from Gmail')
+    )
+    gmail_thread_id = models.CharField(
+        _(u'Gmail thread ID'), max_length=32, blank=True, null=True,
+        help_text=_(u'X-GM-THRID of messages fetched from Gmail')
+    )
 
     in_reply_to = models.ForeignKey(
         'Mail', related_name='mail_replies', blank=True,
@@ -85,6 +113,16 @@ class Mail(models.Model):
     encoded = models.BooleanField(
         _(u'Encoded'), default=False, help_text=_('True if the e-mail body is Base64 encoded'),
     )
+    # The raw message as written by `set_body`; `body` then stays empty
+    body_data = models.BinaryField(_(u'Body data'), null=True, blank=True)
+    built = models.BooleanField(
+        _(u'Built'), default=False,
+        help_text=_('True once an outgoing message has been built from its HTML body'),
+    )
+    # `body_data` moved out of the table by `archive_mail_bodies`
+    cold_body = models.FileField(
+        _(u'Cold body'), null=True, blank=True, upload_to=utils.get_cold_body_save_path, max_length=255
+    )
     date = models.DateTimeField(_('Date'), auto_now_add=True, blank=True, null=True)
     processed = models.DateTimeField(_('Processed'), auto_now_add=True)
     read = models.DateTimeField(_(u'Read'), default=None, blank=True, null=True,)
@@ -162,9 +200,11 @@ class Mail(models.Model):
                     # Cannot use `email.encoders.encode_quopri due to
                     # bug 14360: http://bugs.python.org/issue14360
                     output = six.BytesIO()
+                    with attachment.open_document() as document:
+                        content = document.read()
                     encode_quopri(
                         six.BytesIO(
-                            attachment.document.read()
+                            content
                         ),
                         output,
                         quotetabs=True,
@@ -176,9 +216,10 @@ class Mail(models.Model):
                     del new['Content-Transfer-Encoding']
                     new['Content-Transfer-Encoding'] = 'quoted-printable'
                 else:
-                    new.set_payload(
-                        attachment.document.read()
-                    )
+                    with attachment.open_document() as document:
+                        new.set_payload(
+                            document.read()
+                        )
                     del new['Content-Transfer-Encoding']
                     encode_base64(new)
             except Attachment.DoesNotExist:
@@ -197,22 +238,37 @@ class Mail(models.Model):
         return new
 
     def get_body(self):
+        if self.body_data is not None:
+            return utils.decompress_body(self.body_data)
         if self.encoded:
             return base64.b64decode(self.body.encode('ascii'))
+        if self.cold_body:
+            return utils.decompress_body(self._get_cold_body_data())
         return self.body.encode('utf-8')
 
+    def _get_cold_body_data(self):
+        cache = get_cold_body_cache()
+        data = cache.get(self.cold_body.name)
+        if data is None:
+            with self.cold_body.open('rb'):
+                data = self.cold_body.read()
+            cache.set(self.cold_body.name, data)
+        return data
+
     def set_body(self, body):
-        """Set the `body` field of this record.
+        """Set the body of this record.
 
-        This will automatically base64-encode the message contents to
-        circumvent a limitation in earlier versions of Django in which
-        no fields existed for storing arbitrary bytes.
+        The message contents are stored as bytes in `body_data`,
+        compressed as ``DJANGO_MAILBOX_BODY_COMPRESSION`` says. Mails
+        stored before kept them base64-encoded in `body` until
+        ``migrate_mail_bodies`` converts them.
 
         """
         if six.PY3:
             body = body.encode('utf-8')
-        self.encoded = True
-        self.body = base64.b64encode(body).decode('ascii')
+        self.encoded = False
+        self.body = ''
+        self.body_data = utils.compress_body(body)
 
     def get_email_object(self):
         """Returns an `email.message.Message` instance representing the
@@ -235,26 +291,23 @@ class Mail(models.Model):
         """
         if not hasattr(self, '_email_object'):
             if self.eml:
-                if self.eml.name.endswith('.gz'):
-                    body = gzip.GzipFile(fileobj=self.eml).read()
-                else:
-                    self.eml.open()
-                    body = self.eml.file.read()
-                    self.eml.close()
+                with self.eml.open('rb'):
+                    with utils.open_original_message(self.eml.file, self.eml.name) as stream:
+                        flat = email.message_from_binary_file(stream)
             else:
                 body = self.get_body()
-            if six.PY3:
-                flat = email.message_from_bytes(body)
-            else:
-                flat = email.message_from_string(body)
+                if six.PY3:
+                    flat = email.message_from_bytes(body)
+                else:
+                    flat = email.message_from_string(body)
             self._email_object = self._rehydrate(flat)
         return self._email_object
 
     def delete(self, *args, **kwargs):
         """Delete this message and all stored attachments."""
-        for attachment in self.attachments.all():
-            # This attachment is attached only to this message.
-            attachment.delete()
+        # Attachments go with the message, releasing their payloads
+        if self.cold_body:
+            self.cold_body.delete(save=False)
         return super(Mail, self).delete(*args, **kwargs)
 
     def __str__(self):
@@ -264,6 +317,12 @@ class Mail(models.Model):
         verbose_name = _('E-mail message')
         verbose_name_plural = _('E-mail messages')
         ordering = ['-processed']
+        indexes = [
+            models.Index(fields=['mailbox', 'message_id']),
+            models.Index(fields=['mailbox', 'content_hash']),
+            models.Index(fields=['mailbox', 'gmail_message_id']),
+            models.Index(fields=['mailbox', 'gmail_thread_id']),
+        ]
 
     def send(self):
         self.mailbox.out_transport.send(message=self)
@@ -271,7 +330,8 @@ class Mail(models.Model):
         self.save()
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
-        if self.outgoing:
+        # `body` holds the draft's HTML until the message is built from it
+        if self.outgoing and not self.built:
             self.from_header = self.mailbox.from_email
             self.message_id = email_utils.make_msgid()
 
@@ -290,6 +350,7 @@ class Mail(models.Model):
             self.set_body(
                 msg.as_string()
             )
+            self.built = True
 
         if self.in_reply_to:
             self.chain = self.in_reply_to.chain
@@ -300,6 +361,16 @@ class Mail(models.Model):
         super(Mail, self).save()
 
 
+class PendingReference(models.Model):
+    """A message referenced by `mail` that had not arrived yet."""
+    mail = models.ForeignKey(
+        Mail, related_name='pending_references', on_delete=models.CASCADE
+    )
+    message_id = models.CharField(_(u'Message ID'), max_length=255, db_index=True)
+    in_reply_to = models.BooleanField(default=False)
+    created = models.DateTimeField(_('Created'), auto_now_add=True)
+
+
 class Folder(models.Model):
     owner = models.IntegerField(_('Owner'), null=True, default=None)
     name = models.CharField(max_length=128, null=False)
@@ -312,18 +383,89 @@ class Folder(models.Model):
         return f'{self.name}'
 
 
+class AttachmentBlob(models.Model):
+    """
+    An attachment payload, stored once under its content hash however
+    many attachments have it.
+
+    `references` counts the attachments sharing the blob; the blob and
+    its file are deleted with the last of them.
+    """
+    STORED = 'stored'
+    STAGED = 'staged'
+    UPLOAD_STATUSES = (
+        (STORED, _(u'Stored')),
+        (STAGED, _(u'Staged')),
+    )
+
+    content_hash = models.CharField(_(u'Content hash'), max_length=64, unique=True)
+    document = models.FileField(
+        _(u'Document'), upload_to=utils.get_attachment_blob_save_path, max_length=255, blank=True
+    )
+    size = models.BigIntegerField(_(u'Size'), default=0)
+    references = models.IntegerField(_(u'References'), default=0)
+    # Staged blobs are in the local staging area until they are uploaded
+    upload_status = models.CharField(
+        _(u'Upload status'), max_length=16, choices=UPLOAD_STATUSES, default=STORED
+    )
+    staged_path = models.CharField(_(u'Staged path'), max_length=255, blank=True, default='')
+
+    def delete_payload(self):
+        """Deletes the file holding the payload, wherever it is."""
+        if self.upload_status == self.STAGED:
+            from mail.api.uploads import get_staging_storage
+            get_staging_storage().delete(self.staged_path)
+        else:
+            self.document.delete(save=False)
+
+    def __str__(self):
+        return self.content_hash
+
+    class Meta:
+        verbose_name = _('Attachment blob')
+        verbose_name_plural = _('Attachment blobs')
+
+
 class Attachment(models.Model):
     message = models.ForeignKey(
         Mail, related_name='attachments', null=True, blank=True, verbose_name=_('Message'), on_delete=models.CASCADE
     )
+    # Attachments stored before blobs, or uploaded through the API, own
+    # their document
+    blob = models.ForeignKey(
+        AttachmentBlob, related_name='attachments', null=True, blank=True,
+        verbose_name=_('Blob'), on_delete=models.PROTECT
+    )
 
     headers = models.TextField(_(u'Headers'), null=True, blank=True,)
-    document = models.FileField(_(u'Document'), upload_to=utils.get_attachment_save_path, )
+    document = models.FileField(_(u'Document'), upload_to=utils.get_attachment_save_path, max_length=255)
 
-    def delete(self, *args, **kwargs):
-        """Deletes the attachment."""
-        self.document.delete()
-        return super(Attachment, self).delete(*args, **kwargs)
+    def open_document(self):
+        """Opens the payload, from the staging area until it is uploaded."""
+        if self.blob_id is not None and self.blob.upload_status == AttachmentBlob.STAGED:
+            from mail.api.uploads import get_staging_storage
+            try:
+                return get_staging_storage().open(self.blob.staged_path)
+            except FileNotFoundError:
+                # Uploaded meanwhile
+                self.refresh_from_db()
+        self.document.open('rb')
+        return self.document
+
+    def get_metadata(self):
+        """Returns the file metadata of the payload, described from the
+        blob and headers while it is staged."""
+        if self.blob_id is not None and self.blob.upload_status == AttachmentBlob.STAGED:
+            return {
+                'id': None,
+                'filename': self.get_filename() or os.path.basename(self.blob.staged_path),
+                'mimetype': self._get_rehydrated_headers().get_content_type(),
+                'size': self.blob.size,
+                'file_url': None,
+            }
+        if not self.document:
+            return None
+        return self.document.file.meta
 
     def _get_rehydrated_headers(self):
         headers = self.headers
@@ -377,6 +519,29 @@ class Attachment(models.Model):
         verbose_name_plural = _('Message attachments')
 
 
+@receiver(post_delete, sender=Attachment)
+def release_attachment_payload(sender, instance, **kwargs):
+    """Deletes the payload of a deleted attachment unless other
+    attachments share it.
+
+    Done on `post_delete`, so that attachments deleted along with their
+    mail or in bulk drop their blob references too.
+
+    """
+    if instance.blob_id is None:
+        instance.document.delete(save=False)
+        return
+
+    with transaction.atomic():
+        blob = AttachmentBlob.objects.select_for_update().get(pk=instance.blob_id)
+        blob.references -= 1
+        if blob.references > 0:
+            blob.save(update_fields=['references'])
+        else:
+            blob.delete()
+            transaction.on_commit(blob.delete_payload)
+
+
 class Contact(models.Model):
     folder = models.ForeignKey(Folder, null=True, on_delete=models.SET_NULL)
     email = models.EmailField(blank=False, null=True, default=None, unique=True)
@@ -415,6 +580,10 @@ class Template(models.Model):
         }
 
 
+# Weight of the latest poll in the arrival rate moving average
+ARRIVAL_RATE_SMOOTHING = 0.3
+
+
 class ActiveMailboxManager(models.Manager):
     def get_queryset(self):
         return super(ActiveMailboxManager, self).get_queryset().filter(
@@ -485,6 +654,40 @@ class Mailbox(models.Model):
          )),
     )
 
+    next_polling = models.DateTimeField(
+        _(u"Next polling"), blank=True, null=True,
+        help_text=(_("The time this mailbox is due to be polled by the scheduler.")),
+    )
+
+    polling_interval = models.FloatField(
+        _(u"Polling interval"), blank=True, null=True, help_text=_('Seconds'),
+    )
+
+    arrival_rate = models.FloatField(
+        _(u"Arrival rate"), default=0,
+        help_text=(_("Moving average of incoming messages per second.")),
+    )
+
+    polling_failures = models.IntegerField(
+        _(u"Polling failures"), default=0,
+        help_text=(_("Number of polls failed in a row.")),
+    )
+
+    sync_state = JSONField(
+        null=True,
+        help_text=(_("Incremental sync state per remote folder: "
+                     "UIDVALIDITY and the highest UID already ingested.")),
+    )
+
+    fetch_lease = models.CharField(
+        _(u"Fetch lease"), max_length=32, blank=True, null=True,
+        help_text=(_("Token of the fetch currently holding this mailbox.")),
+    )
+
+    fetch_lease_expires = models.DateTimeField(
+        _(u"Fetch lease expires"), blank=True, null=True,
+    )
+
     objects = models.Manager()
     active_mailboxes = ActiveMailboxManager()
 
@@ -528,6 +731,23 @@ class Mailbox(models.Model):
             return scheme.split('+')[0]
         return scheme
 
+    @property
+    def is_gmail(self):
+        """Returns whether Gmail attributes of fetched messages apply."""
+        return self.type == 'gmail'
+
+    def get_account_mailbox_ids(self):
+        """Returns ids of the mailboxes fetching the same Gmail account as
+        this one, e.g. its INBOX and All Mail, this one included."""
+        ids = [self.pk]
+        if not self.is_gmail:
+            return ids
+        account = (self._domain, self._protocol_info.username)
+        for mailbox in Mailbox.objects.filter(uri__istartswith='gmail').exclude(pk=self.pk).only('uri'):
+            if (mailbox._domain, mailbox._protocol_info.username) == account:
+                ids.append(mailbox.pk)
+        return ids
+
     @property
     def use_ssl(self):
         """Returns whether or not this mailbox's connection uses SSL."""
@@ -554,6 +774,58 @@ class Mailbox(models.Model):
             return None
         return folder[0]
 
+    @property
+    def sync_folder(self):
+        """Returns the name of the remote folder the sync state is kept for."""
+        return self.folder or 'INBOX'
+
+    def get_sync_state(self):
+        return (self.sync_state or {}).get(self.sync_folder)
+
+    def set_sync_state(self, state):
+        sync_state = dict(self.sync_state or {})
+        sync_state[self.sync_folder] = state
+        self.sync_state = sync_state
+
+    def acquire_fetch_lease(self):
+        """Takes the lease fetching this mailbox exclusively.
+
+        Returns the lease token, or None if another fetch holds the
+        lease. A lease lapses ``DJANGO_MAILBOX_FETCH_LEASE_TTL`` seconds
+        after it was last renewed, so a crashed fetch does not keep the
+        mailbox forever.
+
+        """
+        token = uuid.uuid4().hex
+        current = now()
+        expires = current + timedelta(seconds=utils.get_settings()['fetch_lease_ttl'])
+        acquired = Mailbox.objects.filter(pk=self.pk).filter(
+            models.Q(fetch_lease_expires=None) | models.Q(fetch_lease_expires__lt=current)
+        ).update(fetch_lease=token, fetch_lease_expires=expires)
+        if not acquired:
+            return None
+        self.fetch_lease, self.fetch_lease_expires = token, expires
+        return token
+
+    def renew_fetch_lease(self, token):
+        """Extends the lease `token`; returns whether it is still held."""
+        return bool(Mailbox.objects.filter(pk=self.pk, fetch_lease=token).update(
+            fetch_lease_expires=now() + timedelta(
+                seconds=utils.get_settings()['fetch_lease_ttl']
+            )
+        ))
+
+    def release_fetch_lease(self, token):
+        Mailbox.objects.filter(pk=self.pk, fetch_lease=token).update(
+            fetch_lease=None, fetch_lease_expires=None
+        )
+        self.fetch_lease, self.fetch_lease_expires = None, None
+
+    @property
+    def date_cutoff(self):
+        """Returns the date messages have to be sent after to be fetched."""
+        return getattr(django_settings, 'SKIP_MAILS_BEFORE', None)
+
     @property
     def out_transport(self):
         return OUTGOING[self.out_type](self.out_config)
@@ -574,7 +846,9 @@ class Mailbox(models.Model):
                 ssl=self.use_ssl,
                 tls=self.use_tls,
                 archive=self.archive,
-                folder=self.folder
+                folder=self.folder,
+                sync_state=self.get_sync_state(),
+                since=self.date_cutoff,
             )
             conn.connect(self.username, self.password)
         elif self.type == 'gmail':
@@ -582,218 +856,601 @@ class Mailbox(models.Model):
                 self.location,
                 port=self.port if self.port else None,
                 ssl=True,
-                archive=self.archive
+                archive=self.archive,
+                folder=self.folder,
+                sync_state=self.get_sync_state(),
+                since=self.date_cutoff,
             )
             conn.connect(self.username, self.password)
         elif self.type == 'pop3':
             conn = Pop3Transport(
                 self.location,
                 port=self.port if self.port else None,
-                ssl=self.use_ssl
+                ssl=self.use_ssl,
+                sync_state=self.get_sync_state(),
+                since=self.date_cutoff,
             )
             conn.connect(self.username, self.password)
         elif self.type == 'maildir':
-            conn = MaildirTransport(self.location)
+            conn = MaildirTransport(self.location, since=self.date_cutoff)
         elif self.type == 'mbox':
-            conn = MboxTransport(self.location)
+            conn = MboxTransport(
+                self.location,
+                since=self.date_cutoff,
+                sync_state=self.get_sync_state(),
+            )
         elif self.type == 'babyl':
-            conn = BabylTransport(self.location)
+            conn = BabylTransport(self.location, since=self.date_cutoff)
         elif self.type == 'mh':
-            conn = MHTransport(self.location)
+            conn = MHTransport(self.location, since=self.date_cutoff)
         elif self.type == 'mmdf':
-            conn = MMDFTransport(self.location)
+            conn = MMDFTransport(self.location, since=self.date_cutoff)
         return conn
 
+    def get_async_connection(self):
+        """Returns an `AsyncImapTransport` for this IMAP mailbox, or None
+        for other transports.
+
+        It is connected with ``await connection.connect(username, password)``.
+
+        """
+        if not self.uri or self.type != 'imap':
+            return None
+        return AsyncImapTransport(
+            self.location,
+            port=self.port if self.port else None,
+            ssl=self.use_ssl,
+            tls=self.use_tls,
+            archive=self.archive,
+            folder=self.folder,
+            sync_state=self.get_sync_state(),
+            since=self.date_cutoff,
+        )
+
+    @contextmanager
+    def open_connection(self):
+        """Yields a connection to this mailbox and closes it afterwards.
+
+        IMAP sessions are taken from and returned to the process-wide
+        connection pool instead, unless pooling is disabled.
+
+        """
+        pool = None
+        if self.type in ('imap', 'gmail'):
+            pool = get_connection_pool()
+
+        if pool is None:
+            connection = self.get_connection()
+            try:
+                yield connection
+            finally:
+                if hasattr(connection, 'close'):
+                    connection.close()
+            return
+
+        connection = pool.acquire(self.uri, self.location, self.get_connection)
+        # A reused session may be ahead of a poll that failed to commit
+        connection.sync_state = self.get_sync_state()
+        discard = True
+        try:
+            yield connection
+            discard = False
+        finally:
+            pool.release(self.uri, connection, discard=discard)
+
     def process_incoming_message(self, message):
         """Process a message incoming to this mailbox."""
-        msg = self._process_message(message)
-        if msg is None:
-            return None
-        msg.outgoing = False
-        msg.save()
+        mails = self.process_incoming_messages([message])
+        return mails[0] if mails else None
 
-        message_received.send(sender=self, message=msg)
+    def process_incoming_messages(self, messages):
+        """Process a batch of messages incoming to this mailbox.
 
-        return msg
+        The batch is written in a single transaction with a constant
+        number of queries; `message_received` is sent once it commits.
+
+        """
+        settings = utils.get_settings()
+        fresh = self._exclude_known_messages(messages)
+        for message in messages:
+            if message not in fresh:
+                # Never prepared, which is what removes a spooled file
+                discard_raw_file(message)
+        return self._store_prepared_messages([
+            prepare_message(message, settings) for message in fresh
+        ])
+
+    def process_prepared_messages(self, prepared):
+        """Process a batch of messages prepared by `mail.api.pipeline`."""
+        fresh = self._exclude_known_messages(
+            prepared, get_keys=lambda item: item.dedupe_keys
+        )
+        for item in prepared:
+            if item not in fresh:
+                item.discard()
+        return self._store_prepared_messages(fresh)
+
+    def _store_prepared_messages(self, prepared):
+        try:
+            with transaction.atomic():
+                # Concurrent batches of this mailbox, or of another one
+                # of its Gmail account, wait here, so that messages
+                # stored by another batch are known below
+                list(Mailbox.objects.select_for_update().filter(
+                    pk__in=self.get_account_mailbox_ids()
+                ).order_by('pk').values_list('pk'))
+                mails = self._write_messages(self._exclude_known_messages(
+                    prepared, get_keys=lambda item: item.dedupe_keys
+                ))
+        finally:
+            for item in prepared:
+                item.discard()
+
+        for msg in mails:
+            message_received.send(sender=self, message=msg)
+
+        return mails
+
+    def _get_dedupe_keys(self, message):
+        """Returns the `Mail` fields and values identifying `message`."""
+        keys = []
+        gmail_message_id = get_gmail_attributes(message)[0]
+        if gmail_message_id and self.is_gmail:
+            keys.append(('gmail_message_id', gmail_message_id))
+        message_id = (message['message-id'] or '')[0:255].strip()
+        if message_id:
+            keys.append(('message_id', message_id))
+        else:
+            keys.append(('content_hash', utils.get_content_hash(message)))
+        return keys
+
+    def _exclude_known_messages(self, messages, get_keys=None):
+        """Drops messages already stored in this mailbox.
+
+        Messages are matched by Gmail message id, Message-ID, or by
+        content hash when they have none, so re-fetching after a failure
+        is idempotent. Gmail message ids are matched across the mailboxes
+        of the account, as a message shows in each folder it is labelled
+        with.
+
+        """
+        get_keys = get_keys or self._get_dedupe_keys
+        keyed = [(get_keys(message), message) for message in messages]
+        if not self.is_gmail:
+            keyed = [
+                ([key for key in keys if key[0] != 'gmail_message_id'], message)
+                for keys, message in keyed
+            ]
+
+        fields = ('gmail_message_id', 'message_id', 'content_hash')
+        query = models.Q()
+        for field in fields:
+            values = set(
+                value for keys, _ in keyed for name, value in keys if name == field
+            )
+            if not values:
+                continue
+            if field == 'gmail_message_id':
+                query |= models.Q(
+                    mailbox__in=self.get_account_mailbox_ids(), gmail_message_id__in=values
+                )
+            else:
+                query |= models.Q(mailbox=self, **{field + '__in': values})
+
+        known = set()
+        if query:
+            stored = Mail.objects.filter(query).values_list('mailbox_id', *fields)
+            for mailbox_id, *values in stored:
+                if mailbox_id == self.pk:
+                    known.update(zip(fields, values))
+                else:
+                    known.add(('gmail_message_id', values[0]))
+
+        fresh = []
+        for keys, message in keyed:
+            if known.intersection(keys):
+                logger.info("Skipping already stored message %s", keys[0][1])
+                continue
+            known.update(keys)
+            fresh.append(message)
+        return fresh
 
     def record_outgoing_message(self, message):
         """Record an outgoing message associated with this mailbox."""
-        msg = self._process_message(message)
-        if msg is None:
+        prepared = prepare_message(message, utils.get_settings())
+        try:
+            with transaction.atomic():
+                mails = self._write_messages([prepared])
+        finally:
+            prepared.discard()
+        if not mails:
             return None
+        msg = mails[0]
         msg.outgoing = True
+        # Recorded as sent, there is nothing to build
+        msg.built = True
         msg.save()
         return msg
 
-    def _get_dehydrated_message(self, msg, record):
-        settings = utils.get_settings()
+    def _build_message_record(self, prepared):
+        msg = Mail()
+        if prepared.message is not None:
+            msg._email_object = prepared.message # remove ?
 
-        new = EmailMessage()
-        if msg.is_multipart():
-            for header, value in msg.items():
-                # new[header] = value.replace('\n', '').replace('\r', '')
-                new[header] = value
-            for part in msg.get_payload():
-                new.attach(
-                    self._get_dehydrated_message(part, record)
-                )
-        elif (
-            settings['strip_unallowed_mimetypes']
-            and not msg.get_content_type() in settings['allowed_mimetypes']
-        ):
-            for header, value in msg.items():
-                new[header] = value
-            # Delete header, otherwise when attempting to  deserialize the
-            # payload, it will be expecting a body for this.
-            del new['Content-Transfer-Encoding']
-            new[settings['altered_message_header']] = (
-                'Stripped; Content type %s not allowed' % (
-                    msg.get_content_type()
-                )
+        if prepared.original is not None:
+            self._process_save_original_message(
+                prepared.original, msg, prepared.original_extension
             )
-            new.set_payload('')
-        elif (
-            (
-                msg.get_content_type() not in settings['text_stored_mimetypes']
-            ) or
-            ('attachment' in msg.get('Content-Disposition', ''))
-        ):
-            filename = None
-            raw_filename = msg.get_filename()
-            if raw_filename:
-                filename = utils.convert_header_to_unicode(raw_filename)
-            if not filename:
-                extension = mimetypes.guess_extension(msg.get_content_type())
-            else:
-                _, extension = os.path.splitext(filename)
-            if not extension:
-                extension = '.bin'
-
-            attachment = Attachment()
-
-            attachment.document.save(
-                filename or (uuid.uuid4().hex + extension),
-                ContentFile(
-                    six.BytesIO(
-                        msg.get_payload(decode=True)
-                    ).getvalue()
+        elif prepared.original_path is not None:
+            with open(prepared.original_path, 'rb') as fp:
+                self._process_save_original_message(
+                    File(fp), msg, prepared.original_extension
                 )
-            )
-            attachment.message = record
-            for key, value in msg.items():
-                attachment[key] = value
-            attachment.save()
-
-            placeholder = EmailMessage()
-            placeholder[
-                settings['attachment_interpolation_header']
-            ] = str(attachment.pk)
-            new = placeholder
-        else:
-            content_charset = msg.get_content_charset()
-            if not content_charset:
-                content_charset = 'ascii'
-            try:
-                # Make sure that the payload can be properly decoded in the
-                # defined charset, if it can't, let's mash some things
-                # inside the payload :-\
-                msg.get_payload(decode=True).decode(content_charset)
-            except LookupError:
-                logger.warning(
-                    "Unknown encoding %s; interpreting as ASCII!", content_charset
-                )
-                msg.set_payload(
-                    msg.get_payload(decode=True).decode('ascii', 'ignore')
-                )
-            except ValueError:
-                logger.warning("Decoding error encountered; interpreting %s as ASCII!", content_charset)
-                msg.set_payload(
-                    msg.get_payload(decode=True).decode('ascii', 'ignore')
-                )
-            new = msg
-        return new
+        msg.mailbox = self
 
-    def _process_message(self, message):
-        msg = Mail()
-        msg._email_object = message # remove ?
-        settings = utils.get_settings()
+        msg.subject = prepared.subject
+        msg.message_id = prepared.message_id
+        msg.content_hash = prepared.content_hash
+        if self.is_gmail:
+            msg.gmail_message_id = prepared.gmail_message_id
+            msg.gmail_thread_id = prepared.gmail_thread_id
+        msg.from_header = prepared.from_header
+        msg.to_header = prepared.to_header
+        return msg
 
-        if settings['store_original_message']:
-            self._process_save_original_message(message, msg)
-        msg.mailbox = self
+    def _store_attachment_blobs(self, prepared_attachments):
+        """Returns the blobs holding the payloads of `prepared_attachments`
+        by content hash, counting a reference for each attachment.
+
+        Only payloads with no blob yet are uploaded, or staged with
+        ``defer_attachment_uploads``, once each. Must run in a
+        transaction.
 
-        if 'subject' in message:
-            msg.subject = (
-                utils.convert_header_to_unicode(message['subject'])[0:255]
+        """
+        counts = collections.Counter(
+            prepared_attachment.content_hash for prepared_attachment in prepared_attachments
+        )
+        if not counts:
+            return {}
+
+        blobs = AttachmentBlob.objects.select_for_update().in_bulk(
+            list(counts), field_name='content_hash'
+        )
+        staging = None
+        if utils.get_settings()['defer_attachment_uploads']:
+            from mail.api.uploads import get_staging_storage
+            staging = get_staging_storage()
+
+        uploaded = {}
+        for prepared_attachment in prepared_attachments:
+            content_hash = prepared_attachment.content_hash
+            if content_hash in blobs or content_hash in uploaded:
+                continue
+            blob = AttachmentBlob(content_hash=content_hash, size=prepared_attachment.size)
+            with prepared_attachment.open() as payload:
+                if staging is None:
+                    blob.document.save(prepared_attachment.filename, File(payload), save=False)
+                else:
+                    blob.upload_status = AttachmentBlob.STAGED
+                    blob.staged_path = staging.save(
+                        os.path.join(content_hash, prepared_attachment.filename), File(payload)
+                    )
+            uploaded[content_hash] = blob
+
+        if uploaded:
+            AttachmentBlob.objects.bulk_create(uploaded.values(), ignore_conflicts=True)
+            stored = AttachmentBlob.objects.select_for_update().in_bulk(
+                list(uploaded), field_name='content_hash'
             )
-        if 'message-id' in message:
-            msg.message_id = message['message-id'][0:255].strip()
-        if 'from' in message:
-            msg.from_header = utils.convert_header_to_unicode(message['from'])
-        if 'to' in message:
-            msg.to_header = utils.convert_header_to_unicode(message['to'])
-        elif 'Delivered-To' in message:
-            msg.to_header = utils.convert_header_to_unicode(
-                message['Delivered-To']
+            staged = []
+            for content_hash, blob in uploaded.items():
+                winner = stored[content_hash]
+                if (winner.document.name, winner.staged_path) != (blob.document.name, blob.staged_path):
+                    # Another batch stored the same payload meanwhile
+                    blob.delete_payload()
+                elif blob.upload_status == AttachmentBlob.STAGED:
+                    staged.append(winner.pk)
+            blobs.update(stored)
+            if staged:
+                from mail.api.uploads import schedule_uploads
+                schedule_uploads(staged)
+
+        by_count = collections.defaultdict(list)
+        for content_hash, count in counts.items():
+            by_count[count].append(blobs[content_hash].pk)
+        for count, pks in by_count.items():
+            AttachmentBlob.objects.filter(pk__in=pks).update(
+                references=models.F('references') + count
             )
+        return blobs
 
-        if 'in-reply-to' in message:
-            try:
-                msg.in_reply_to = Mail.objects.filter(
-                    message_id=message['in-reply-to'].strip()
-                )[0]
-            except IndexError:
-                pass
+    def _write_messages(self, prepared):
+        """Stores prepared messages, returning the mails whose body could
+        be serialized.
 
-        msg.save()
-        message = self._get_dehydrated_message(message, msg)
-        try:
-            body = message.as_string()
-        except KeyError as exc:
-            logger.warning("Failed to parse message: %s", exc,)
-            return None
-        msg.set_body(body)
+        Chains are resolved for the whole batch at once; chains, mails and
+        attachments are then inserted with one query each, and bodies
+        written with a final bulk update.
 
-        if 'date' in message:
-            msg.date = parsedate_to_datetime(message['date'])
+        """
+        from mail.api.chains import ChainResolver
 
-        msg.save()
-        return msg
+        records = [(self._build_message_record(item), item) for item in prepared]
+        if not records:
+            return []
 
-    def _process_save_original_message(self, message, msg):
-        settings = utils.get_settings()
-        if settings['compress_original_message']:
-            with NamedTemporaryFile(suffix=".eml.gz") as fp_tmp:
-                with gzip.GzipFile(fileobj=fp_tmp, mode="w") as fp:
-                    fp.write(message.as_string().encode('utf-8'))
-                msg.eml.save(
-                    "%s.eml.gz" % (uuid.uuid4(), ),
-                    File(fp_tmp),
-                    save=False
+        resolver = ChainResolver(self)
+        resolver.resolve([(msg, item.headers) for msg, item in records])
+        Chain.objects.bulk_create(resolver.new_chains)
+        Mail.objects.bulk_create([msg for msg, _ in records])
+        resolver.link()
+        if self.is_gmail:
+            self._assign_labels([(msg, item.gmail_labels) for msg, item in records])
+
+        blobs = self._store_attachment_blobs(
+            [prepared_attachment for _, item in records for prepared_attachment in item.attachments]
+        )
+        attachments = {}
+        for msg, item in records:
+            for prepared_attachment in item.attachments:
+                blob = blobs[prepared_attachment.content_hash]
+                attachments[prepared_attachment.token] = Attachment(
+                    message=msg, headers=prepared_attachment.headers,
+                    blob=blob, document=blob.document.name
                 )
+        Attachment.objects.bulk_create(list(attachments.values()))
+
+        # The archived original is then the only copy of the message
+        single_copy = utils.get_settings()['single_copy_original_message']
+        processed = []
+        for msg, item in records:
+            if item.body is None:
+                continue
+            if not (single_copy and msg.eml):
+                body = item.body
+                for prepared_attachment in item.attachments:
+                    body = body.replace(
+                        prepared_attachment.token,
+                        str(attachments[prepared_attachment.token].pk)
+                    )
+                msg.set_body(body)
+            if item.date is not None:
+                msg.date = item.date
+            processed.append(msg)
+
+        # `date` is overwritten on insert, being an auto_now_add field
+        Mail.objects.bulk_update(
+            [msg for msg, _ in records],
+            ['body', 'body_data', 'encoded', 'date', 'in_reply_to']
+        )
+        return processed
 
-        else:
-            msg.eml.save(
-                '%s.eml' % uuid.uuid4(),
-                ContentFile(message.as_string()),
-                save=False
-            )
+    def _assign_labels(self, records):
+        """Adds the chains of mails to the folders named by their Gmail
+        labels, a list of ``(mail, labels)`` pairs.
+
+        System labels such as ``\\Inbox`` are left out.
 
-    def get_new_mail(self, condition=None):
-        """Connect to this transport and fetch new messages."""
-        connection = self.get_connection()
-        if not connection:
+        """
+        chains = {}
+        for msg, labels in records:
+            for label in labels:
+                if label and not label.startswith('\\') and msg.chain_id:
+                    chains.setdefault(label[0:128], set()).add(msg.chain_id)
+        if not chains:
             return
-        for message in connection.get_message(condition):
-            msg = self.process_incoming_message(message)
-            if not msg is None:
+
+        folders = {}
+        for folder in Folder.objects.filter(owner=self.owner, name__in=chains).order_by('-pk'):
+            folders[folder.name] = folder
+        created = Folder.objects.bulk_create([
+            Folder(owner=self.owner, name=name) for name in chains if name not in folders
+        ])
+        folders.update((folder.name, folder) for folder in created)
+
+        Folder.chains.through.objects.bulk_create([
+            Folder.chains.through(folder_id=folders[name].pk, chain_id=chain_id)
+            for name, chain_ids in chains.items() for chain_id in chain_ids
+        ], ignore_conflicts=True)
+
+    def _process_save_original_message(self, original, msg, extension='.eml'):
+        """Saves the original message, as bytes or a `File`, compressed
+        already if `extension` says so."""
+        if isinstance(original, bytes):
+            original = ContentFile(original)
+        msg.eml.save(
+            '%s%s' % (uuid.uuid4(), extension),
+            original,
+            save=False
+        )
+
+    def get_new_mail(self, condition=None, connection=None):
+        """Connect to this transport and fetch new messages.
+
+        An already open `connection` may be passed in to be reused, e.g.
+        by a long-running listener. Nothing is fetched while another
+        fetch of this mailbox holds its lease.
+
+        """
+        token = self.acquire_fetch_lease()
+        if token is None:
+            logger.info("Mailbox %s is being fetched elsewhere, skipping", self.pk)
+            return
+        try:
+            if connection is None:
+                with self.open_connection() as connection:
+                    if connection:
+                        yield from self._get_new_mail(condition, connection, token)
+            else:
+                yield from self._get_new_mail(condition, connection, token)
+        finally:
+            self.release_fetch_lease(token)
+
+    def _get_new_mail(self, condition, connection, token):
+        settings = utils.get_settings()
+        if settings['parse_workers'] and not callable(condition) \
+                and getattr(connection, 'raw_messages', False):
+            # Parsing and dehydration are spread over worker processes,
+            # a batch at a time; this thread only fetches and writes.
+            executor = get_parse_executor(settings['parse_workers'])
+            messages = connection.get_raw_message(condition)
+
+            def process(batch):
+                try:
+                    prepared = list(executor.map(
+                        prepare_raw_message, batch, itertools.repeat(settings),
+                        chunksize=max(1, len(batch) // (settings['parse_workers'] * 4))
+                    ))
+                except BrokenProcessPool:
+                    # The batch is fetched again by the next poll, which
+                    # gets a new pool
+                    discard_parse_executor(executor)
+                    raise
+                return self.process_prepared_messages(prepared)
+        else:
+            messages = connection.get_message(condition)
+            process = self.process_incoming_messages
+
+        for batch in utils.chunked(messages, settings['ingest_batch_size']):
+            mails = process(batch)
+            # Only now that the batch is stored may the transport delete,
+            # flag or checkpoint its messages
+            connection.commit()
+            # Checkpoint, so that an interrupted fetch resumes from here
+            if self._update_sync_state(connection):
+                self.save(update_fields=['sync_state'])
+            for msg in mails:
                 yield msg
+            if not self.renew_fetch_lease(token):
+                logger.warning("Mailbox %s fetch lease lapsed, stopping", self.pk)
+                return
+        # Messages skipped after the last batch
+        connection.commit()
         self.last_polling = now()
+        update_fields = ['last_polling']
+
+        if self._update_sync_state(connection):
+            update_fields.append('sync_state')
+
         if django.VERSION >= (1, 5):  # Django 1.5 introduces update_fields
-            self.save(update_fields=['last_polling'])
+            self.save(update_fields=update_fields)
         else:
             self.save()
 
+    def _update_sync_state(self, connection):
+        sync_state = getattr(connection, 'sync_state', None)
+        if sync_state is None:
+            return False
+        self.set_sync_state(sync_state)
+        return True
+
+    def get_fetching_condition(self):
+        # @todo: find better way of filter overriding
+        if self.type == 'imap':
+            return self.custom_query or django_settings.DEFAULT_IMAP_QUERY
+        return None
+
+    def schedule_next_polling(self, mails_count, since=None, failed=False):
+        """Pick the next polling time from the observed arrival rate.
+
+        The interval is the expected time until the next message arrives,
+        bounded by ``MAIL_POLLING_MIN_INTERVAL`` and
+        ``MAIL_POLLING_MAX_INTERVAL``. Failed polls back off exponentially
+        up to ``MAIL_POLLING_MAX_BACKOFF``.
+
+        """
+        min_interval = django_settings.MAIL_POLLING_MIN_INTERVAL
+        max_interval = django_settings.MAIL_POLLING_MAX_INTERVAL
+        current = now()
+
+        if not failed and since is not None:
+            elapsed = max((current - since).total_seconds(), 1)
+            self.arrival_rate = (
+                ARRIVAL_RATE_SMOOTHING * mails_count / elapsed
+                + (1 - ARRIVAL_RATE_SMOOTHING) * self.arrival_rate
+            )
+
+        if self.arrival_rate > 0:
+            interval = min(max(1 / self.arrival_rate, min_interval), max_interval)
+        else:
+            interval = max_interval
+
+        if failed:
+            self.polling_failures += 1
+            interval = max(interval, min(
+                min_interval * 2 ** self.polling_failures,
+                django_settings.MAIL_POLLING_MAX_BACKOFF
+            ))
+        else:
+            self.polling_failures = 0
+
+        self.polling_interval = interval
+        self.next_polling = current + timedelta(seconds=interval)
+        self.save(update_fields=[
+            'arrival_rate', 'polling_failures', 'polling_interval', 'next_polling'
+        ])
+
+    def fetch_new_mail(self, connection=None):
+        """Fetch new messages and register contacts of their participants.
+
+        Returns a tuple of received mails count and created contacts count.
+
+        """
+        mails = self.get_new_mail(
+            self.get_fetching_condition(), connection=connection
+        )
+
+        new_contacts = 0
+        mails_count = 0
+        batch_size = utils.get_settings()['ingest_batch_size']
+        for batch in utils.chunked(mails, batch_size):
+            mails_count += len(batch)
+            new_contacts += self._register_contacts(batch)
+
+        return mails_count, new_contacts
+
+    def _register_contacts(self, mails):
+        """Creates missing contacts for `mails` participants in bulk.
+
+        Returns the number of contacts created.
+
+        """
+        addresses = set()
+        for mail in mails:
+            addresses.update(mail.address)
+        if not addresses:
+            return 0
+
+        existing = set(Contact.objects.filter(
+            email__in=addresses
+        ).values_list('email', flat=True))
+        created = addresses - existing
+        Contact.objects.bulk_create(
+            [Contact(email=address) for address in created],
+            ignore_conflicts=True
+        )
+
+        contacts = Contact.objects.filter(
+            email__in=addresses, folder__isnull=False
+        ).select_related('folder')
+        folders = {contact.email: contact for contact in contacts}
+        for mail in mails:
+            for address in mail.address:
+                if address in folders:
+                    self._move_mail_to_folder_assigned_to(
+                        mail, folders[address]
+                    )
+        return len(created)
+
+    def _move_mail_to_folder_assigned_to(self, mail, contact):
+        try:
+            folder = contact.folder
+            folder.messages.add(mail)
+            folder.save()
+        except Exception:
+            # TODO Log here
+            pass
+
     def __str__(self):
         return self.name
 
@@ -802,6 +1459,42 @@ class Mailbox(models.Model):
         verbose_name_plural = _('Mailboxes')
 
 
+class FetchJob(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    owner = models.IntegerField(_('Owner'), null=True, default=None)
+    created = models.DateTimeField(_('Created'), auto_now_add=True)
+    finished = models.DateTimeField(_('Finished'), blank=True, null=True)
+
+    class Meta:
+        ordering = ['-created']
+
+
+class MailboxFetch(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    job = models.ForeignKey(FetchJob, related_name='mailboxes', on_delete=models.CASCADE)
+    mailbox = models.ForeignKey(Mailbox, on_delete=models.CASCADE)
+    status = models.CharField(_('Status'), choices=STATUSES, max_length=16, default=PENDING)
+    mails_received = models.IntegerField(_('Mails received'), default=0)
+    contacts_added = models.IntegerField(_('Contacts added'), default=0)
+    error = models.TextField(_('Error'), blank=True, null=True)
+    started = models.DateTimeField(_('Started'), blank=True, null=True)
+    duration = models.FloatField(_('Duration'), blank=True, null=True, help_text=_('Seconds'))
+
+    class Meta:
+        ordering = ['id']
+
+
 class IncomingMessageManager(models.Manager):
     def get_queryset(self):
         return super(IncomingMessageManager, self).get_queryset().filter(
@@ -0,0 +1,298 @@
+"""
+Parsing and dehydration of incoming messages, kept apart from the
+database and file storage so that it can run in worker processes.
+
+`prepare_message` turns a message into a picklable `PreparedMessage`;
+`Mailbox.process_prepared_messages` writes those in batches.
+"""
+import io
+import os
+import re
+import uuid
+import hashlib
+import logging
+import tempfile
+import threading
+import mimetypes
+
+from concurrent.futures import ProcessPoolExecutor
+from email.message import Message as EmailMessage
+from email.utils import parsedate_to_datetime
+
+import mail.api.utils as utils
+from mail.api.transports.base import message_from_raw, discard_raw_file
+from mail.api.transports.gmail import get_gmail_attributes
+
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_parse_executor(workers):
+    """Returns the process-wide pool parsing raw messages."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=workers)
+    return _executor
+
+
+def discard_parse_executor(executor):
+    """Drops `executor` once it is broken, e.g. after a worker was
+    killed, so that `get_parse_executor` starts a new pool."""
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+
+def dehydrate_message(msg, store_attachment, settings):
+    """Returns `msg` with its attachments replaced by placeholders.
+
+    `store_attachment(part, filename)` keeps the payload of an attachment
+    part and returns the value the placeholder refers to it by.
+
+    """
+    new = EmailMessage()
+    if msg.is_multipart():
+        for header, value in msg.items():
+            new[header] = value
+        for part in msg.get_payload():
+            new.attach(
+                dehydrate_message(part, store_attachment, settings)
+            )
+    elif (
+        settings['strip_unallowed_mimetypes']
+        and not msg.get_content_type() in settings['allowed_mimetypes']
+    ):
+        for header, value in msg.items():
+            new[header] = value
+        # Delete header, otherwise when attempting to  deserialize the
+        # payload, it will be expecting a body for this.
+        del new['Content-Transfer-Encoding']
+        new[settings['altered_message_header']] = (
+            'Stripped; Content type %s not allowed' % (
+                msg.get_content_type()
+            )
+        )
+        new.set_payload('')
+    elif (
+        (
+            msg.get_content_type() not in settings['text_stored_mimetypes']
+        ) or
+        ('attachment' in msg.get('Content-Disposition', ''))
+    ):
+        filename = None
+        raw_filename = msg.get_filename()
+        if raw_filename:
+            filename = utils.convert_header_to_unicode(raw_filename)
+        if not filename:
+            extension = mimetypes.guess_extension(msg.get_content_type())
+        else:
+            _, extension = os.path.splitext(filename)
+        if not extension:
+            extension = '.bin'
+
+        placeholder = EmailMessage()
+        placeholder[settings['attachment_interpolation_header']] = store_attachment(
+            msg, filename or (uuid.uuid4().hex + extension)
+        )
+        new = placeholder
+    else:
+        content_charset = msg.get_content_charset()
+        if not content_charset:
+            content_charset = 'ascii'
+        try:
+            # Make sure that the payload can be properly decoded in the
+            # defined charset, if it can't, let's mash some things
+            # inside the payload :-\
+            msg.get_payload(decode=True).decode(content_charset)
+        except LookupError:
+            logger.warning(
+                "Unknown encoding %s; interpreting as ASCII!", content_charset
+            )
+            msg.set_payload(
+                msg.get_payload(decode=True).decode('ascii', 'ignore')
+            )
+        except ValueError:
+            logger.warning("Decoding error encountered; interpreting %s as ASCII!", content_charset)
+            msg.set_payload(
+                msg.get_payload(decode=True).decode('ascii', 'ignore')
+            )
+        new = msg
+    return new
+
+
+class PreparedAttachment(object):
+    """
+    Decoded payload and headers of an attachment part.
+
+    Payloads larger than ``attachment_spool_size`` are kept in a
+    temporary file rather than in memory; `discard` removes it. The
+    `content_hash` of the payload names the blob it is stored in.
+    """
+    def __init__(self, part, filename, settings):
+        self.token = uuid.uuid4().hex
+        self.filename = filename
+
+        headers = EmailMessage()
+        for key, value in part.items():
+            headers[key] = re.sub("\r\n", "", str(value))
+        self.headers = headers.as_string()
+
+        self.content = None
+        self.path = None
+        if len(part.get_payload()) > settings['attachment_spool_size']:
+            fd, self.path = tempfile.mkstemp(prefix='mail-attachment-')
+            with os.fdopen(fd, 'w+b') as fp:
+                utils.write_decoded_payload(part, fp)
+                self.size = fp.tell()
+                fp.seek(0)
+                self.content_hash = utils.get_file_hash(fp)
+        else:
+            fp = io.BytesIO()
+            utils.write_decoded_payload(part, fp)
+            self.content = fp.getvalue()
+            self.size = len(self.content)
+            self.content_hash = hashlib.sha256(self.content).hexdigest()
+
+    def open(self):
+        if self.path is not None:
+            return open(self.path, 'rb')
+        return io.BytesIO(self.content)
+
+    def discard(self):
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+
+class PreparedMessage(object):
+    """
+    Everything needed to store a message, without the message itself.
+
+    `headers` holds the top-level headers only. The dehydrated `body`
+    refers to attachments by their tokens until they have been saved.
+    """
+    # The parsed message, kept when prepared in this process
+    message = None
+
+    def __init__(self, message, settings):
+        self.headers = EmailMessage()
+        for header, value in message.items():
+            self.headers[header] = value
+
+        self.subject = None
+        if 'subject' in message:
+            self.subject = utils.convert_header_to_unicode(message['subject'])[0:255]
+        self.message_id = None
+        if 'message-id' in message:
+            self.message_id = message['message-id'][0:255].strip()
+        self.from_header = ''
+        if 'from' in message:
+            self.from_header = utils.convert_header_to_unicode(message['from'])
+        self.to_header = ''
+        if 'to' in message:
+            self.to_header = utils.convert_header_to_unicode(message['to'])
+        elif 'Delivered-To' in message:
+            self.to_header = utils.convert_header_to_unicode(message['Delivered-To'])
+
+        self.gmail_message_id, self.gmail_thread_id, self.gmail_labels = \
+            get_gmail_attributes(message)
+
+        self.content_hash = None
+        if not self.message_id:
+            self.content_hash = utils.get_content_hash(message)
+        # The original as bytes, or in a temporary file at `original_path`
+        # if the message was fetched into one
+        self.original = None
+        self.original_path = None
+        self.original_extension = '.eml'
+        raw_file = getattr(message, 'raw_file', None)
+        if settings['store_original_message'] and raw_file is not None:
+            method = None
+            if settings['compress_original_message']:
+                method = settings['original_message_compression_method']
+            with raw_file.open() as fp:
+                self.original_path, self.original_extension = utils.spool_original_message(
+                    fp, method, settings['original_message_compression']
+                )
+        elif settings['store_original_message']:
+            self.original = utils.get_message_bytes(message)
+            if settings['compress_original_message']:
+                self.original, self.original_extension = utils.compress_original_message(
+                    self.original,
+                    settings['original_message_compression_method'],
+                    settings['original_message_compression'],
+                )
+
+        self.attachments = []
+        dehydrated = dehydrate_message(
+            message,
+            lambda part, filename: self._store_attachment(part, filename, settings),
+            settings
+        )
+        try:
+            self.body = dehydrated.as_string()
+        except KeyError as exc:
+            logger.warning("Failed to parse message: %s", exc,)
+            self.body = None
+        self.date = None
+        if 'date' in dehydrated:
+            try:
+                self.date = parsedate_to_datetime(dehydrated['date'])
+            except (TypeError, ValueError, IndexError):
+                logger.warning("Unparseable Date header: %s", dehydrated['date'])
+
+    def _store_attachment(self, part, filename, settings):
+        attachment = PreparedAttachment(part, filename, settings)
+        self.attachments.append(attachment)
+        return attachment.token
+
+    @property
+    def dedupe_keys(self):
+        keys = []
+        if self.gmail_message_id:
+            keys.append(('gmail_message_id', self.gmail_message_id))
+        if self.message_id:
+            keys.append(('message_id', self.message_id))
+        else:
+            keys.append(('content_hash', self.content_hash))
+        return keys
+
+    def discard(self):
+        for attachment in self.attachments:
+            attachment.discard()
+        if self.original_path is not None:
+            try:
+                os.remove(self.original_path)
+            except FileNotFoundError:
+                pass
+            self.original_path = None
+
+
+def prepare_message(message, settings):
+    try:
+        prepared = PreparedMessage(message, settings)
+    finally:
+        discard_raw_file(message)
+    prepared.message = message
+    return prepared
+
+
+def prepare_raw_message(contents, settings):
+    """Parses and prepares a message given as bytes or as a
+    `RawMessageFile`; run in the pool."""
+    try:
+        message = message_from_raw(contents)
+        message.gmail_attributes = get_gmail_attributes(contents)
+        return PreparedMessage(message, settings)
+    finally:
+        if not isinstance(contents, bytes):
+            contents.discard()
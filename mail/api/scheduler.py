@@ -0,0 +1,77 @@
+import time
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections, connection
+from django.db.models import F, Q
+from django.utils.timezone import now
+
+from mail.api.models import Mailbox
+
+
+logger = logging.getLogger(__name__)
+
+
+def poll_mailbox(mailbox_id):
+    close_old_connections()
+    try:
+        mailbox = Mailbox.objects.get(pk=mailbox_id)
+        since = mailbox.last_polling
+        try:
+            mails_count, new_contacts = mailbox.fetch_new_mail()
+            failed = False
+        except Exception:
+            logger.exception("Polling mailbox %s failed", mailbox_id)
+            mails_count, failed = 0, True
+        mailbox.schedule_next_polling(mails_count, since=since, failed=failed)
+    except Exception:
+        logger.exception("Scheduling mailbox %s failed", mailbox_id)
+    finally:
+        connection.close()
+
+
+class PollingScheduler(object):
+    """
+    Polls active mailboxes once their `next_polling` time is due.
+
+    At most `concurrency` mailboxes are polled at once; each poll picks
+    the mailbox's next due time from its arrival rate and failures.
+    """
+    def __init__(self, concurrency, tick=1):
+        self.concurrency = concurrency
+        self.tick = tick
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix='mail-poll'
+        )
+        self.in_flight = {}
+
+    def get_due_mailboxes(self, limit):
+        return Mailbox.active_mailboxes.exclude(uri=None).exclude(
+            pk__in=list(self.in_flight)
+        ).filter(
+            Q(next_polling=None) | Q(next_polling__lte=now())
+        ).order_by(
+            F('next_polling').asc(nulls_first=True)
+        ).values_list('id', flat=True)[:limit]
+
+    def run_pending(self):
+        for mailbox_id, future in list(self.in_flight.items()):
+            if future.done():
+                del self.in_flight[mailbox_id]
+
+        free = self.concurrency - len(self.in_flight)
+        if free <= 0:
+            return
+
+        for mailbox_id in self.get_due_mailboxes(free):
+            self.in_flight[mailbox_id] = self.executor.submit(poll_mailbox, mailbox_id)
+
+    def run(self):
+        try:
+            while True:
+                close_old_connections()
+                self.run_pending()
+                time.sleep(self.tick)
+        finally:
+            self.executor.shutdown(wait=True)
@@ -5,11 +5,12 @@ from urllib.parse import urlparse, quote_plus
 from django.core.files.storage import default_storage
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
+from rest_framework.reverse import reverse
 from rest_framework.validators import UniqueValidator
 
 
 from mail.api.models import Folder, Contact, Mail, \
-    Mailbox, Attachment, Template
+    Mailbox, Attachment, Template, FetchJob, MailboxFetch
 
 
 class EmailsListHeaderField(serializers.ListField):
@@ -63,10 +64,15 @@ class AttachmentsSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
     def to_representation(self, instance):
-        if instance.document:
-            return instance.document.file.meta
-        else:
-            return None
+        meta = instance.get_metadata()
+        if meta is not None and meta['file_url'] is None:
+            # Staged, and only served by this API until it is uploaded
+            meta['file_url'] = reverse(
+                'api:mails-attachment',
+                kwargs={'pk': instance.message_id, 'attachment_id': instance.pk},
+                request=self.context.get('request'),
+            )
+        return meta
 
 
 class MailSerializer(serializers.ModelSerializer):
@@ -146,10 +152,11 @@ class TroodMailboxSerializer(serializers.ModelSerializer):
         model = Mailbox
         fields = (
             "id", "owner", "shared",  "name", "active", "out_type", "out_config",
-            "imap_host", "imap_port", "last_polling", "custom_query", "from_email"
+            "imap_host", "imap_port", "last_polling", "custom_query", "from_email",
+            "next_polling", "polling_interval"
         )
 
-        read_only_fields = ("owner", "id")
+        read_only_fields = ("owner", "id", "next_polling", "polling_interval")
 
     def to_internal_value(self, data):
         imap_secure = data.pop("imap_secure", None)
@@ -201,3 +208,28 @@ class MoveMailsToFolderSerializer(serializers.ModelSerializer):
     class Meta:
         model = Folder
         fields = ('messages', )
+
+
+class MailboxFetchSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = MailboxFetch
+        fields = (
+            "mailbox", "status", "mails_received", "contacts_added",
+            "error", "started", "duration"
+        )
+
+
+class FetchJobSerializer(serializers.ModelSerializer):
+    mailboxes = MailboxFetchSerializer(many=True, read_only=True)
+    mails_received = serializers.SerializerMethodField()
+    contacts_added = serializers.SerializerMethodField()
+
+    class Meta:
+        model = FetchJob
+        fields = ("id", "created", "finished", "mails_received", "contacts_added", "mailboxes")
+
+    def get_mails_received(self, instance):
+        return sum(fetch.mails_received for fetch in instance.mailboxes.all())
+
+    def get_contacts_added(self, instance):
+        return sum(fetch.contacts_added for fetch in instance.mailboxes.all())
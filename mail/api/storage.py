@@ -1,17 +1,280 @@
+import io
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import functools
+
+from collections import OrderedDict
+
 import requests
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.core.files.storage import Storage
+from requests.adapters import HTTPAdapter
 from rest_framework import status
 
 from mail.api.utils import build_absolute_url
 from trood.core.utils import get_service_token
 
+_session = None
+_session_lock = threading.Lock()
+
+_token = None
+_token_expires = 0
+_token_lock = threading.Lock()
+
+_metadata = None
+_metadata_lock = threading.Lock()
+
+_file_cache = None
+_file_cache_lock = threading.Lock()
+
+_cold_body_cache = None
+_cold_body_cache_lock = threading.Lock()
+
+
+def get_http_session():
+    """Returns the process-wide keep-alive session for the file service.
+
+    ``DJANGO_MAILBOX_FILE_STORAGE_POOL_SIZE`` caps the connections it
+    keeps open to a host.
+
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool_size = getattr(settings, 'DJANGO_MAILBOX_FILE_STORAGE_POOL_SIZE', 10)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+    return _session
+
+
+def get_cached_service_token():
+    """Returns the service token, signing a new one once the previous is
+    older than ``DJANGO_MAILBOX_SERVICE_TOKEN_TTL`` seconds."""
+    global _token, _token_expires
+    with _token_lock:
+        if _token is None or time.monotonic() >= _token_expires:
+            _token = get_service_token()
+            _token_expires = time.monotonic() + getattr(
+                settings, 'DJANGO_MAILBOX_SERVICE_TOKEN_TTL', 5 * 60
+            )
+        return _token
+
+
+class LRUCache(object):
+    """Least recently used values, up to `max_size` in total as measured
+    by `sizeof`, which counts each value as 1 by default."""
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self.size -= self.sizeof(previous)
+            self._items[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+
+
+class FileCache(object):
+    """
+    Read-through cache of remote file contents on local disk.
+
+    Files are kept under `path` by a hash of their name, up to
+    `max_size` bytes; the least recently read are evicted first. A file
+    is written to a temporary name and renamed into place, so processes
+    sharing the directory never read a partial copy. Files of up to
+    `memory_max_file` bytes are also kept in memory, `memory_size` bytes
+    at most.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, path, max_size, memory_size=0, memory_max_file=0):
+        self.path = path
+        self.max_size = max_size
+        self.memory_max_file = memory_max_file
+        self.memory = LRUCache(memory_size, sizeof=len)
+        # Size of the directory when last measured, plus what this
+        # process has written since
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _get_path(self, name):
+        key = hashlib.sha256(name.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, name):
+        """Returns the cached contents of `name` as a file, or None."""
+        content = self.memory.get(name)
+        if content is not None:
+            return io.BytesIO(content)
+
+        path = self._get_path(name)
+        try:
+            fp = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            # The modification time orders files for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return self._keep_small(name, fp)
+
+    def fill(self, name, stream):
+        """Copies `stream` into the cache as `name` and returns the copy."""
+        path = self._get_path(name)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.fill-')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                shutil.copyfileobj(stream, fp, self.chunk_size)
+                size = fp.tell()
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        fp = open(path, 'rb')
+        self._add(size)
+        return self._keep_small(name, fp)
+
+    def _keep_small(self, name, fp):
+        if not self.memory.max_size or os.fstat(fp.fileno()).st_size > self.memory_max_file:
+            return fp
+        with fp:
+            content = fp.read()
+        self.memory.set(name, content)
+        return io.BytesIO(content)
+
+    def _add(self, size):
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+                if self._size <= self.max_size:
+                    return
+            self._size = self._evict()
+
+    def _evict(self):
+        """Removes the least recently read files until the cache fits in
+        nine tenths of `max_size`; returns the size left."""
+        files = []
+        with os.scandir(self.path) as directories:
+            for directory in directories:
+                if not directory.is_dir():
+                    continue
+                with os.scandir(directory.path) as entries:
+                    for entry in entries:
+                        if entry.name.startswith('.fill-'):
+                            continue
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(file_size for _, file_size, _ in files)
+        if size <= self.max_size:
+            return size
+        files.sort()
+        for _, file_size, path in files:
+            if size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+        return size
+
+
+def get_metadata_cache():
+    """Returns the process-wide file metadata cache, holding up to
+    ``DJANGO_MAILBOX_FILE_STORAGE_METADATA_CACHE_SIZE`` files."""
+    global _metadata
+    with _metadata_lock:
+        if _metadata is None:
+            _metadata = LRUCache(
+                getattr(settings, 'DJANGO_MAILBOX_FILE_STORAGE_METADATA_CACHE_SIZE', 1024)
+            )
+    return _metadata
+
+
+def get_cold_body_cache():
+    """Returns the process-wide cache of mail bodies read from cold
+    storage, holding up to ``DJANGO_MAILBOX_COLD_BODY_CACHE_SIZE`` bytes."""
+    global _cold_body_cache
+    with _cold_body_cache_lock:
+        if _cold_body_cache is None:
+            _cold_body_cache = LRUCache(
+                getattr(settings, 'DJANGO_MAILBOX_COLD_BODY_CACHE_SIZE', 64 * 1024 * 1024),
+                sizeof=len
+            )
+    return _cold_body_cache
+
+
+def get_file_cache():
+    """Returns the process-wide cache of remote file contents, or None if
+    it is disabled with ``DJANGO_MAILBOX_FILE_CACHE_SIZE = 0``."""
+    global _file_cache
+    with _file_cache_lock:
+        if _file_cache is None:
+            max_size = getattr(settings, 'DJANGO_MAILBOX_FILE_CACHE_SIZE', 1024 ** 3)
+            if not max_size:
+                return None
+            _file_cache = FileCache(
+                os.path.join(
+                    settings.MEDIA_ROOT,
+                    getattr(settings, 'DJANGO_MAILBOX_FILE_CACHE_DIR', 'mailbox_cache')
+                ),
+                max_size,
+                memory_size=getattr(settings, 'DJANGO_MAILBOX_FILE_CACHE_MEMORY_SIZE', 0),
+                memory_max_file=getattr(settings, 'DJANGO_MAILBOX_FILE_CACHE_MEMORY_MAX_FILE', 64 * 1024),
+            )
+    return _file_cache
+
+
 class TroodFile(ContentFile):
     def __init__(self, content, options):
         self.meta = options
         self.file = content
 
+    @property
+    def file(self):
+        # Contents given as a callable are fetched on first use, so that
+        # reading the metadata alone costs no transfer
+        if callable(self._file):
+            self._file = self._file()
+        return self._file
+
+    @file.setter
+    def file(self, value):
+        self._file = value
+
     @property
     def type(self):
         return self.meta['mimetype']
@@ -28,47 +291,74 @@ class TroodFile(ContentFile):
 class TroodFileStorage(Storage):
     def __init__(self):
         self.host = settings.DEFAULT_FILE_STORAGE_HOST
+        self.metadata = get_metadata_cache()
 
-    def _open(self, name, mode):
-        detail_file_url = build_absolute_url(self.host,  f'api/v1.0/files/{name}/')
-        response = requests.get(detail_file_url, headers={
-            'Authorization': get_service_token()
+    def _get_metadata(self, name):
+        """Returns the metadata of file `name`, or None if there is none."""
+        meta = self.metadata.get(name)
+        if meta is not None:
+            return meta
+
+        detail_file_url = build_absolute_url(self.host, f'api/v1.0/files/{name}/')
+        response = get_http_session().get(detail_file_url, headers={
+            'Authorization': get_cached_service_token()
         })
+        if response.status_code != status.HTTP_200_OK:
+            return None
 
-        if response.status_code == status.HTTP_200_OK:
-            file_data = response.json()
+        meta = response.json()
+        self.metadata.set(name, meta)
+        return meta
 
-            response = requests.get('http:' + file_data['file_url'], stream=True)
-            if response.status_code == status.HTTP_200_OK:
-                return TroodFile(response.raw, file_data)
-            raise FileNotFoundError("File http:{} does not exists".format(file_data['file_url']))
+    def _open(self, name, mode):
+        file_data = self._get_metadata(name)
+        if file_data is None:
+            raise FileNotFoundError("File with id:{} does not exists".format(name))
 
-        raise FileNotFoundError("File with id:{} does not exists".format(detail_file_url))
+        return TroodFile(functools.partial(self._open_content, name, file_data), file_data)
 
-    def _save(self, name, content):
-        try:
-            file = self.open(name)
-            return file.meta['id']
+    def _open_content(self, name, file_data):
+        cache = get_file_cache()
+        if cache is not None:
+            content = cache.get(name)
+            if content is not None:
+                return content
 
-        except FileNotFoundError:
+        response = get_http_session().get('http:' + file_data['file_url'], stream=True)
+        if response.status_code != status.HTTP_200_OK:
+            raise FileNotFoundError("File http:{} does not exists".format(file_data['file_url']))
+        if cache is None:
+            return response.raw
+        with response:
+            return cache.fill(name, response.raw)
+
+    def _save(self, name, content):
+        if isinstance(content, TroodFile) and content.meta.get('id') == name:
+            # A stored file saved back under its id, such as one attached
+            # to an outgoing mail; there is nothing to upload
+            return name
 
-            url = build_absolute_url(self.host, 'api/v1.0/files/')
+        url = build_absolute_url(self.host, 'api/v1.0/files/')
 
-            headers = {
-                'Authorization': get_service_token()
-            }
+        headers = {
+            'Authorization': get_cached_service_token()
+        }
 
-            response = requests.post(url, files={'file': (name, content)}, data={'name': name}, headers=headers)
+        response = get_http_session().post(url, files={'file': (name, content)}, data={'name': name}, headers=headers)
 
-            response.raise_for_status()
+        response.raise_for_status()
 
-            if response.status_code == status.HTTP_201_CREATED:
-                return response.json()['id']
+        if response.status_code == status.HTTP_201_CREATED:
+            meta = response.json()
+            self.metadata.set(meta['id'], meta)
+            return meta['id']
 
+    def exists(self, name):
+        return self._get_metadata(name) is not None
 
     def get_available_name(self, name, max_length=None):
         name = name.split('/')[-1]
         return name
 
     def url(self, name):
-        return f'api/v1.0/files/{name}/'
\ No newline at end of file
+        return f'api/v1.0/files/{name}/'
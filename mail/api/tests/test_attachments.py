@@ -0,0 +1,110 @@
+import os
+import email
+
+from django.test import testcases, override_settings
+from hamcrest import *
+from rest_framework import status
+from rest_framework.reverse import reverse
+from rest_framework.test import APIClient
+
+from mail.api.chains import get_chain_cache
+from mail.api.models import Mail, Attachment, AttachmentBlob
+from mail.api.serializers import AttachmentsSerializer
+from mail.api.tests.utils import trood_user, Maildir
+from mail.api.uploads import get_staging_storage, upload_blob
+
+
+class AttachmentBlobTestCase(testcases.TestCase):
+
+    def setUp(self):
+        self.maildir = Maildir()
+        self.mailbox = self.maildir.mailbox
+        get_chain_cache().clear()
+
+    def tearDown(self):
+        self.maildir.delete()
+
+    def parse(self, content, message_id=None):
+        message = email.message_from_string(content)
+        if message_id:
+            message.replace_header('Message-ID', message_id)
+        return message
+
+    def test_attachment_payloads_stored_once(self):
+        content = self.maildir.create_mail(
+            'Attached', 'attached@mail.com', 'message_with_attachment_template.eml'
+        )
+        mails = self.mailbox.process_incoming_messages([
+            self.parse(content, '<first@mail.com>'), self.parse(content, '<second@mail.com>')
+        ])
+        mails.append(self.mailbox.process_incoming_message(self.parse(content, '<third@mail.com>')))
+
+        blob = AttachmentBlob.objects.get()
+        assert_that(blob.references, equal_to(3))
+        assert_that(blob.size, greater_than(0))
+        attachments = Attachment.objects.filter(message__in=mails)
+        assert_that(set(attachment.blob_id for attachment in attachments), equal_to({blob.pk}))
+        assert_that(set(attachment.document.name for attachment in attachments), equal_to({blob.document.name}))
+        assert_that(mails[2].get_email_object().get_payload()[1].get_filename(), equal_to('heart.png'))
+
+        mails[0].delete()
+        mails[1].delete()
+        assert_that(AttachmentBlob.objects.get().references, equal_to(1))
+        mails[2].delete()
+        assert_that(AttachmentBlob.objects.exists(), equal_to(False))
+
+    @override_settings(DJANGO_MAILBOX_DEFER_ATTACHMENT_UPLOADS=True)
+    def test_attachment_uploads_deferred(self):
+        content = self.maildir.create_mail(
+            'Attached', 'attached@mail.com', 'message_with_attachment_template.eml'
+        )
+        mail = self.mailbox.process_incoming_message(self.parse(content))
+        payload = self.parse(content).get_payload()[1].get_payload(decode=True)
+
+        blob = AttachmentBlob.objects.get()
+        attachment = Attachment.objects.get(message=mail)
+        assert_that(blob.upload_status, equal_to(AttachmentBlob.STAGED))
+        assert_that(attachment.document.name, equal_to(''))
+        staged = os.path.join(get_staging_storage().location, blob.staged_path)
+        assert_that(os.path.exists(staged), equal_to(True))
+        restored = Mail.objects.get(pk=mail.pk).get_email_object()
+        assert_that(restored.get_payload()[1].get_payload(decode=True), equal_to(payload))
+
+        # Described and served from staging meanwhile
+        url = reverse('api:mails-attachment', kwargs={'pk': mail.pk, 'attachment_id': attachment.pk})
+        assert_that(AttachmentsSerializer(attachment).data, has_entries({
+            'filename': 'heart.png', 'mimetype': 'image/png', 'size': len(payload), 'file_url': url,
+        }))
+        client = APIClient()
+        client.force_authenticate(user=trood_user)
+        response = client.get(url)
+        assert_that(response.status_code, equal_to(status.HTTP_200_OK))
+        assert_that(response['Content-Type'], equal_to('image/png'))
+        assert_that(b''.join(response.streaming_content), equal_to(payload))
+
+        assert_that(upload_blob(blob.pk), equal_to(True))
+        assert_that(upload_blob(blob.pk), equal_to(False))
+        blob.refresh_from_db()
+        attachment.refresh_from_db()
+        assert_that(blob.upload_status, equal_to(AttachmentBlob.STORED))
+        assert_that(attachment.document.name, equal_to(blob.document.name))
+        assert_that(os.path.exists(staged), equal_to(False))
+        restored = Mail.objects.get(pk=mail.pk).get_email_object()
+        assert_that(restored.get_payload()[1].get_payload(decode=True), equal_to(payload))
+
+    def test_mails_deleted_in_bulk_release_blobs(self):
+        content = self.maildir.create_mail(
+            'Attached', 'attached@mail.com', 'message_with_attachment_template.eml'
+        )
+        mails = self.mailbox.process_incoming_messages([
+            self.parse(content, '<%s@mail.com>' % name) for name in ('first', 'second', 'third')
+        ])
+        assert_that(AttachmentBlob.objects.get().references, equal_to(3))
+
+        # Attachments deleted along with their mails drop their references
+        Mail.objects.filter(pk__in=[mails[0].pk, mails[1].pk]).delete()
+        assert_that(AttachmentBlob.objects.get().references, equal_to(1))
+        assert_that(Attachment.objects.filter(blob__isnull=False).count(), equal_to(1))
+
+        Mail.objects.filter(pk=mails[2].pk).delete()
+        assert_that(AttachmentBlob.objects.exists(), equal_to(False))
@@ -0,0 +1,169 @@
+import os
+import gzip
+import email
+import base64
+import tempfile
+
+from datetime import timedelta
+
+from django.test import testcases, override_settings
+from django.utils.timezone import now
+from hamcrest import *
+
+import mail.api.utils as utils
+from mail.api.chains import get_chain_cache
+from mail.api.management.commands.archive_mail_bodies import archive_mail_bodies
+from mail.api.management.commands.migrate_mail_bodies import migrate_mail_bodies
+from mail.api.management.commands.strip_mail_bodies import strip_mail_bodies
+from mail.api.models import Mail, Attachment
+from mail.api.pipeline import prepare_raw_message
+from mail.api.tests.utils import Maildir
+from mail.api.transports.base import EmailTransport, RawMessageFile
+
+
+class MailBodyTestCase(testcases.TestCase):
+
+    def setUp(self):
+        self.maildir = Maildir()
+        self.mailbox = self.maildir.mailbox
+        get_chain_cache().clear()
+
+    def tearDown(self):
+        self.maildir.delete()
+
+    def parse(self, content, message_id=None):
+        message = email.message_from_string(content)
+        if message_id:
+            message.replace_header('Message-ID', message_id)
+        return message
+
+    def test_base64_bodies_migrated(self):
+        content = self.maildir.create_mail('Legacy', 'legacy@mail.com')
+        legacy = [
+            Mail.objects.create(
+                mailbox=self.mailbox, encoded=True,
+                body=base64.b64encode(content.encode()).decode('ascii')
+            ) for _ in range(3)
+        ]
+        draft = Mail.objects.create(mailbox=self.mailbox, body='<p>Draft</p>')
+
+        assert_that(migrate_mail_bodies(2), equal_to((2, legacy[1].pk)))
+        assert_that(migrate_mail_bodies(2, after=legacy[1].pk), equal_to((1, legacy[2].pk)))
+        assert_that(migrate_mail_bodies(2, after=legacy[2].pk), equal_to((0, legacy[2].pk)))
+
+        for mail in legacy:
+            mail.refresh_from_db()
+            assert_that(mail.body, equal_to(''))
+            assert_that(mail.encoded, equal_to(False))
+            assert_that(mail.get_body(), equal_to(content.encode()))
+        draft.refresh_from_db()
+        assert_that(draft.body_data, none())
+        assert_that(draft.get_body(), equal_to(b'<p>Draft</p>'))
+
+    @override_settings(
+        DJANGO_MAILBOX_STORE_ORIGINAL_MESSAGE=True, DJANGO_MAILBOX_COMPRESS_ORIGINAL_MESSAGE=True,
+        DJANGO_MAILBOX_ORIGINAL_MESSAGE_COMPRESSION=1,
+    )
+    def test_original_archived_from_fetched_bytes(self):
+        raw = self.maildir.create_mail('Original', 'original@mail.com').encode()
+        compressed = self.mailbox.process_incoming_message(EmailTransport().get_email_from_bytes(raw))
+        with override_settings(DJANGO_MAILBOX_COMPRESS_ORIGINAL_MESSAGE=False):
+            plain = self.mailbox.process_incoming_message(
+                EmailTransport().get_email_from_bytes(raw.replace(b'Message-ID: <', b'Message-ID: <plain'))
+            )
+
+        compressed = Mail.objects.get(pk=compressed.pk)
+        assert_that(compressed.eml.name, ends_with('.eml.gz'))
+        with compressed.eml.open('rb'):
+            assert_that(gzip.decompress(compressed.eml.read()), equal_to(raw))
+        assert_that(compressed.get_email_object()['Subject'], equal_to('Message Without Attachment'))
+
+        plain = Mail.objects.get(pk=plain.pk)
+        assert_that(plain.eml.name, ends_with('.eml'))
+        assert_that(plain.get_email_object()['Subject'], equal_to('Message Without Attachment'))
+
+    @override_settings(
+        DJANGO_MAILBOX_STORE_ORIGINAL_MESSAGE=True, DJANGO_MAILBOX_COMPRESS_ORIGINAL_MESSAGE=True,
+    )
+    def test_original_archived_from_spooled_file(self):
+        raw = self.maildir.create_mail('Original', 'original@mail.com').encode()
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(raw)
+
+        prepared = prepare_raw_message(RawMessageFile(path), utils.get_settings())
+        original_path = prepared.original_path
+        assert_that(os.path.exists(path), equal_to(False))
+        assert_that(prepared.original, none())
+
+        mail, = self.mailbox.process_prepared_messages([prepared])
+
+        assert_that(os.path.exists(original_path), equal_to(False))
+        mail = Mail.objects.get(pk=mail.pk)
+        assert_that(mail.eml.name, ends_with('.eml.gz'))
+        with mail.eml.open('rb'):
+            assert_that(gzip.decompress(mail.eml.read()), equal_to(raw))
+
+    @override_settings(DJANGO_MAILBOX_STORE_ORIGINAL_MESSAGE=True, DJANGO_MAILBOX_SINGLE_COPY_ORIGINAL_MESSAGE=True)
+    def test_single_copy_of_original(self):
+        content = self.maildir.create_mail(
+            'Attached', 'attached@mail.com', 'message_with_attachment_template.eml'
+        )
+        mail = Mail.objects.get(pk=self.mailbox.process_incoming_message(self.parse(content)).pk)
+
+        assert_that(mail.body, equal_to(''))
+        assert_that(mail.body_data, none())
+        assert_that(mail.eml.name, ends_with('.eml'))
+        assert_that(mail.get_email_object().get_payload()[1].get_filename(), equal_to('heart.png'))
+        assert_that(Attachment.objects.get(message=mail).get_filename(), equal_to('heart.png'))
+
+        with override_settings(DJANGO_MAILBOX_SINGLE_COPY_ORIGINAL_MESSAGE=False):
+            stored = self.mailbox.process_incoming_message(self.parse(content, '<stored@mail.com>'))
+        draft = Mail.objects.create(mailbox=self.mailbox, body='<p>Draft</p>')
+        assert_that(stored.body_data, not_none())
+
+        assert_that(strip_mail_bodies(10), equal_to((1, stored.pk)))
+        stored = Mail.objects.get(pk=stored.pk)
+        assert_that(stored.body_data, none())
+        assert_that(stored.get_email_object().get_payload()[1].get_filename(), equal_to('heart.png'))
+        draft.refresh_from_db()
+        assert_that(draft.body, equal_to('<p>Draft</p>'))
+
+    def test_old_bodies_archived(self):
+        content = self.maildir.create_mail('Old', 'old@mail.com')
+        old = self.mailbox.process_incoming_message(self.parse(content, '<old@mail.com>'))
+        legacy = Mail.objects.create(
+            mailbox=self.mailbox, encoded=True,
+            body=base64.b64encode(content.encode()).decode('ascii')
+        )
+        recent = self.mailbox.process_incoming_message(self.parse(content, '<recent@mail.com>'))
+        sent = Mail.objects.create(mailbox=self.mailbox, outgoing=True, subject='Sent', body='<p>Sent</p>')
+        draft = Mail.objects.create(mailbox=self.mailbox, draft=True, body='<p>Draft</p>')
+        Mail.objects.filter(
+            pk__in=[old.pk, legacy.pk, sent.pk, draft.pk]
+        ).update(date=now() - timedelta(days=400))
+        recent.date = now()
+        recent.save()
+        body = Mail.objects.get(pk=old.pk).get_body()
+
+        assert_that(archive_mail_bodies(timedelta(days=365), 10), equal_to((2, legacy.pk)))
+        assert_that(archive_mail_bodies(timedelta(days=365), 10, after=legacy.pk), equal_to((0, legacy.pk)))
+
+        old = Mail.objects.get(pk=old.pk)
+        assert_that(old.body_data, none())
+        assert_that(old.cold_body.name, starts_with('mailbox_cold_bodies/'))
+        assert_that(old.get_body(), equal_to(body))
+        assert_that(old.get_email_object()['Subject'], equal_to('Message Without Attachment'))
+        assert_that(Mail.objects.get(pk=legacy.pk).get_body(), equal_to(content.encode()))
+        assert_that(Mail.objects.get(pk=recent.pk).body_data, not_none())
+        assert_that(Mail.objects.get(pk=draft.pk).body, equal_to('<p>Draft</p>'))
+
+        # A sent mail keeps the message it was sent as
+        resaved = Mail.objects.get(pk=sent.pk)
+        resaved.save()
+        assert_that(resaved.message_id, equal_to(sent.message_id))
+        assert_that(resaved.get_body(), equal_to(sent.get_body()))
+
+        # Read again from the cache
+        os.remove(old.cold_body.path)
+        assert_that(Mail.objects.get(pk=old.pk).get_body(), equal_to(body))
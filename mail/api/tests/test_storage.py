@@ -0,0 +1,105 @@
+import io
+import os
+import tempfile
+
+from unittest import mock
+
+from django.core.files.base import ContentFile
+from django.test import testcases, override_settings
+from hamcrest import *
+
+import mail.api.storage as storage
+
+
+def response(status_code, data=None, content=b''):
+    return mock.MagicMock(
+        status_code=status_code, json=mock.Mock(return_value=data), raw=io.BytesIO(content)
+    )
+
+
+@override_settings(
+    DEFAULT_FILE_STORAGE_HOST='http://files/', MEDIA_ROOT=tempfile.mkdtemp(),
+    DJANGO_MAILBOX_FILE_CACHE_MEMORY_SIZE=1024, DJANGO_MAILBOX_FILE_CACHE_MEMORY_MAX_FILE=4,
+)
+class TroodFileStorageTestCase(testcases.SimpleTestCase):
+
+    def setUp(self):
+        storage._metadata = None
+        storage._file_cache = None
+        storage._token = None
+        self.session = mock.Mock()
+        session_patch = mock.patch.object(storage, 'get_http_session', return_value=self.session)
+        token_patch = mock.patch.object(storage, 'get_service_token', return_value='Service token')
+        session_patch.start()
+        self.get_service_token = token_patch.start()
+        self.addCleanup(session_patch.stop)
+        self.addCleanup(token_patch.stop)
+        self.storage = storage.TroodFileStorage()
+
+    def test_save_uploads_in_one_request(self):
+        meta = {'id': 'abc', 'filename': 'heart.png', 'file_url': '//files/heart.png'}
+        self.session.post.return_value = response(201, meta)
+
+        assert_that(self.storage.save('heart.png', ContentFile(b'data')), equal_to('abc'))
+        assert_that(self.session.post.call_count, equal_to(1))
+        self.session.get.assert_not_called()
+
+        # The uploaded file's metadata is cached, and its contents are
+        # only fetched when read
+        assert_that(self.storage.open('abc').meta, equal_to(meta))
+        self.session.get.assert_not_called()
+        assert_that(self.get_service_token.call_count, equal_to(1))
+
+    def test_contents_read_through_cache(self):
+        meta = {'id': 'abc', 'filename': 'report.pdf', 'file_url': '//files/report.pdf'}
+        self.session.get.side_effect = [response(200, meta), response(200, content=b'report')]
+
+        assert_that(self.storage.open('abc').read(), equal_to(b'report'))
+        assert_that(self.storage.open('abc').read(), equal_to(b'report'))
+        assert_that(self.session.get.call_count, equal_to(2))
+
+        path = storage.get_file_cache()._get_path('abc')
+        with open(path, 'rb') as fp:
+            assert_that(fp.read(), equal_to(b'report'))
+        assert_that(os.listdir(os.path.dirname(path)), equal_to([os.path.basename(path)]))
+
+    def test_small_contents_kept_in_memory(self):
+        cache = storage.get_file_cache()
+        assert_that(cache.fill('small', io.BytesIO(b'tiny')).read(), equal_to(b'tiny'))
+        os.remove(cache._get_path('small'))
+
+        assert_that(cache.get('small').read(), equal_to(b'tiny'))
+        assert_that(cache.get('missing'), none())
+
+    def test_file_cache_evicts_least_recently_read(self):
+        cache = storage.FileCache(tempfile.mkdtemp(), max_size=10)
+        for name, mtime in (('a', 1), ('b', 2)):
+            cache.fill(name, io.BytesIO(b'1234')).close()
+            os.utime(cache._get_path(name), (mtime, mtime))
+        cache.get('a').close()
+        cache.fill('c', io.BytesIO(b'1234')).close()
+
+        assert_that(os.path.exists(cache._get_path('b')), equal_to(False))
+        assert_that(os.path.exists(cache._get_path('a')), equal_to(True))
+        assert_that(os.path.exists(cache._get_path('c')), equal_to(True))
+
+    def test_save_existing_file(self):
+        self.session.get.return_value = response(200, {'id': 'abc', 'filename': 'heart.png'})
+
+        assert_that(self.storage.save('abc', self.storage.open('abc')), equal_to('abc'))
+        assert_that(self.storage.exists('abc'), equal_to(True))
+        assert_that(self.session.get.call_count, equal_to(1))
+        self.session.post.assert_not_called()
+
+    @override_settings(DJANGO_MAILBOX_FILE_STORAGE_METADATA_CACHE_SIZE=2)
+    def test_metadata_cache_evicts_least_recently_used(self):
+        storage._metadata = None
+        cache = storage.get_metadata_cache()
+        cache.set('a', {'id': 'a'})
+        cache.set('b', {'id': 'b'})
+        cache.get('a')
+        cache.set('c', {'id': 'c'})
+
+        assert_that(cache.get('b'), none())
+        assert_that(cache.get('a'), equal_to({'id': 'a'}))
+        assert_that(cache.get('c'), equal_to({'id': 'c'}))
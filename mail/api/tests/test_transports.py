@@ -0,0 +1,710 @@
+import os
+import email
+import pickle
+import socket
+import ssl
+import asyncio
+import sys
+import shutil
+import tempfile
+import subprocess
+import imaplib
+import poplib
+import itertools
+import threading
+from datetime import date
+from unittest import mock
+
+from django.test import testcases, override_settings
+from hamcrest import *
+
+from mail.api.transports import ImapTransport, Pop3Transport, MaildirTransport, MboxTransport
+from mail.api.transports.aioimap import AsyncImapTransport
+from mail.api.transports.base import RawMessageFile
+from mail.api.transports.gmail import GmailImapTransport, get_gmail_attributes
+from mail.api.transports.imap import compress_uid_set
+from mail.api.transports.pop3 import PipeliningPOP3
+from mail.api.transports.pool import ConnectionPoolError, ImapConnectionPool
+from mail.api.tests.utils import FakeImapServer, FakePop3Server, serve_imap
+
+
+class ImapIncrementalSyncTestCase(testcases.SimpleTestCase):
+    def setUp(self):
+        self.server = FakeImapServer(uidvalidity=7, messages={
+            3: b'Subject: third\r\n\r\nbody',
+            5: b'Subject: fifth\r\n\r\nbody',
+        })
+        self.transport = ImapTransport('localhost', archive=None)
+
+    def connect(self):
+        with mock.patch.object(self.transport, 'transport', return_value=self.server):
+            self.transport.connect('user', 'password')
+
+    def poll(self, condition):
+        messages = list(self.transport.get_message(condition))
+        self.transport.commit()
+        return messages
+
+    def test_first_poll_does_full_sync(self):
+        self.connect()
+
+        messages = self.poll('UNSEEN')
+
+        assert_that(messages, has_length(2))
+        assert_that(self.server.searches, equal_to([('UNSEEN', )]))
+        assert_that(self.transport.sync_state, equal_to({'uidvalidity': 7, 'last_uid': 5}))
+
+    def test_poll_asks_only_for_new_uids(self):
+        self.transport.sync_state = {'uidvalidity': 7, 'last_uid': 3}
+        self.connect()
+
+        messages = self.poll('UNSEEN')
+
+        assert_that([m['subject'] for m in messages], equal_to(['fifth']))
+        assert_that(self.server.searches, equal_to([('UID', '4:*')]))
+        assert_that(self.transport.sync_state['last_uid'], equal_to(5))
+
+    def test_poll_without_new_uids_skips_search(self):
+        self.transport.sync_state = {'uidvalidity': 7, 'last_uid': 5}
+        self.connect()
+
+        messages = self.poll('UNSEEN')
+
+        assert_that(messages, empty())
+        assert_that(self.server.searches, empty())
+
+    def test_uidvalidity_change_does_full_resync(self):
+        self.transport.sync_state = {'uidvalidity': 6, 'last_uid': 100}
+        self.connect()
+
+        messages = self.poll('UNSEEN')
+
+        assert_that(messages, has_length(2))
+        assert_that(self.server.searches, equal_to([('UNSEEN', )]))
+        assert_that(self.transport.sync_state, equal_to({'uidvalidity': 7, 'last_uid': 5}))
+
+    def test_poll_fetches_new_mail_read_elsewhere(self):
+        self.transport.sync_state = {'uidvalidity': 7, 'last_uid': 3}
+        self.server.seen.add(5)
+        self.connect()
+
+        messages = self.poll('UNSEEN')
+
+        assert_that([m['subject'] for m in messages], equal_to(['fifth']))
+        assert_that(self.transport.sync_state['last_uid'], equal_to(5))
+
+    def test_date_cutoff_sent_to_server(self):
+        self.transport.since = date(2018, 3, 5)
+        self.connect()
+
+        self.poll('UNSEEN')
+
+        assert_that(self.server.searches, equal_to([('UNSEEN', 'SINCE', '5-Mar-2018')]))
+
+
+class ImapBatchedFetchTestCase(testcases.SimpleTestCase):
+    def setUp(self):
+        self.server = FakeImapServer(messages={
+            uid: b'Subject: %d\r\n\r\nbody' % uid for uid in (1, 2, 3, 7, 8)
+        })
+        self.transport = ImapTransport('localhost', archive='processed')
+        self.transport.fetch_chunk_size = 3
+        self.transport.server = self.server
+
+    def test_compress_uid_set(self):
+        assert_that(compress_uid_set(['9', '1', '2', '3', '7', '10']), equal_to('1:3,7,9:10'))
+
+    def test_messages_fetched_in_chunks(self):
+        messages = list(self.transport.get_message('ALL'))
+
+        assert_that([m['subject'] for m in messages], equal_to(['1', '2', '3', '7', '8']))
+
+        fetches = [c for c in self.server.commands if c[0] == 'fetch']
+        assert_that(fetches, equal_to([
+            ('fetch', '1:3', '(UID BODY.PEEK[]<0.1048576>)'),
+            ('fetch', '7:8', '(UID BODY.PEEK[]<0.1048576>)'),
+        ]))
+
+    def test_large_messages_spooled_in_pieces(self):
+        self.server.messages[2] = b'Subject: 2\r\n\r\n' + b'large body ' * 3
+        self.transport.message_spool_size = 32
+
+        contents = list(self.transport.get_raw_message('ALL'))
+
+        assert_that(contents[0], equal_to(self.server.messages[1]))
+        assert_that(contents[1], instance_of(RawMessageFile))
+        with contents[1].open() as fp:
+            assert_that(fp.read(), equal_to(self.server.messages[2]))
+        contents[1].discard()
+        assert_that(os.path.exists(contents[1].path), equal_to(False))
+
+        fetches = [c[1:] for c in self.server.commands if c[0] == 'fetch']
+        assert_that(fetches, equal_to([
+            ('1:3', '(UID BODY.PEEK[]<0.32>)'),
+            ('2', '(UID BODY.PEEK[]<32.32>)'),
+            ('7:8', '(UID BODY.PEEK[]<0.32>)'),
+        ]))
+
+    def test_copy_and_store_coalesced_per_commit(self):
+        messages = self.transport.get_message('ALL')
+        list(itertools.islice(messages, 2))
+        self.transport.commit()
+        list(messages)
+        self.transport.commit()
+
+        flags = [c for c in self.server.commands if c[0] in ('copy', 'store')]
+        assert_that(flags, equal_to([
+            ('copy', '1:2', 'processed'),
+            ('store', '1:2', '+FLAGS', '(\\Seen)'),
+            ('copy', '3,7:8', 'processed'),
+            ('store', '3,7:8', '+FLAGS', '(\\Seen)'),
+        ]))
+        assert_that(self.transport.sync_state['last_uid'], equal_to(8))
+
+    def test_nothing_flagged_before_commit(self):
+        list(self.transport.get_message('ALL'))
+
+        commands = [c[0] for c in self.server.commands]
+        assert_that(commands, not_(has_item('store')))
+        assert_that(commands, not_(has_item('copy')))
+        assert_that(self.transport.sync_state.get('last_uid'), none())
+
+
+class ImapIdleTestCase(testcases.SimpleTestCase):
+    def setUp(self):
+        self.client_sock, self.server_sock = socket.socketpair()
+        self.server = FakeImapServer()
+        self.server.sock = self.client_sock
+        self.server.send = self.client_sock.sendall
+        self.server._new_tag = lambda: b'A001'
+        self.transport = ImapTransport('localhost')
+        self.transport.server = self.server
+
+    def tearDown(self):
+        self.client_sock.close()
+        self.server_sock.close()
+
+    def test_idle_returns_on_exists(self):
+        self.server_sock.sendall(b'+ idling\r\n* 4 EXISTS\r\nA001 OK IDLE terminated\r\n')
+
+        assert_that(self.transport.idle(timeout=5), is_(True))
+        assert_that(self.server_sock.recv(1024), equal_to(b'A001 IDLE\r\nDONE\r\n'))
+
+    def test_idle_times_out(self):
+        self.server_sock.sendall(b'+ idling\r\n* 2 EXPUNGE\r\n')
+        threading.Timer(0.3, self.server_sock.sendall, [b'A001 OK IDLE terminated\r\n']).start()
+
+        assert_that(self.transport.idle(timeout=0.1), is_(False))
+
+    def test_idle_rejected(self):
+        self.server_sock.sendall(b'A001 BAD unknown command\r\n')
+
+        with self.assertRaises(imaplib.IMAP4.abort):
+            self.transport.idle(timeout=0.1)
+
+
+class ImapConnectionPoolTestCase(testcases.SimpleTestCase):
+    def setUp(self):
+        self.pool = ImapConnectionPool(max_per_host=2, max_idle=60, keepalive_interval=10, timeout=0)
+        self.servers = []
+
+    def connect(self):
+        transport = ImapTransport('localhost', archive=None)
+        transport.server = FakeImapServer()
+        self.servers.append(transport.server)
+        return transport
+
+    def test_session_reused_after_check(self):
+        first = self.pool.acquire('imap://a@localhost', 'localhost', self.connect)
+        self.pool.release('imap://a@localhost', first)
+        second = self.pool.acquire('imap://a@localhost', 'localhost', self.connect)
+
+        assert_that(second, same_instance(first))
+        assert_that(self.servers, has_length(1))
+
+    def test_dropped_session_replaced(self):
+        first = self.pool.acquire('imap://a@localhost', 'localhost', self.connect)
+        self.pool.release('imap://a@localhost', first)
+        first.server.alive = False
+
+        second = self.pool.acquire('imap://a@localhost', 'localhost', self.connect)
+        assert_that(second, is_not(same_instance(first)))
+        assert_that(self.pool._open, equal_to({'localhost': 1}))
+
+    def test_sessions_capped_per_host(self):
+        a = self.pool.acquire('imap://a@localhost', 'localhost', self.connect)
+        b = self.pool.acquire('imap://b@localhost', 'localhost', self.connect)
+        with self.assertRaises(ConnectionPoolError):
+            self.pool.acquire('imap://c@localhost', 'localhost', self.connect)
+        self.pool.acquire('imap://c@other', 'other', self.connect)
+
+        # An idle session of another mailbox makes room
+        self.pool.release('imap://a@localhost', a)
+        self.pool.acquire('imap://c@localhost', 'localhost', self.connect)
+        assert_that(a.server.logged_out, is_(True))
+        assert_that(self.pool._open, equal_to({'localhost': 2, 'other': 1}))
+
+    def test_idle_sessions_kept_alive(self):
+        kept = self.pool.acquire('imap://a@localhost', 'localhost', self.connect)
+        expired = self.pool.acquire('imap://b@localhost', 'localhost', self.connect)
+        self.pool.release('imap://a@localhost', kept)
+        self.pool.release('imap://b@localhost', expired)
+
+        with mock.patch('time.monotonic', return_value=self.pool._idle['imap://a@localhost'][0][1] + 30):
+            self.pool._idle['imap://b@localhost'][0] = (expired, 0, 0)
+            self.pool.keepalive()
+
+        assert_that(kept.server.logged_out, is_(False))
+        assert_that(expired.server.logged_out, is_(True))
+        assert_that(self.pool._open, equal_to({'localhost': 1}))
+
+    def test_close_logs_out(self):
+        transport = self.pool.acquire('imap://a@localhost', 'localhost', self.connect)
+        self.pool.release('imap://a@localhost', transport)
+        self.pool.close()
+
+        assert_that(transport.server.logged_out, is_(True))
+        with self.assertRaises(ConnectionPoolError):
+            self.pool.acquire('imap://a@localhost', 'localhost', self.connect)
+
+
+class GmailAttributesTestCase(testcases.SimpleTestCase):
+    def test_attributes_fetched_with_body(self):
+        server = FakeImapServer(messages={3: b'Subject: third\r\n\r\nbody'})
+        transport = GmailImapTransport('localhost', archive=None)
+        with mock.patch.object(transport, 'transport', return_value=server):
+            transport.connect('user', 'password')
+        response = b'3 (X-GM-THRID 1278455344230334865 X-GM-MSGID 1278455344230334866 ' \
+                   b'X-GM-LABELS (\\Inbox "Side \\"projects\\"" &BCEEPwQ4BEEEPgQ6-) UID 3 BODY[] {29}'
+
+        with mock.patch.object(server, 'uid', return_value=('OK', [(response, server.messages[3]), b')'])):
+            (uid, contents), = transport._fetch_chunk(['3'])
+
+        attributes = ('1278455344230334866', '1278455344230334865', ['\\Inbox', 'Side "projects"', 'Список'])
+        assert_that(contents, equal_to(server.messages[3]))
+        assert_that(get_gmail_attributes(transport.get_email_from_bytes(contents)), equal_to(attributes))
+        assert_that(get_gmail_attributes(pickle.loads(pickle.dumps(contents))), equal_to(attributes))
+
+    def test_attribute_headers_ignored(self):
+        message = email.message_from_bytes(b'X-GM-MSGID: 1\r\nX-GM-THRID: 2\r\n\r\nbody')
+
+        assert_that(get_gmail_attributes(message), equal_to((None, None, [])))
+
+
+class AsyncImapTransportTestCase(testcases.SimpleTestCase):
+    def setUp(self):
+        self.server = FakeImapServer(uidvalidity=7, messages={
+            3: b'Subject: third\r\n\r\nbody',
+            5: b'Subject: fifth\r\n\r\nbody',
+        })
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def poll(self, sync_state=None, ssl_context=None, **options):
+        async def run():
+            listener = await asyncio.start_server(serve_imap(self.server, ssl_context), '127.0.0.1', 0)
+            transport = AsyncImapTransport(
+                '127.0.0.1', port=listener.sockets[0].getsockname()[1],
+                archive=None, sync_state=sync_state, **options
+            )
+            await transport.connect('user', 'password')
+            subjects = [message['subject'] async for message in transport.get_message('UNSEEN')]
+            await transport.commit()
+            await transport.close()
+            listener.close()
+            await listener.wait_closed()
+            return subjects, transport.sync_state
+        return self.loop.run_until_complete(run())
+
+    @override_settings(DJANGO_MAILBOX_IMAP_TIMEOUT=0.2)
+    def test_unresponsive_server_times_out(self):
+        async def stall(reader, writer):
+            writer.write(b'* OK IMAP4rev1 ready\r\n')
+            # Never answers, until the client hangs up
+            await reader.read()
+            writer.close()
+
+        async def run():
+            listener = await asyncio.start_server(stall, '127.0.0.1', 0)
+            transport = AsyncImapTransport(
+                '127.0.0.1', port=listener.sockets[0].getsockname()[1], archive=None,
+            )
+            try:
+                await transport.connect('user', 'password')
+            finally:
+                transport.server.writer.close()
+                listener.close()
+                await listener.wait_closed()
+
+        assert_that(
+            calling(self.loop.run_until_complete).with_args(run()),
+            raises(imaplib.IMAP4.abort, 'timed out')
+        )
+
+    def test_starttls(self):
+        openssl = shutil.which('openssl')
+        if openssl is None:
+            self.skipTest('openssl is needed to make a certificate')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+        subprocess.run([
+            openssl, 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-keyout', key, '-out', cert, '-subj', '/CN=localhost',
+            '-addext', 'subjectAltName=IP:127.0.0.1',
+        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(cert, key)
+        client_context = ssl.create_default_context(cafile=cert)
+
+        with mock.patch('ssl.create_default_context', return_value=client_context):
+            subjects, state = self.poll(ssl_context=server_context, tls=True)
+
+        assert_that(subjects, equal_to(['third', 'fifth']))
+        assert_that(self.server.commands[0], equal_to(('starttls', )))
+        assert_that(self.server.logged_out, is_(True))
+
+    def test_messages_fetched_and_flagged(self):
+        subjects, state = self.poll()
+
+        assert_that(subjects, equal_to(['third', 'fifth']))
+        assert_that(state, equal_to({'uidvalidity': 7, 'last_uid': 5}))
+        assert_that(self.server.commands, has_item(('store', '3,5', '+FLAGS', '(\\Seen)')))
+        assert_that(self.server.logged_out, is_(True))
+
+    def test_poll_asks_only_for_new_uids(self):
+        self.server.messages[8] = b'Subject: eighth\r\n\r\nbody'
+
+        subjects, state = self.poll({'uidvalidity': 7, 'last_uid': 5})
+
+        assert_that(subjects, equal_to(['eighth']))
+        assert_that(self.server.searches, equal_to([('UID', '6:*')]))
+        assert_that(state, equal_to({'uidvalidity': 7, 'last_uid': 8}))
+
+
+class Pop3TransportTestCase(testcases.SimpleTestCase):
+    def setUp(self):
+        self.server = FakePop3Server({
+            'a': b'Subject: old\r\n\r\nbody',
+            'b': b'Subject: new\r\n\r\nbody',
+            'c': b'Subject: new\r\n\r\nbody',
+        })
+        self.transport = Pop3Transport('localhost')
+        self.transport.server = self.server
+
+    def condition(self, message):
+        return message['subject'] != 'old'
+
+    def fetch(self, condition=None):
+        messages = list(self.transport.get_message(condition))
+        self.transport.commit()
+        return messages
+
+    def test_rejected_message_not_downloaded(self):
+        messages = self.fetch(self.condition)
+
+        assert_that(messages, has_length(2))
+        assert_that(self.server.sent, has_items('TOP 1 0', 'RETR 2', 'RETR 3'))
+        assert_that(self.server.sent, not_(has_item('RETR 1')))
+        assert_that(self.server.deleted, equal_to([2, 3]))
+
+    def test_seen_uidls_skipped(self):
+        self.transport.sync_state = {'uidls': ['a', 'b', 'gone']}
+
+        messages = self.fetch(self.condition)
+
+        assert_that(messages, has_length(1))
+        assert_that(self.server.sent, equal_to(['TOP 3 0', 'RETR 3', 'DELE 3']))
+        assert_that(self.transport.sync_state, equal_to({'uidls': ['a', 'b', 'c']}))
+
+    def test_old_message_rejected_by_headers(self):
+        self.server.messages[1] = ('b', b'Date: Sun, 20 Jan 2013 11:53:53 -0800\r\n\r\nbody')
+        self.transport.since = date(2018, 1, 1)
+
+        messages = self.fetch()
+
+        assert_that(messages, has_length(2))
+        assert_that(self.server.sent, not_(has_item('RETR 2')))
+
+    def test_nothing_deleted_before_commit(self):
+        messages = list(self.transport.get_message())
+
+        assert_that(messages, has_length(3))
+        assert_that(self.server.deleted, empty())
+        assert_that(self.transport.sync_state, empty())
+
+        self.transport.commit()
+        assert_that(self.server.deleted, equal_to([1, 2, 3]))
+        assert_that(self.transport.sync_state, equal_to({'uidls': ['a', 'b', 'c']}))
+
+    def test_large_message_spooled(self):
+        self.server.messages[1] = ('b', b'Subject: new\r\n\r\n' + b'large body\r\n' * 3)
+        self.transport.message_spool_size = 32
+
+        contents = list(self.transport.get_raw_message())
+
+        assert_that(contents[0], equal_to(self.server.messages[0][1]))
+        with contents[1].open() as fp:
+            assert_that(fp.read(), equal_to(self.server.messages[1][1]))
+        contents[1].discard()
+
+    def test_commands_pipelined(self):
+        self.transport.pipelining = True
+
+        self.fetch()
+
+        assert_that(self.server.log, equal_to(
+            ['send'] * 3 + ['read'] * 3 + ['send'] * 3 + ['read'] * 3
+        ))
+
+    def test_commands_not_pipelined_without_capability(self):
+        self.fetch()
+
+        assert_that(self.server.log, equal_to(['send', 'read'] * 6))
+
+
+class PipeliningPop3TestCase(testcases.SimpleTestCase):
+    def setUp(self):
+        self.client_sock, self.server_sock = socket.socketpair()
+        self.addCleanup(self.client_sock.close)
+        self.addCleanup(self.server_sock.close)
+        self.client = PipeliningPOP3.__new__(PipeliningPOP3)
+        self.client.sock = self.client_sock
+        self.client.file = self.client_sock.makefile('rb')
+
+    def test_responses_read_after_all_commands_sent(self):
+        self.client.send_command('RETR 1')
+        self.client.send_command('DELE 1')
+        self.client.send_command('DELE 2')
+        assert_that(self.server_sock.recv(1024), equal_to(b'RETR 1\r\nDELE 1\r\nDELE 2\r\n'))
+
+        self.server_sock.sendall(
+            b'+OK 23 octets\r\nSubject: a\r\n\r\n..dotted\r\n.\r\n'
+            b'+OK deleted\r\n-ERR no such message\r\n'
+        )
+        assert_that(self.client.read_long_response(), equal_to(
+            (b'+OK 23 octets', [b'Subject: a', b'', b'.dotted'], 23)
+        ))
+        assert_that(self.client.read_response(), equal_to(b'+OK deleted'))
+        assert_that(calling(self.client.read_response), raises(poplib.error_proto))
+
+
+class MaildirDateCutoffTestCase(testcases.SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for subdir in ('new', 'cur', 'tmp'):
+            os.mkdir(os.path.join(self.path, subdir))
+        self.transport = MaildirTransport(self.path, since=date(2018, 1, 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def deliver(self, name, sent, mtime=None):
+        path = os.path.join(self.path, 'new', name)
+        with open(path, 'wb') as f:
+            f.write(b'Date: %s\r\nSubject: %s\r\n\r\nbody' % (sent, name.encode()))
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_old_messages_skipped(self):
+        old_header = self.deliver('old-header', b'Sun, 20 Jan 2013 11:53:53 -0800')
+        # 2013-01-20, the Date header alone would let it through
+        old_file = self.deliver('old-file', b'Mon, 20 Jan 2020 11:53:53 -0800', mtime=1358711633)
+        self.deliver('new', b'Mon, 20 Jan 2020 11:53:53 -0800')
+
+        messages = list(self.transport.get_message())
+
+        assert_that([m['subject'] for m in messages], equal_to(['new']))
+        assert_that(os.path.exists(old_header), is_(True))
+        assert_that(os.path.exists(old_file), is_(True))
+
+
+class MaildirClaimTestCase(testcases.SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for subdir in ('new', 'cur', 'tmp'):
+            os.mkdir(os.path.join(self.path, subdir))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def deliver(self, name, directory='new'):
+        path = os.path.join(self.path, directory, name)
+        with open(path, 'wb') as f:
+            f.write(b'Subject: %s\r\n\r\nbody' % name.encode())
+        return path
+
+    def listdir(self, *path):
+        return sorted(os.listdir(os.path.join(self.path, *path)))
+
+    def test_workers_drain_maildir_together(self):
+        names = ['message%d' % i for i in range(10)]
+        for name in names:
+            self.deliver(name)
+        workers = [MaildirTransport(self.path), MaildirTransport(self.path)]
+        generators = dict((worker, worker.get_message()) for worker in workers)
+
+        subjects = []
+        while generators:
+            for worker, generator in list(generators.items()):
+                try:
+                    subjects.append(next(generator)['subject'])
+                except StopIteration:
+                    worker.commit()
+                    worker.close()
+                    del generators[worker]
+
+        assert_that(sorted(subjects), equal_to(names))
+        assert_that(self.listdir('new'), empty())
+        assert_that(self.listdir('tmp'), empty())
+
+    def test_unprocessed_messages_released(self):
+        for name in ('first', 'rejected', 'third'):
+            self.deliver(name)
+        transport = MaildirTransport(self.path)
+
+        messages = transport.get_message(lambda message: message['subject'] != 'rejected')
+        next(messages)
+        transport.commit()
+        next(messages)
+        # Only committed messages count as processed
+        messages.close()
+        transport.close()
+
+        assert_that(self.listdir('new'), has_length(2))
+        assert_that(self.listdir('new'), has_item('rejected'))
+        assert_that(self.listdir('tmp'), empty())
+
+    def test_seen_messages_drained(self):
+        self.deliver('unseen')
+        self.deliver('seen:2,S', directory='cur')
+        transport = MaildirTransport(self.path)
+
+        messages = transport.get_message(lambda message: message['subject'] != 'unseen')
+        assert_that([m['subject'] for m in messages], equal_to(['seen:2,S']))
+        transport.commit()
+        transport.close()
+
+        # Rejected messages go back to the directory they were claimed from
+        assert_that(self.listdir('new'), equal_to(['unseen']))
+        assert_that(self.listdir('cur'), empty())
+        assert_that(self.listdir('tmp'), empty())
+
+    def test_stale_claims_recovered(self):
+        claim_path = os.path.join(self.path, 'tmp', 'claimed-crashed')
+        for directory in ('new', 'cur'):
+            os.makedirs(os.path.join(claim_path, directory))
+            self.deliver(os.path.join('claimed-crashed', directory, 'orphan'), directory='tmp')
+            os.utime(os.path.join(claim_path, directory), (0, 0))
+        os.utime(claim_path, (0, 0))
+
+        transport = MaildirTransport(self.path)
+        messages = list(transport.get_message())
+        transport.commit()
+        transport.close()
+
+        assert_that([m['subject'] for m in messages], equal_to([
+            'claimed-crashed/new/orphan', 'claimed-crashed/cur/orphan'
+        ]))
+        assert_that(self.listdir('tmp'), empty())
+
+    def test_active_claims_kept(self):
+        self.deliver('claimed')
+        worker = MaildirTransport(self.path)
+        next(worker.get_message())
+        os.utime(worker.claim_path, (0, 0))
+
+        assert_that(list(MaildirTransport(self.path).get_message()), empty())
+        assert_that(os.listdir(os.path.join(worker.claim_path, 'new')), equal_to(['claimed']))
+
+
+class MboxCheckpointTestCase(testcases.SimpleTestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.append('first', 'second', 'third')
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def append(self, *subjects):
+        with open(self.path, 'ab') as f:
+            for subject in subjects:
+                f.write(
+                    b'From sender@mail.com Sat Jan  3 01:05:34 2015\n'
+                    b'Subject: %s\n\nThe body\n>From escaped\n\n' % subject.encode()
+                )
+
+    def read(self, sync_state=None):
+        transport = MboxTransport(self.path, sync_state=sync_state)
+        subjects = [message['subject'] for message in transport.get_message()]
+        transport.commit()
+        return subjects, transport.sync_state
+
+    def test_interrupted_import_resumes(self):
+        with open(self.path, 'rb') as f:
+            original = f.read()
+
+        transport = MboxTransport(self.path)
+        messages = transport.get_message()
+        assert_that(next(messages)['subject'], equal_to('first'))
+        transport.commit()
+        assert_that(next(messages)['subject'], equal_to('second'))
+        messages.close()
+        state = transport.sync_state
+
+        # The uncommitted second message is read again
+        subjects, state = self.read(state)
+        assert_that(subjects, equal_to(['second', 'third']))
+
+        with open(self.path, 'rb') as f:
+            assert_that(f.read(), equal_to(original))
+
+        self.append('fourth')
+        assert_that(self.read(state)[0], equal_to(['fourth']))
+
+    def test_message_parsed_without_envelope(self):
+        transport = MboxTransport(self.path)
+        message = next(transport.get_message())
+
+        assert_that(message.get_unixfrom(), none())
+        assert_that(message.get_payload(), starts_with('The body'))
+
+    def test_message_being_delivered_not_cut_off(self):
+        state = self.read()[1]
+        # A delivery appends the headers, then the body, under the lock
+        delivery = subprocess.Popen([sys.executable, '-c', (
+            'import fcntl, sys\n'
+            'with open(sys.argv[1], "ab") as f:\n'
+            '    fcntl.lockf(f, fcntl.LOCK_EX)\n'
+            '    f.write(b"From sender@mail.com Sat Jan  3 01:05:34 2015\\nSubject: fourth\\n\\n")\n'
+            '    f.flush()\n'
+            '    print("locked", flush=True)\n'
+            '    sys.stdin.readline()\n'
+            '    f.write(b"The body\\n\\n")\n'
+        ), self.path], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.addCleanup(delivery.wait)
+        self.addCleanup(delivery.kill)
+        assert_that(delivery.stdout.readline(), equal_to(b'locked\n'))
+
+        transport = MboxTransport(self.path, sync_state=state)
+        messages = []
+        reader = threading.Thread(target=lambda: messages.extend(transport.get_message()))
+        reader.start()
+        reader.join(0.2)
+        assert_that(reader.is_alive(), equal_to(True))
+
+        delivery.communicate(b'\n')
+        reader.join()
+        assert_that([m.get_payload() for m in messages], equal_to(['The body\n\n']))
+
+    def test_replaced_file_read_again(self):
+        subjects, state = self.read()
+        with open(self.path, 'wb'):
+            pass
+        self.append('replaced')
+
+        assert_that(self.read(state)[0], equal_to(['replaced']))
@@ -0,0 +1,84 @@
+import io
+import base64
+import os
+
+from unittest import mock
+
+from email.mime.application import MIMEApplication
+from email.mime.text import MIMEText
+from email.encoders import encode_quopri
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import testcases, override_settings
+from hamcrest import *
+
+import mail.api.utils as utils
+from mail.api.utils import write_decoded_payload
+
+
+class WriteDecodedPayloadTestCase(testcases.SimpleTestCase):
+    def decode(self, message):
+        fp = io.BytesIO()
+        write_decoded_payload(message, fp)
+        return fp.getvalue()
+
+    def test_base64_payload(self):
+        # Spans several chunks
+        message = MIMEApplication(os.urandom(300 * 1024))
+
+        assert_that(self.decode(message), equal_to(message.get_payload(decode=True)))
+
+    def test_folded_base64_payload(self):
+        data = os.urandom(300 * 1024)
+        encoded = base64.b64encode(data).decode()
+        # Folded at odd widths, with stray characters outside the alphabet
+        lines = [encoded[start:start + 61] for start in range(0, len(encoded), 61)]
+        message = MIMEApplication(b'')
+        message.set_payload('\r\n\t'.join(line + '!' for line in lines))
+
+        # Decoded a chunk at a time, not handed back to the email package
+        with mock.patch.object(message, 'get_payload', wraps=message.get_payload) as get_payload:
+            assert_that(self.decode(message), equal_to(data))
+        assert_that(get_payload.call_args_list, equal_to([mock.call()]))
+
+    def test_quoted_printable_payload(self):
+        message = MIMEApplication(('Café = 1\n' * 10000 + 'tail').encode(), _encoder=encode_quopri)
+
+        assert_that(self.decode(message), equal_to(message.get_payload(decode=True)))
+
+    def test_plain_payload(self):
+        message = MIMEText('plain text')
+
+        assert_that(self.decode(message), equal_to(b'plain text'))
+
+    def test_malformed_base64_payload(self):
+        message = MIMEApplication(b'')
+        message.set_payload('QUJD\nR')
+
+        assert_that(self.decode(message), equal_to(message.get_payload(decode=True)))
+
+
+class BodyCompressionTestCase(testcases.SimpleTestCase):
+    body = b'Subject: Compressed\r\n\r\n' + b'Body line\r\n' * 1000
+
+    def test_zlib(self):
+        data = utils.compress_body(self.body)
+
+        assert_that(len(data), less_than(len(self.body) // 10))
+        assert_that(utils.decompress_body(memoryview(data)), equal_to(self.body))
+
+    @override_settings(DJANGO_MAILBOX_BODY_COMPRESSION=None)
+    def test_uncompressed(self):
+        data = utils.compress_body(self.body)
+
+        assert_that(data, equal_to(utils.BODY_RAW + self.body))
+        assert_that(utils.decompress_body(data), equal_to(self.body))
+
+    @override_settings(DJANGO_MAILBOX_BODY_COMPRESSION='zstd')
+    def test_zstd(self):
+        if utils.zstandard is None:
+            with self.assertRaises(ImproperlyConfigured):
+                utils.compress_body(self.body)
+            return
+
+        assert_that(utils.decompress_body(utils.compress_body(self.body)), equal_to(self.body))
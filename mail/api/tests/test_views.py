@@ -1,19 +1,26 @@
+import time
 from unittest import mock
 
 import pytest
 from datetime import datetime
 
 from django.conf import settings
+from django.test import override_settings
 from hamcrest import *
-from rest_framework.status import HTTP_200_OK, HTTP_201_CREATED, HTTP_400_BAD_REQUEST, HTTP_404_NOT_FOUND
-from rest_framework.test import APITestCase
+from rest_framework.status import HTTP_200_OK, HTTP_201_CREATED, HTTP_202_ACCEPTED, HTTP_400_BAD_REQUEST, \
+    HTTP_404_NOT_FOUND
+from rest_framework.test import APITestCase, APITransactionTestCase
 from rest_framework.test import APIClient
 
-from mail.api.models import Contact, Folder, Mail, Template
+from mail.api.models import Contact, Folder, Mail, Template, FetchJob, MailboxFetch
 
 from mail.api.tests.utils import Maildir, trood_user
 
 
+# Fixture messages are dated 2013
+SKIP_MAILS_BEFORE = datetime.strptime("01-01-2012", "%d-%m-%Y").date()
+
+
 class MailTestMixin:
     def send_fetch_email(self, emails):
         # Send another mail
@@ -130,6 +137,77 @@ class MailboxViewSetTestCase(MailTestMixin, APITestCase):
         self.maildir.delete()
 
 
+@override_settings(SKIP_MAILS_BEFORE=SKIP_MAILS_BEFORE)
+class FetchAllViewSetTestCase(APITransactionTestCase):
+    def setUp(self):
+        self.maildirs = [Maildir(from_email=f'test{i}@mail.com') for i in range(2)]
+        self.client = APIClient()
+        self.client.force_authenticate(user=trood_user)
+
+    def test_fetchall_runs_job_in_background(self):
+        for maildir in self.maildirs:
+            maildir.send_mail(maildir.create_mail('eugene', 'dharmagetic@gmail.com'))
+
+        response = self.client.post('/api/v1.0/mailboxes/fetchall/', format='json')
+
+        assert_that(response.status_code, equal_to(HTTP_202_ACCEPTED))
+        assert_that(response.data['mailboxes'], has_length(2))
+
+        job_url = f'/api/v1.0/fetch-jobs/{response.data["id"]}/'
+        for _ in range(50):
+            response = self.client.get(job_url, format='json')
+            if response.data['finished']:
+                break
+            time.sleep(0.1)
+
+        assert_that(response.data['finished'], not_none())
+        assert_that(response.data['mails_received'], equal_to(2))
+        assert_that(response.data['mailboxes'], only_contains(has_entries({
+            'status': 'done',
+            'mails_received': 1,
+            'error': None,
+            'duration': not_none(),
+        })))
+
+    def tearDown(self):
+        for maildir in self.maildirs:
+            maildir.delete()
+
+
+class FetchJobViewSetTestCase(APITestCase):
+    def setUp(self):
+        self.maildir = Maildir()
+        self.client = APIClient()
+        self.client.force_authenticate(user=trood_user)
+
+    def test_jobs_scoped_to_owner(self):
+        own = FetchJob.objects.create(owner=trood_user.id)
+        FetchJob.objects.create(owner=trood_user.id + 1)
+
+        response = self.client.get('/api/v1.0/fetch-jobs/', format='json')
+
+        assert_that(response.data, contains(has_entries({'id': str(own.id)})))
+
+    def test_stale_fetches_failed(self):
+        job = FetchJob.objects.create(owner=trood_user.id)
+        MailboxFetch.objects.create(job=job, mailbox=self.maildir.mailbox)
+
+        with override_settings(MAIL_FETCH_TIMEOUT=3600):
+            response = self.client.get(f'/api/v1.0/fetch-jobs/{job.id}/', format='json')
+        assert_that(response.data['finished'], none())
+
+        with override_settings(MAIL_FETCH_TIMEOUT=0):
+            response = self.client.get(f'/api/v1.0/fetch-jobs/{job.id}/', format='json')
+        assert_that(response.data['finished'], not_none())
+        assert_that(response.data['mailboxes'], contains(has_entries({
+            'mailbox': self.maildir.mailbox.id, 'status': 'failed', 'error': 'Interrupted by a worker restart'
+        })))
+
+    def tearDown(self):
+        self.maildir.delete()
+
+
+@override_settings(SKIP_MAILS_BEFORE=SKIP_MAILS_BEFORE)
 class MailsViewSetTestCase(MailTestMixin, APITestCase):
     def setUp(self):
         self.maildir = Maildir()
@@ -235,6 +313,7 @@ class FolderViewSetTestCase(MailTestMixin, APITestCase):
         self.maildir.delete()
 
 
+@override_settings(SKIP_MAILS_BEFORE=SKIP_MAILS_BEFORE)
 class AssignContactToFolderViewSetTestCase(MailTestMixin, APITestCase):
     def setUp(self):
         self.maildir = Maildir()
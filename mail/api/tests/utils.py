@@ -1,5 +1,8 @@
+import re
 import shutil
 import os
+import asyncio
+import imaplib
 
 import pathlib
 import uuid
@@ -23,7 +26,7 @@ class Maildir:
     """
     Encapsulate local mail dir creation and wirin it with Mailbox entity
     """
-    def __init__(self):
+    def __init__(self, from_email="test@mail.com"):
         # Create temporary dir structure to let maildir protocol work
         self.box_path = os.path.join(os.path.dirname(__file__), f'box{uuid.uuid4()}')
         self.new_path = os.path.join(self.box_path, 'new')
@@ -35,7 +38,7 @@ class Maildir:
 
         # To let maildir protocol works,
         # there are should be new,cur dirs in local mail dir path
-        self.mailbox = Mailbox.objects.create(owner=trood_user.id, uri='maildir://' + self.box_path, from_email="test@mail.com")
+        self.mailbox = Mailbox.objects.create(owner=trood_user.id, uri='maildir://' + self.box_path, from_email=from_email)
 
     def delete(self):
         # Should be invoked explicitly,
@@ -50,7 +53,8 @@ class Maildir:
         template_file = open(template_path)
         src = Template(template_file.read())
         result = src.substitute({'contact_name': contact_name,
-                                 'contact_mail': contact_mail})
+                                 'contact_mail': contact_mail,
+                                 'message_id': uuid.uuid4().hex})
         return result
 
     def send_mail(self, content):
@@ -79,4 +83,199 @@ def create_temp_file(ext='.txt', data=None):
 def create_django_temp_file(ext):
     file, path = create_temp_file(ext)
     django_file = File(open(file.name, "rb"))
-    return django_file
\ No newline at end of file
+    return django_file
+
+class FakeImapServer:
+    """
+    Minimal in-memory stand-in for `imaplib.IMAP4` used by transport tests
+    """
+    def __init__(self, uidvalidity=1, messages=None, seen=None):
+        self.uidvalidity = uidvalidity
+        self.messages = dict(messages or {})
+        self.seen = set(seen or ())
+        self.searches = []
+        self.commands = []
+        self.alive = True
+        self.logged_out = False
+
+    def login(self, username, password):
+        return 'OK', [b'Logged in']
+
+    def noop(self):
+        if not self.alive:
+            raise imaplib.IMAP4.abort('socket error: EOF')
+        return 'OK', [b'NOOP completed']
+
+    def logout(self):
+        self.logged_out = True
+        return 'BYE', [b'Logging out']
+
+    def select(self, mailbox='INBOX'):
+        return 'OK', [str(len(self.messages)).encode()]
+
+    def response(self, code):
+        if code == 'UIDVALIDITY':
+            return code, [str(self.uidvalidity).encode()]
+        if code == 'UIDNEXT':
+            return code, [str(max(self.messages, default=0) + 1).encode()]
+        return code, [None]
+
+    def list(self, pattern=None):
+        return 'OK', [b'(\\HasNoChildren) "/" ' + pattern.encode()]
+
+    def create(self, mailbox):
+        return 'OK', [None]
+
+    def expunge(self):
+        return 'OK', [None]
+
+    def _resolve_uid_set(self, uid_set):
+        uids = set()
+        highest = max(self.messages, default=0)
+        for item in uid_set.split(','):
+            if ':' in item:
+                start, end = item.split(':')
+                start = int(start)
+                end = highest if end == '*' else int(end)
+                # `n:*` always matches the highest UID
+                uids.update(range(min(start, end), max(start, end) + 1))
+            else:
+                uids.add(int(item))
+        return sorted(uid for uid in uids if uid in self.messages)
+
+    def uid(self, command, *args):
+        self.commands.append((command, ) + args)
+        if command == 'search':
+            criteria = args[1:]
+            self.searches.append(criteria)
+            if criteria[0] == 'UID':
+                uids = self._resolve_uid_set(criteria[1])
+            else:
+                uids = sorted(self.messages)
+            if 'UNSEEN' in criteria:
+                uids = [uid for uid in uids if uid not in self.seen]
+            return 'OK', [' '.join(str(uid) for uid in uids).encode()]
+        if command == 'fetch':
+            data = []
+            # BODY.PEEK[]<offset.length> fetches a piece of the message
+            piece = re.search(r'BODY\.PEEK\[\]<(\d+)\.(\d+)>', args[1])
+            for uid in self._resolve_uid_set(args[0]):
+                body = self.messages[uid]
+                section = b'BODY[]'
+                if piece is not None:
+                    offset, length = int(piece.group(1)), int(piece.group(2))
+                    body = body[offset:offset + length]
+                    section = b'BODY[]<%d>' % offset
+                data.append((
+                    b'%d (UID %d %s {%d}' % (uid, uid, section, len(body)), body
+                ))
+                data.append(b')')
+            return 'OK', data
+        return 'OK', [None]
+
+
+def serve_imap(server, ssl_context=None):
+    """
+    Returns an `asyncio.start_server` callback speaking IMAP on behalf of
+    a `FakeImapServer`, and STARTTLS with `ssl_context` if given
+    """
+    async def handle(reader, writer):
+        writer.write(b'* OK IMAP4rev1 ready\r\n')
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            tag, command, *args = line.rstrip(b'\r\n').split(b' ')
+            command = command.decode().upper()
+            args = [arg.decode() for arg in args]
+            if command == 'STARTTLS' and ssl_context is not None:
+                writer.write(tag + b' OK Begin TLS negotiation now\r\n')
+                await writer.drain()
+                loop = asyncio.get_event_loop()
+                reader = asyncio.StreamReader()
+                protocol = asyncio.StreamReaderProtocol(reader)
+                transport = await loop.start_tls(
+                    writer.transport, protocol, ssl_context, server_side=True
+                )
+                protocol.connection_made(transport)
+                writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+                server.commands.append(('starttls', ))
+                continue
+            if command == 'SELECT':
+                writer.write(b'* %d EXISTS\r\n* OK [UIDVALIDITY %d] UIDs valid\r\n' % (
+                    len(server.messages), server.uidvalidity
+                ))
+                writer.write(b'* OK [UIDNEXT %d] Predicted next UID\r\n' % (
+                    max(server.messages, default=0) + 1
+                ))
+            elif command == 'UID' and args[0] == 'SEARCH':
+                typ, data = server.uid('search', None, *args[1:])
+                writer.write(b'* SEARCH ' + data[0] + b'\r\n')
+            elif command == 'UID':
+                typ, data = server.uid(args[0].lower(), *args[1:])
+                for item in data:
+                    if isinstance(item, tuple):
+                        number, rest = item[0].split(b' ', 1)
+                        writer.write(b'* ' + number + b' FETCH ' + rest + b'\r\n' + item[1])
+                    elif item is not None:
+                        writer.write(item + b'\r\n')
+            elif command == 'LOGOUT':
+                server.logout()
+                writer.write(b'* BYE Logging out\r\n')
+            writer.write(tag + b' OK ' + command.encode() + b' completed\r\n')
+            await writer.drain()
+            if command == 'LOGOUT':
+                break
+        writer.close()
+    return handle
+
+
+class FakePop3Server:
+    """
+    Minimal in-memory stand-in for `PipeliningPOP3` used by transport tests
+    """
+    def __init__(self, messages, capabilities=('UIDL', 'TOP')):
+        # {uidl: raw message bytes}, numbered in insertion order
+        self.messages = list(messages.items())
+        self.capabilities = capabilities
+        self.sent = []
+        self.pending = []
+        self.deleted = []
+        self.log = []
+
+    def capa(self):
+        return {name: [] for name in self.capabilities}
+
+    def list(self):
+        return b'+OK', [b'%d %d' % (i + 1, len(body)) for i, (uidl, body) in enumerate(self.messages)], 0
+
+    def uidl(self):
+        return b'+OK', [b'%d %s' % (i + 1, uidl.encode()) for i, (uidl, body) in enumerate(self.messages)], 0
+
+    def send_command(self, line):
+        self.sent.append(line)
+        self.pending.append(line)
+        self.log.append('send')
+
+    def read_response(self):
+        self.log.append('read')
+        command, number = self.pending.pop(0).split(' ')[:2]
+        if command == 'DELE':
+            self.deleted.append(int(number))
+        return b'+OK'
+
+    def read_long_response(self):
+        self.log.append('read')
+        command, number = self.pending.pop(0).split(' ')[:2]
+        body = self.messages[int(number) - 1][1]
+        if command == 'TOP':
+            body = body.split(b'\r\n\r\n')[0]
+        return b'+OK', body.split(b'\r\n'), len(body)
+
+    def read_long_response_into(self, fp):
+        response, lines, octets = self.read_long_response()
+        fp.write(b'\r\n'.join(lines))
+        return response, octets
+
+    def quit(self):
+        return b'+OK'
@@ -0,0 +1,319 @@
+import re
+import ssl
+import asyncio
+import imaplib
+import logging
+
+from django.conf import settings
+
+from mail.api.transports.base import MessageParseError
+from mail.api.transports.imap import ImapTransport, compress_uid_set
+
+
+logger = logging.getLogger(__name__)
+
+LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+TAGGED_RE = re.compile(rb'(?P<tag>A\d+) (?P<type>[A-Z]+) ?(?P<data>.*)$')
+UNTAGGED_RE = re.compile(rb'\* (?P<type>[A-Z-]+)( (?P<data>.*))?$')
+UNTAGGED_STATUS_RE = re.compile(rb'\* (?P<data>\d+) (?P<type>[A-Z-]+)( (?P<data2>.*))?$')
+RESPONSE_CODE_RE = re.compile(rb'\[(?P<type>[A-Z-]+)( (?P<data>[^\]]*))?\]')
+
+
+def quote(value):
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+class AsyncImapClient(object):
+    """
+    Minimal IMAP4rev1 client on asyncio streams.
+
+    Commands are coroutines named and returning like those of
+    `imaplib.IMAP4`, so that `AsyncImapTransport` reads the same way as
+    `ImapTransport`. Only what the transport needs is implemented. A
+    server that keeps the client waiting for more than `timeout` seconds
+    raises `abort`.
+    """
+    error = imaplib.IMAP4.error
+    abort = imaplib.IMAP4.abort
+
+    def __init__(self, reader, writer, timeout=None):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.tagnum = 0
+        self.untagged_responses = {}
+        self.capabilities = ()
+
+    @classmethod
+    async def open(cls, host, port, ssl_context=None, starttls=False, timeout=None):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(
+                host, port, ssl=ssl_context, limit=imaplib._MAXLINE
+            ), timeout)
+        except asyncio.TimeoutError:
+            raise cls.abort('socket error: connection timed out')
+        client = cls(reader, writer, timeout=timeout)
+        try:
+            greeting = await client._get_line()
+            if not greeting.startswith((b'* OK', b'* PREAUTH')):
+                raise cls.error('Unexpected greeting: %r' % greeting)
+            if starttls:
+                await client.starttls(host)
+        except BaseException:
+            client.writer.close()
+            raise
+        return client
+
+    async def starttls(self, host):
+        typ, data = await self._simple_command('STARTTLS')
+        if typ != 'OK':
+            raise self.error('STARTTLS failed: %r' % data)
+        loop = asyncio.get_event_loop()
+        # asyncio streams can't be upgraded in place before Python 3.11,
+        # so new ones are opened on the TLS transport
+        reader = asyncio.StreamReader(limit=imaplib._MAXLINE, loop=loop)
+        protocol = asyncio.StreamReaderProtocol(reader, loop=loop)
+        transport = await self._wait(loop.start_tls(
+            self.writer.transport, protocol, ssl.create_default_context(),
+            server_hostname=host,
+        ))
+        protocol.connection_made(transport)
+        self.reader = reader
+        self.writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+
+    async def _wait(self, awaitable):
+        """Awaits I/O with the server for at most `timeout` seconds."""
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            raise self.abort('socket error: timed out after %s seconds' % self.timeout)
+
+    async def login(self, user, password):
+        typ, data = await self._simple_command('LOGIN', quote(user), quote(password))
+        if typ != 'OK':
+            raise self.error(data[-1])
+        return typ, data
+
+    async def select(self, mailbox='INBOX'):
+        self.untagged_responses = {}
+        typ, data = await self._simple_command('SELECT', quote(mailbox))
+        if typ != 'OK':
+            raise self.error('SELECT %s failed: %r' % (mailbox, data))
+        return typ, self.untagged_responses.get('EXISTS', [None])
+
+    def response(self, code):
+        return code, self.untagged_responses.pop(code, [None])
+
+    async def list(self, directory='""', pattern='*'):
+        typ, data = await self._simple_command('LIST', directory, quote(pattern))
+        return typ, self.untagged_responses.pop('LIST', [None])
+
+    async def create(self, mailbox):
+        return await self._simple_command('CREATE', quote(mailbox))
+
+    async def expunge(self):
+        typ, data = await self._simple_command('EXPUNGE')
+        return typ, self.untagged_responses.pop('EXPUNGE', [None])
+
+    async def noop(self):
+        return await self._simple_command('NOOP')
+
+    async def uid(self, command, *args):
+        command = command.upper()
+        typ, data = await self._simple_command('UID', command, *(arg for arg in args if arg))
+        return typ, self.untagged_responses.pop(command, [None])
+
+    async def logout(self):
+        try:
+            typ, data = await self._simple_command('LOGOUT')
+        except (self.error, OSError, asyncio.IncompleteReadError):
+            typ, data = 'NO', [None]
+        self.writer.close()
+        return typ, data
+
+    async def _simple_command(self, name, *args):
+        self.tagnum += 1
+        tag = b'A%03d' % self.tagnum
+        line = b' '.join([tag, name.encode()] + [
+            arg if isinstance(arg, bytes) else str(arg).encode() for arg in args
+        ])
+        self.writer.write(line + b'\r\n')
+        await self._wait(self.writer.drain())
+
+        while True:
+            response = await self._get_response()
+            match = TAGGED_RE.match(response[0] if isinstance(response[0], bytes) else b'')
+            if match and match.group('tag') == tag:
+                typ = match.group('type').decode()
+                if typ == 'BAD':
+                    raise self.error('%s command error: %s %r' % (name, typ, match.group('data')))
+                return typ, [match.group('data')]
+
+    async def _get_response(self):
+        """Reads a response with its literals and files untagged ones
+        by type, as imaplib does."""
+        line = await self._get_line()
+        response = [line]
+        match = LITERAL_RE.search(line)
+        while match:
+            literal = await self._wait(self.reader.readexactly(int(match.group(1))))
+            response[-1] = (response[-1], literal)
+            line = await self._get_line()
+            response.append(line)
+            match = LITERAL_RE.search(line)
+
+        head = response[0][0] if isinstance(response[0], tuple) else response[0]
+        if not head.startswith(b'* '):
+            return response
+
+        match = UNTAGGED_STATUS_RE.match(head)
+        if match:
+            typ = match.group('type')
+            data = match.group('data')
+            if match.group('data2'):
+                data += b' ' + match.group('data2')
+        else:
+            match = UNTAGGED_RE.match(head)
+            if match is None:
+                raise self.abort('Unexpected response: %r' % head)
+            typ = match.group('type')
+            data = match.group('data') or b''
+            code = RESPONSE_CODE_RE.match(data)
+            if typ in (b'OK', b'NO', b'BAD') and code:
+                self._append_untagged(code.group('type'), code.group('data'))
+
+        if typ == b'CAPABILITY':
+            self.capabilities = tuple(data.decode().upper().split())
+        if isinstance(response[0], tuple):
+            response[0] = (data, response[0][1])
+        else:
+            response[0] = data
+        for item in response:
+            self._append_untagged(typ, item)
+        return response
+
+    def _append_untagged(self, typ, data):
+        self.untagged_responses.setdefault(typ.decode(), []).append(data)
+
+    async def _get_line(self):
+        line = await self._wait(self.reader.readline())
+        if not line:
+            raise self.abort('socket error: EOF')
+        return line.rstrip(b'\r\n')
+
+
+class AsyncImapTransport(ImapTransport):
+    """
+    `ImapTransport` on asyncio, for polling many mailboxes from one
+    event loop.
+
+    Methods doing I/O are coroutines, and `get_message` is an async
+    generator with the same contract: messages are flagged and archived
+    once the consumer awaits `commit`.
+    """
+    raw_messages = False
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncImapTransport, self).__init__(*args, **kwargs)
+        # Seconds to wait for the server before giving the session up
+        self.timeout = getattr(
+            settings,
+            'DJANGO_MAILBOX_IMAP_TIMEOUT',
+            60
+        )
+
+    async def connect(self, username, password):
+        ssl_context = None
+        if self.transport is imaplib.IMAP4_SSL:
+            ssl_context = ssl.create_default_context()
+        self.server = await AsyncImapClient.open(
+            self.hostname, self.port, ssl_context=ssl_context, starttls=self.tls,
+            timeout=self.timeout,
+        )
+        await self.server.login(username, password)
+        await self.select_folder()
+
+    async def select_folder(self):
+        if self.folder:
+            await self.server.select(self.folder)
+        else:
+            await self.server.select()
+
+        self.uidvalidity = self._get_select_response('UIDVALIDITY')
+        self.uidnext = self._get_select_response('UIDNEXT')
+
+    async def _search(self, *criteria):
+        response, message_ids = await self.server.uid('search', None, *self._get_search_criteria(criteria))
+        return self._parse_search_response(message_ids)
+
+    async def _get_all_message_ids(self, condition='UNSEEN'):
+        criteria = self._get_sync_criteria(condition)
+        if criteria is None:
+            return []
+        return self._filter_new_uids(await self._search(*criteria))
+
+    async def _get_small_message_ids(self, message_ids):
+        status, data = await self.server.uid(
+            'fetch',
+            compress_uid_set(message_ids),
+            '(RFC822.SIZE)'
+        )
+        return self._parse_size_response(data)
+
+    async def get_message(self, condition=None):
+        self._pending_uids, self._pending_sync = [], []
+        message_ids = await self._get_all_message_ids(condition)
+
+        if not message_ids:
+            self._finish_sync(message_ids)
+            return
+
+        searched_ids = message_ids
+
+        # Limit the uids to the small ones if we care about that
+        if self.max_message_size:
+            message_ids = await self._get_small_message_ids(message_ids)
+
+        if self.archive:
+            typ, folders = await self.server.list(pattern=self.archive)
+            if folders[0] is None:
+                # If the archive folder does not exist, create it
+                await self.server.create(self.archive)
+
+        for start in range(0, len(message_ids), self.fetch_chunk_size):
+            chunk = message_ids[start:start + self.fetch_chunk_size]
+
+            typ, data = await self.server.uid('fetch', compress_uid_set(chunk), self.fetch_items)
+            for uid, contents in self._parse_fetch_response(data):
+                try:
+                    message = self.get_email_from_bytes(contents)
+                except MessageParseError:
+                    continue
+                self._pending_uids.append(uid)
+                yield message
+        self._finish_sync(searched_ids)
+
+    async def commit(self):
+        uid_set = self._take_pending()
+        if uid_set is None:
+            return
+        if self.archive:
+            await self.server.uid('copy', uid_set, quote(self.archive))
+        await self.server.uid('store', uid_set, "+FLAGS", "(\\Seen)")
+        await self.server.expunge()
+
+    @property
+    def supports_idle(self):
+        return False
+
+    async def noop(self):
+        """Returns whether the session is still usable."""
+        try:
+            typ, data = await self.server.noop()
+        except (imaplib.IMAP4.error, OSError, asyncio.IncompleteReadError) as e:
+            logger.info("Connection to %s was lost: %s", self.hostname, e)
+            return False
+        return typ == 'OK'
+
+    async def close(self):
+        await self.server.logout()
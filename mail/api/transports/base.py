@@ -1,7 +1,12 @@
+import os
 import email
+import tempfile
 
 import six
 
+from email.feedparser import BytesFeedParser
+from email.utils import parsedate_to_datetime
+
 # Do *not* remove this, we need to use this in subclasses of EmailTransport
 if six.PY3:
     from email.errors import MessageParseError  # noqa: F401
@@ -9,17 +14,141 @@ else:
     from email.Errors import MessageParseError  # noqa: F401
 
 
+class RawMessageFile(object):
+    """
+    A fetched message kept in a temporary file rather than in memory.
+
+    Transports hand these out in place of bytes for messages larger than
+    ``DJANGO_MAILBOX_MESSAGE_SPOOL_SIZE``. They pickle as their path, so
+    a parse worker reads the file itself; `discard` removes it.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def open(self):
+        return open(self.path, 'rb')
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class MessageSpool(object):
+    """
+    Collects a message as it is fetched, in memory up to `max_size` bytes
+    and in a temporary file beyond that.
+
+    `finish` returns the message as bytes or as a `RawMessageFile`.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._chunks = []
+        self._file = None
+        self._path = None
+
+    def write(self, data):
+        if self._file is None and self.size + len(data) > self.max_size:
+            fd, self._path = tempfile.mkstemp(prefix='mail-message-')
+            self._file = os.fdopen(fd, 'wb')
+            self._file.writelines(self._chunks)
+            self._chunks = []
+        if self._file is None:
+            self._chunks.append(data)
+        else:
+            self._file.write(data)
+        self.size += len(data)
+
+    def finish(self):
+        if self._file is None:
+            return b''.join(self._chunks)
+        self._file.close()
+        return RawMessageFile(self._path)
+
+
+def parse_file(fp, chunk_size=64 * 1024):
+    """Parses the message in `fp` without reading it in one piece."""
+    parser = BytesFeedParser()
+    for chunk in iter(lambda: fp.read(chunk_size), b''):
+        parser.feed(chunk)
+    return parser.close()
+
+
+def message_from_raw(contents):
+    """Parses a message handed out as bytes or as a `RawMessageFile`,
+    keeping what it was parsed from to archive the original."""
+    if isinstance(contents, RawMessageFile):
+        with contents.open() as fp:
+            message = parse_file(fp)
+        message.raw_file = contents
+    else:
+        message = email.message_from_bytes(contents)
+        message.raw_bytes = contents
+    return message
+
+
+def discard_raw_file(message):
+    """Removes the file `message` was parsed from, if it was spooled."""
+    raw_file = getattr(message, 'raw_file', None)
+    if raw_file is not None:
+        raw_file.discard()
+
+
 class EmailTransport(object):
+    # Messages dated before this `datetime.date` are skipped
+    since = None
+    # Whether `get_raw_message` is implemented
+    raw_messages = False
+
     def __init__(self, config=None):
         if config and self.config_class:
             serializer = self.config_class(data=config)
             if serializer.is_valid():
                 self.config = serializer.validated_data
 
+    def get_raw_message(self, condition=None):
+        """Yields messages as bytes, or as a `RawMessageFile` if large, to
+        be parsed out of the fetching thread."""
+        raise NotImplementedError
+
+    def commit(self):
+        """Acknowledges every message handed out so far.
+
+        Called once the consumer has stored them; transports delete, flag
+        or checkpoint messages here and never before, so that a failed
+        write leaves them to be fetched again.
+
+        """
+
     def get_email_from_bytes(self, contents):
         if six.PY3:
-            message = email.message_from_bytes(contents)
+            # Kept to archive the original without serializing it again
+            message = message_from_raw(contents)
         else:
             message = email.message_from_string(contents)
 
         return message
+
+    def get_email_from_file(self, fp, chunk_size=64 * 1024):
+        """Parses the message in `fp` without reading it in one piece."""
+        return parse_file(fp, chunk_size)
+
+    def get_email_headers_from_file(self, fp):
+        """Parses only the header block of the message in `fp`."""
+        lines = []
+        for line in fp:
+            if line in (b'\r\n', b'\n'):
+                break
+            lines.append(line)
+        return self.get_email_from_bytes(b''.join(lines))
+
+    def is_too_old(self, message):
+        if self.since is None or 'date' not in message:
+            return False
+        try:
+            date = parsedate_to_datetime(message['date'])
+        except (TypeError, ValueError):
+            return False
+        return date.date() < self.since
@@ -1,14 +1,23 @@
+import os
 import sys
 import six
 
+from datetime import datetime
+
 from .base import EmailTransport
 
 
+def get_file_modified_date(path):
+    return datetime.fromtimestamp(os.path.getmtime(path)).date()
+
 class GenericFileMailbox(EmailTransport):
     _variant = None
     _path = None
+    # The locked repository and the keys handed out since the last commit
+    _repository = None
+    _pending_keys = ()
 
-    def __init__(self, path):
+    def __init__(self, path, since=None):
         super(GenericFileMailbox, self).__init__()
         if six.PY2:
             self._path = path.encode(
@@ -16,17 +25,52 @@ class GenericFileMailbox(EmailTransport):
             )
         else:
             self._path = path
+        self.since = since
 
     def get_instance(self):
         return self._variant(self._path)
 
+    def get_modified_date(self, repository, key):
+        """Returns the date the message file was last modified, if known."""
+        return None
+
+    def _is_message_too_old(self, repository, key):
+        # A message written before the cutoff can't be dated after it,
+        # so the file's mtime rejects it without opening the file.
+        modified = self.get_modified_date(repository, key)
+        if modified is not None and modified < self.since:
+            return True
+
+        with repository.get_file(key) as fp:
+            headers = self.get_email_headers_from_file(fp)
+        return self.is_too_old(headers)
+
     def get_message(self, condition=None):
-        repository = self.get_instance()
+        # The repository stays locked until the messages are committed
+        # and the connection is closed
+        repository = self._repository = self.get_instance()
         repository.lock()
-        for key, message in repository.items():
+        self._pending_keys = []
+        for key in repository.keys():
+            if self.since is not None and self._is_message_too_old(repository, key):
+                continue
+            with repository.get_file(key) as fp:
+                message = self.get_email_from_file(fp)
             if condition and not condition(message):
                 continue
-            repository.remove(key)
+            self._pending_keys.append(key)
             yield message
-        repository.flush()
-        repository.unlock()
+
+    def commit(self):
+        keys, self._pending_keys = self._pending_keys, []
+        if not keys:
+            return
+        for key in keys:
+            self._repository.remove(key)
+        self._repository.flush()
+
+    def close(self):
+        if self._repository is not None:
+            # Unlocks the repository as well
+            self._repository.close()
+            self._repository = None
@@ -1,12 +1,80 @@
+import re
+import base64
 import logging
 
+from mail.api.transports.base import RawMessageFile
 from mail.api.transports.imap import ImapTransport
 
 
 logger = logging.getLogger(__name__)
 
+FETCH_ATTRIBUTE_RE = re.compile(rb'(X-GM-MSGID|X-GM-THRID) (\d+)')
+FETCH_LABELS_RE = re.compile(rb'X-GM-LABELS \(([^)]*)\)')
+LABEL_RE = re.compile(r'"((?:[^"\\]|\\.)*)"|([^\s"]+)')
+UTF7_RE = re.compile(r'&([^-]*)-')
+
+
+def decode_mailbox_name(name):
+    """Decodes the modified UTF-7 of IMAP mailbox names (RFC 3501)."""
+    def decode(match):
+        if not match.group(1):
+            return '&'
+        encoded = match.group(1).replace(',', '/')
+        encoded += '=' * (-len(encoded) % 4)
+        return base64.b64decode(encoded).decode('utf-16-be')
+    return UTF7_RE.sub(decode, name)
+
+
+def parse_labels(value):
+    """Returns the labels in an ``X-GM-LABELS`` list."""
+    labels = []
+    for quoted, atom in LABEL_RE.findall(value or ''):
+        label = re.sub(r'\\(.)', r'\1', quoted) if quoted else atom
+        labels.append(decode_mailbox_name(label))
+    return labels
+
+
+class GmailMessageBytes(bytes):
+    """A fetched message, with the Gmail attributes fetched along with it
+    in `gmail_attributes`."""
+    gmail_attributes = None
+
+
+def get_gmail_attributes(message):
+    """Returns the Gmail message id, thread id and labels of `message`.
+
+    They are only known for messages fetched by `GmailImapTransport`;
+    ``X-GM-*`` headers in the message itself are never trusted.
+
+    """
+    return getattr(message, 'gmail_attributes', None) or (None, None, [])
+
 
 class GmailImapTransport(ImapTransport):
+    """
+    IMAP transport for Gmail.
+
+    Gmail's message id, thread id and labels are fetched along with each
+    message and set on it as `gmail_attributes`, apart from its headers.
+    """
+    fetch_items = '(UID X-GM-MSGID X-GM-THRID X-GM-LABELS BODY.PEEK[])'
+
+    def _get_contents(self, response, contents):
+        attributes = dict(FETCH_ATTRIBUTE_RE.findall(response))
+        labels = FETCH_LABELS_RE.search(response)
+        if not isinstance(contents, RawMessageFile):
+            contents = GmailMessageBytes(contents)
+        contents.gmail_attributes = (
+            attributes.get(b'X-GM-MSGID', b'').decode() or None,
+            attributes.get(b'X-GM-THRID', b'').decode() or None,
+            parse_labels(labels.group(1).decode('utf-8', 'replace') if labels else None),
+        )
+        return contents
+
+    def get_email_from_bytes(self, contents):
+        message = super(GmailImapTransport, self).get_email_from_bytes(contents)
+        message.gmail_attributes = getattr(contents, 'gmail_attributes', None)
+        return message
 
     def connect(self, username, password):
         # Try to use oauth2 first.  It's much safer
@@ -16,7 +84,7 @@ class GmailImapTransport(ImapTransport):
             logger.warning("Couldn't do oauth2 because %s" % e)
             self.server = self.transport(self.hostname, self.port)
             typ, msg = self.server.login(username, password)
-            self.server.select()
+            self.select_folder()
 
     def _connect_oauth(self, username):
         # username should be an email address that has already been authorized
@@ -54,4 +122,4 @@ class GmailImapTransport(ImapTransport):
         )
         self.server = self.transport(self.hostname, self.port)
         self.server.authenticate('XOAUTH2', lambda x: auth_string)
-        self.server.select()
+        self.select_folder()
@@ -1,9 +1,12 @@
+import re
+import time
+import select
 import imaplib
 import logging
 
 from django.conf import settings
 
-from .base import EmailTransport, MessageParseError
+from .base import EmailTransport, MessageParseError, MessageSpool, RawMessageFile
 
 
 # By default, imaplib will raise an exception if it encounters more
@@ -15,11 +18,49 @@ imaplib._MAXLINE = 1000000
 
 logger = logging.getLogger(__name__)
 
+FETCH_UID_RE = re.compile(rb'UID (\d+)')
+
+# RFC 2177: clients should re-issue IDLE at least every 29 minutes
+# to avoid being logged off for inactivity.
+IDLE_TIMEOUT = 29 * 60
+
+# How long to wait for the server to confirm the end of IDLE
+IDLE_DONE_TIMEOUT = 30
+
+# SEARCH dates need English month names regardless of the locale
+MONTHS = (
+    'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+    'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec',
+)
+
+
+def compress_uid_set(uids):
+    """Collapses UIDs into an IMAP sequence set, e.g. ``1:3,7,9:10``."""
+    uids = sorted(set(int(uid) for uid in uids))
+    ranges = []
+    for uid in uids:
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(
+        str(start) if start == end else '%d:%d' % (start, end)
+        for start, end in ranges
+    )
+
 
 class ImapTransport(EmailTransport):
+    raw_messages = True
+    # BODY.PEEK[] leaves \Seen alone until the messages are committed
+    fetch_items = '(UID BODY.PEEK[])'
+    # UIDs handed out since the last commit, and UIDs the sync state
+    # moves past on the next commit without flagging them
+    _pending_uids = ()
+    _pending_sync = ()
+
     def __init__(
         self, hostname, port=None, ssl=False, tls=False,
-        archive='processed', folder=None,
+        archive='processed', folder=None, sync_state=None, since=None,
     ):
         self.max_message_size = getattr(
             settings,
@@ -31,11 +72,29 @@ class ImapTransport(EmailTransport):
             'DJANGO_MAILBOX_INTEGRATION_TESTING_SUBJECT',
             None
         )
+        self.fetch_chunk_size = getattr(
+            settings,
+            'DJANGO_MAILBOX_IMAP_FETCH_CHUNK_SIZE',
+            100
+        )
+        # Messages are fetched in pieces of this many bytes, and those
+        # larger than one piece are spooled to disk; 0 fetches them whole
+        self.message_spool_size = getattr(
+            settings,
+            'DJANGO_MAILBOX_MESSAGE_SPOOL_SIZE',
+            1024 * 1024
+        )
         self.hostname = hostname
         self.port = port
         self.archive = archive
         self.folder = folder
         self.tls = tls
+        self.since = since
+        # Per-folder sync state: ``uidvalidity`` of the selected folder
+        # and ``last_uid`` -- the highest UID already ingested.
+        self.sync_state = dict(sync_state or {})
+        self.uidvalidity = None
+        self.uidnext = None
         if ssl:
             self.transport = imaplib.IMAP4_SSL
             if not self.port:
@@ -51,14 +110,54 @@ class ImapTransport(EmailTransport):
             self.server.starttls()
         typ, msg = self.server.login(username, password)
 
+        self.select_folder()
+
+    def select_folder(self):
         if self.folder:
             self.server.select(self.folder)
         else:
             self.server.select()
 
-    def _get_all_message_ids(self, condition='UNSEEN'):
-        # Fetch all the message uids
-        response, message_ids = self.server.uid('search', None, condition)
+        self.uidvalidity = self._get_select_response('UIDVALIDITY')
+        self.uidnext = self._get_select_response('UIDNEXT')
+
+    def _get_select_response(self, name):
+        typ, data = self.server.response(name)
+        try:
+            return int(data[-1])
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    @property
+    def is_incremental(self):
+        """Whether the tracked sync state is still valid for the folder.
+
+        A changed UIDVALIDITY means the server renumbered the folder and
+        previously seen UIDs are meaningless, so a full resync is needed.
+        """
+        return (
+            self.uidvalidity is not None
+            and self.sync_state.get('uidvalidity') == self.uidvalidity
+            and self.sync_state.get('last_uid') is not None
+        )
+
+    def _advance_sync_state(self, uid):
+        last_uid = self.sync_state.get('last_uid') or 0
+        self.sync_state['last_uid'] = max(last_uid, int(uid))
+
+    def _search(self, *criteria):
+        response, message_ids = self.server.uid('search', None, *self._get_search_criteria(criteria))
+        return self._parse_search_response(message_ids)
+
+    def _get_search_criteria(self, criteria):
+        # Let the server drop messages older than the cutoff
+        if self.since is not None:
+            criteria += ('SINCE', '%d-%s-%d' % (
+                self.since.day, MONTHS[self.since.month - 1], self.since.year
+            ))
+        return tuple(c for c in criteria if c) or ('ALL', )
+
+    def _parse_search_response(self, message_ids):
         message_id_string = message_ids[0].strip()
         # Usually `message_id_string` will be a list of space-separated
         # ids; we must make sure that it isn't an empty string before
@@ -67,18 +166,50 @@ class ImapTransport(EmailTransport):
             return message_id_string.decode().split(' ')
         return []
 
+    def _get_all_message_ids(self, condition='UNSEEN'):
+        criteria = self._get_sync_criteria(condition)
+        if criteria is None:
+            return []
+        return self._filter_new_uids(self._search(*criteria))
+
+    def _get_sync_criteria(self, condition):
+        """Returns the search criteria for messages not yet ingested, or
+        None when SELECT already told there are none."""
+        if not self.is_incremental:
+            # First poll of this folder or UIDVALIDITY changed:
+            # forget what we knew and do a full resync.
+            self.sync_state = {'uidvalidity': self.uidvalidity, 'last_uid': None}
+            return (condition, )
+
+        last_uid = self.sync_state['last_uid']
+        if self.uidnext is not None and self.uidnext <= last_uid + 1:
+            # SELECT already told us nothing has arrived since last poll
+            return None
+        # Only the UID range: a condition on flags such as UNSEEN would
+        # miss mail another client read meanwhile, and the checkpoint
+        # would then move past it for good.
+        return ('UID', '%d:*' % (last_uid + 1))
+
+    def _filter_new_uids(self, uids):
+        last_uid = self.sync_state.get('last_uid')
+        if last_uid is None:
+            return uids
+        # `n:*` always matches the highest UID, even if it is below `n`
+        return [uid for uid in uids if int(uid) > last_uid]
+
     def _get_small_message_ids(self, message_ids):
         # Using existing message uids, get the sizes and
         # return only those that are under the size
         # limit
-        safe_message_ids = []
-
         status, data = self.server.uid(
             'fetch',
-            ','.join(message_ids),
+            compress_uid_set(message_ids),
             '(RFC822.SIZE)'
         )
+        return self._parse_size_response(data)
 
+    def _parse_size_response(self, data):
+        safe_message_ids = []
         for each_msg in data:
             each_msg = each_msg.decode()
             try:
@@ -94,11 +225,25 @@ class ImapTransport(EmailTransport):
         return safe_message_ids
 
     def get_message(self, condition=None):
+        for contents in self.get_raw_message(condition):
+            try:
+                message = self.get_email_from_bytes(contents)
+            except MessageParseError:
+                if isinstance(contents, RawMessageFile):
+                    contents.discard()
+                continue
+            yield message
+
+    def get_raw_message(self, condition=None):
+        self._pending_uids, self._pending_sync = [], []
         message_ids = self._get_all_message_ids(condition)
 
         if not message_ids:
+            self._finish_sync(message_ids)
             return
 
+        searched_ids = message_ids
+
         # Limit the uids to the small ones if we care about that
         if self.max_message_size:
             message_ids = self._get_small_message_ids(message_ids)
@@ -109,26 +254,182 @@ class ImapTransport(EmailTransport):
                 # If the archive folder does not exist, create it
                 self.server.create(self.archive)
 
-        for uid in message_ids:
-            try:
-                typ, msg_contents = self.server.uid('fetch', uid, '(RFC822)')
-                if not msg_contents:
-                    continue
-                try:
-                    message = self.get_email_from_bytes(msg_contents[0][1])
-                except TypeError:
-                    # This happens if another thread/process deletes the
-                    # message between our generating the ID list and our
-                    # processing it here.
-                    continue
-
-                yield message
-            except MessageParseError:
-                continue
+        for start in range(0, len(message_ids), self.fetch_chunk_size):
+            chunk = message_ids[start:start + self.fetch_chunk_size]
+            for uid, contents in self._fetch_chunk(chunk):
+                self._pending_uids.append(uid)
+                yield contents
+        self._finish_sync(searched_ids)
 
-            if self.archive:
-                self.server.uid('copy', uid, self.archive)
+    def _take_pending(self):
+        """Advances the sync state past the messages handed out so far
+        and returns the UID set left to archive and flag, or None."""
+        uids, self._pending_uids = self._pending_uids, []
+        for uid in list(uids) + list(self._pending_sync):
+            self._advance_sync_state(uid)
+        self._pending_sync = []
+        return compress_uid_set(uids) if uids else None
 
-            self.server.uid('store', uid, "+FLAGS", "(\\Seen)")
+    def commit(self):
+        # Archive and flag everything stored since the last commit with
+        # one command each, however the consumer batched it
+        uid_set = self._take_pending()
+        if uid_set is None:
+            return
+        if self.archive:
+            self.server.uid('copy', uid_set, self.archive)
+        self.server.uid('store', uid_set, "+FLAGS", "(\\Seen)")
         self.server.expunge()
-        return
+
+    def _get_fetch_items(self, offset):
+        """Returns the items fetching the piece of a message at `offset`."""
+        if not self.message_spool_size:
+            return self.fetch_items
+        return self.fetch_items.replace(
+            'BODY.PEEK[]', 'BODY.PEEK[]<%d.%d>' % (offset, self.message_spool_size)
+        )
+
+    def _fetch_chunk(self, uids):
+        typ, data = self.server.uid('fetch', compress_uid_set(uids), self._get_fetch_items(0))
+        for uid, response, contents in self._iter_fetch_literals(data):
+            if self.message_spool_size and len(contents) >= self.message_spool_size:
+                contents = self._fetch_rest(uid, contents)
+            yield uid, self._get_contents(response, contents)
+
+    def _fetch_rest(self, uid, contents):
+        """Fetches the rest of the message `uid` that starts with
+        `contents`, a piece at a time, into a `MessageSpool`."""
+        spool = MessageSpool(self.message_spool_size)
+        spool.write(contents)
+        piece = contents
+        while len(piece) >= self.message_spool_size:
+            typ, data = self.server.uid('fetch', uid, self._get_fetch_items(spool.size))
+            pieces = [literal for _, _, literal in self._iter_fetch_literals(data)]
+            piece = pieces[0] if pieces else b''
+            spool.write(piece)
+        return spool.finish()
+
+    def _parse_fetch_response(self, data):
+        """Yields the UID and contents of each message in a FETCH response."""
+        for uid, response, contents in self._iter_fetch_literals(data):
+            yield uid, self._get_contents(response, contents)
+
+    def _iter_fetch_literals(self, data):
+        """Yields the UID, response line and literal of each message in a
+        FETCH response."""
+        if not data:
+            return
+
+        for index, item in enumerate(data):
+            if not isinstance(item, tuple):
+                continue
+            match = FETCH_UID_RE.search(item[0])
+            if match is None and index + 1 < len(data) \
+                    and isinstance(data[index + 1], bytes):
+                # Some servers send the UID after the literal
+                match = FETCH_UID_RE.search(data[index + 1])
+            if match is None:
+                logger.warning("No UID in FETCH response %s", item[0])
+                continue
+            yield match.group(1).decode(), item[0], item[1]
+
+    def _get_contents(self, response, contents):
+        """Returns the message to hand out given the FETCH `response` its
+        `contents` came with."""
+        return contents
+
+    def _finish_sync(self, message_ids):
+        # Everything matched by the search has been handed out (or
+        # skipped on purpose, e.g. for size), as has everything below
+        # UIDNEXT; the next commit checkpoints past them.
+        self._pending_sync.extend(message_ids)
+        if self.uidnext is not None:
+            self._pending_sync.append(self.uidnext - 1)
+        # UIDNEXT is only valid right after SELECT; a connection that is
+        # reused for the next poll has to search for new UIDs instead.
+        self.uidnext = None
+
+    @property
+    def supports_idle(self):
+        return 'IDLE' in self.server.capabilities
+
+    def idle(self, timeout=IDLE_TIMEOUT):
+        """Waits in IDLE until the server reports new messages.
+
+        Returns True when an EXISTS notification arrived and False when
+        `timeout` seconds passed without one.
+
+        """
+        reader = IdleResponseReader(self.server.sock)
+        tag = self.server._new_tag()
+        self.server.send(tag + b' IDLE\r\n')
+
+        line = reader.readline(time.monotonic() + IDLE_DONE_TIMEOUT)
+        if line is None or not line.startswith(b'+'):
+            raise imaplib.IMAP4.abort('IDLE was not accepted: %r' % line)
+
+        has_new_messages = False
+        deadline = time.monotonic() + timeout
+        while True:
+            line = reader.readline(deadline)
+            if line is None:
+                break
+            if line.startswith(b'*') and line.rstrip().endswith(b'EXISTS'):
+                has_new_messages = True
+                break
+
+        self.server.send(b'DONE\r\n')
+        deadline = time.monotonic() + IDLE_DONE_TIMEOUT
+        while True:
+            line = reader.readline(deadline)
+            if line is None:
+                raise imaplib.IMAP4.abort('IDLE was not terminated')
+            if line.startswith(tag):
+                break
+
+        return has_new_messages
+
+    def noop(self):
+        """Returns whether the session is still usable."""
+        try:
+            typ, data = self.server.noop()
+        except (imaplib.IMAP4.error, OSError) as e:
+            logger.info("Connection to %s was lost: %s", self.hostname, e)
+            return False
+        return typ == 'OK'
+
+    def close(self):
+        try:
+            self.server.logout()
+        except (imaplib.IMAP4.error, OSError) as e:
+            logger.warning("Failed to log out from %s: %s", self.hostname, e)
+
+
+class IdleResponseReader(object):
+    """Reads response lines straight from the socket while in IDLE.
+
+    imaplib's buffered file cannot be read with a timeout, so untagged
+    responses are read here with `select` until a deadline.
+
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+
+    def readline(self, deadline):
+        while b'\n' not in self.buffer:
+            # TLS may already hold decrypted data select() knows nothing of
+            pending = getattr(self.sock, 'pending', None)
+            if not (pending and pending()):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                ready, _, _ = select.select([self.sock], [], [], remaining)
+                if not ready:
+                    return None
+            data = self.sock.recv(4096)
+            if not data:
+                raise imaplib.IMAP4.abort('Connection closed during IDLE')
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return line + b'\n'
@@ -1,9 +1,181 @@
+import os
+import time
+import uuid
+import socket
+
 from mailbox import Maildir
-from mail.api.transports.generic import GenericFileMailbox
+
+from django.conf import settings
+
+from mail.api.transports.generic import GenericFileMailbox, get_file_modified_date
+
+
+CLAIM_PREFIX = 'claimed-'
+
+# Directories messages are drained from, and claimed into under the
+# same names so that they go back where they came from
+MESSAGE_DIRS = ('new', 'cur')
 
 
 class MaildirTransport(GenericFileMailbox):
+    """
+    Drains ``new/`` and ``cur/`` of a Maildir without locking it.
+
+    Each message file is claimed by renaming it into a directory under
+    ``tmp/`` private to this transport, so several workers can drain the
+    same Maildir at once, and is removed once its message has been
+    committed. Files claimed by a crashed worker go back after
+    ``DJANGO_MAILBOX_MAILDIR_CLAIM_TIMEOUT`` seconds. Messages are handed
+    out as bytes, for the parse pool to parse.
+    """
     _variant = Maildir
+    raw_messages = True
+    # Claimed files handed out since the last commit
+    _pending_paths = ()
+
+    def __init__(self, path, since=None):
+        super(MaildirTransport, self).__init__(path, since=since)
+        self.claim_timeout = getattr(
+            settings,
+            'DJANGO_MAILBOX_MAILDIR_CLAIM_TIMEOUT',
+            60 * 60
+        )
+        self.tmp_path = os.path.join(self._path, 'tmp')
+        self.claim_path = os.path.join(self.tmp_path, '%s%s.%s.%s' % (
+            CLAIM_PREFIX, socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8]
+        ))
 
     def get_instance(self):
         return self._variant(self._path, None)
+
+    def get_message(self, condition=None):
+        return self._drain(condition, raw=False)
+
+    def get_raw_message(self, condition=None):
+        return self._drain(condition, raw=True)
+
+    def _drain(self, condition, raw):
+        self._release_stale_claims()
+        for directory in MESSAGE_DIRS:
+            os.makedirs(os.path.join(self.claim_path, directory), exist_ok=True)
+        self._pending_paths = []
+        try:
+            for directory, entry in self._scan():
+                claimed = self._claim(directory, entry, raw=raw)
+                if claimed is None:
+                    continue
+                path, message = claimed
+                if condition and not condition(
+                    self.get_email_from_bytes(message) if raw else message
+                ):
+                    self._unclaim(path)
+                    continue
+                self._pending_paths.append(path)
+                yield message
+        finally:
+            # Messages claimed but never handed out go back to new/
+            self._release_claims(self.claim_path, keep=self._pending_paths)
+
+    def commit(self):
+        paths, self._pending_paths = self._pending_paths, []
+        for path in paths:
+            os.remove(path)
+
+    def close(self):
+        # Messages handed out but not committed go back to new/
+        self._pending_paths = []
+        self._release_claims(self.claim_path)
+
+    def _scan(self):
+        """Yields the directory name and entry of each message file."""
+        for directory in MESSAGE_DIRS:
+            try:
+                with os.scandir(os.path.join(self._path, directory)) as scan:
+                    for entry in scan:
+                        if not entry.name.startswith('.'):
+                            yield directory, entry
+            except FileNotFoundError:
+                continue
+
+    def _claim(self, directory, entry, raw=False):
+        """Moves `entry` of `directory` into the claim directory and
+        parses it.
+
+        Returns the claimed path and the message, or its bytes if `raw`,
+        or None if the message is too old or another worker claimed it
+        first.
+
+        """
+        if self.since is not None and self._is_entry_too_old(entry):
+            return None
+
+        path = os.path.join(self.claim_path, directory, entry.name)
+        try:
+            os.rename(entry.path, path)
+        except FileNotFoundError:
+            return None
+        with open(path, 'rb') as fp:
+            return path, fp.read() if raw else self.get_email_from_file(fp)
+
+    def _is_entry_too_old(self, entry):
+        try:
+            # The mtime rejects a message without opening its file
+            if get_file_modified_date(entry.path) < self.since:
+                return True
+            with open(entry.path, 'rb') as fp:
+                headers = self.get_email_headers_from_file(fp)
+        except FileNotFoundError:
+            return True
+        return self.is_too_old(headers)
+
+    def _unclaim(self, path):
+        directory, name = os.path.split(path)
+        try:
+            os.rename(path, os.path.join(self._path, os.path.basename(directory), name))
+        except FileNotFoundError:
+            pass
+
+    def _release_claims(self, claim_path, keep=()):
+        keep = set(keep)
+        for directory in MESSAGE_DIRS:
+            try:
+                with os.scandir(os.path.join(claim_path, directory)) as scan:
+                    for entry in scan:
+                        if entry.path not in keep:
+                            self._unclaim(entry.path)
+                if not keep:
+                    os.rmdir(os.path.join(claim_path, directory))
+            except OSError:
+                pass
+        if not keep:
+            try:
+                os.rmdir(claim_path)
+            except OSError:
+                pass
+
+    def _get_claim_time(self, claim_path):
+        """Returns when a file was last claimed into `claim_path`."""
+        times = []
+        for path in (claim_path, ) + tuple(
+            os.path.join(claim_path, directory) for directory in MESSAGE_DIRS
+        ):
+            try:
+                times.append(os.stat(path).st_mtime)
+            except FileNotFoundError:
+                continue
+        return max(times, default=0)
+
+    def _release_stale_claims(self):
+        try:
+            with os.scandir(self.tmp_path) as scan:
+                claims = [
+                    entry for entry in scan
+                    if entry.name.startswith(CLAIM_PREFIX) and entry.is_dir()
+                ]
+        except FileNotFoundError:
+            return
+
+        deadline = time.time() - self.claim_timeout
+        for entry in claims:
+            if self._get_claim_time(entry.path) < deadline:
+                self._release_claims(entry.path)
@@ -1,6 +1,131 @@
+import os
+import re
+import mmap
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from email.feedparser import BytesFeedParser
 from mailbox import mbox
+
 from mail.api.transports.generic import GenericFileMailbox
 
 
+logger = logging.getLogger(__name__)
+
+SEPARATOR = b'\nFrom '
+HEADERS_END_RE = re.compile(rb'\r?\n\r?\n')
+
+
 class MboxTransport(GenericFileMailbox):
+    """
+    Reads an mbox file through `mmap`, without rewriting it.
+
+    The file is read up to its size once no delivery holds its lock, so
+    a message still being appended is left for the next poll. Messages
+    are sliced out between ``From `` lines, and the offset past
+    the last committed message is kept in `sync_state`. An interrupted
+    import resumes from there, and later polls read only the messages
+    appended since.
+    """
     _variant = mbox
+    chunk_size = 64 * 1024
+    raw_messages = True
+
+    def __init__(self, path, since=None, sync_state=None):
+        super(MboxTransport, self).__init__(path, since=since)
+        self.sync_state = dict(sync_state or {})
+        # Offset past the last message handed out, checkpointed on commit
+        self._pending_offset = None
+
+    def commit(self):
+        if self._pending_offset is not None:
+            self.sync_state = {'offset': self._pending_offset}
+            self._pending_offset = None
+
+    def get_message(self, condition=None):
+        return self._read(condition, raw=False)
+
+    def get_raw_message(self, condition=None):
+        return self._read(condition, raw=True)
+
+    def _read(self, condition, raw):
+        with open(self._path, 'rb') as fp:
+            size = self._get_complete_size(fp)
+            if not size:
+                return
+            with mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ) as data:
+                offset = self._get_resume_offset(data)
+                for start, end in self._iter_messages(data, offset):
+                    start = self._skip_envelope(data, start, end)
+                    if not self._is_too_old(data, start, end):
+                        message = None
+                        if condition or not raw:
+                            message = self._parse(data, start, end)
+                        if condition is None or condition(message):
+                            self._pending_offset = end
+                            yield data[start:end] if raw else message
+                            continue
+                    self._pending_offset = end
+
+    def _get_complete_size(self, fp):
+        """Returns the size of the file once no delivery is writing to it.
+
+        Deliveries append under an exclusive lock, as `mailbox.mbox`
+        takes it; waiting for a shared one means no message is cut off.
+
+        """
+        if fcntl is None:
+            return os.fstat(fp.fileno()).st_size
+        fcntl.lockf(fp, fcntl.LOCK_SH)
+        try:
+            return os.fstat(fp.fileno()).st_size
+        finally:
+            fcntl.lockf(fp, fcntl.LOCK_UN)
+
+    def _get_resume_offset(self, data):
+        offset = self.sync_state.get('offset', 0)
+        if offset == len(data) or data[offset:offset + 6] == SEPARATOR \
+                or data[offset:offset + 5] == SEPARATOR[1:]:
+            return offset
+        # The file was replaced or truncated since the checkpoint
+        logger.warning("Checkpoint %s doesn't match %s; reading it again", offset, self._path)
+        return 0
+
+    def _iter_messages(self, data, offset):
+        """Yields the start and end offsets of messages after `offset`."""
+        size = len(data)
+        if data[offset:offset + 5] == SEPARATOR[1:]:
+            start = offset
+        else:
+            start = data.find(SEPARATOR, offset)
+            if start < 0:
+                return
+            start += 1
+        while start < size:
+            end = data.find(SEPARATOR, start)
+            if end < 0:
+                end = size
+            yield start, end
+            start = end + 1
+
+    def _skip_envelope(self, data, start, end):
+        """Returns the offset past the ``From `` envelope line."""
+        return data.find(b'\n', start, end) + 1 or end
+
+    def _is_too_old(self, data, start, end):
+        if self.since is None:
+            return False
+        match = HEADERS_END_RE.search(data, start, end)
+        headers = self.get_email_from_bytes(data[start:match.start() if match else end])
+        return self.is_too_old(headers)
+
+    def _parse(self, data, start, end):
+        parser = BytesFeedParser()
+        with memoryview(data) as view:
+            for offset in range(start, end, self.chunk_size):
+                parser.feed(view[offset:min(offset + self.chunk_size, end)].tobytes())
+        return parser.close()
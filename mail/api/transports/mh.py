@@ -1,6 +1,11 @@
+import os
+
 from mailbox import MH
-from mail.api.transports.generic import GenericFileMailbox
+from mail.api.transports.generic import GenericFileMailbox, get_file_modified_date
 
 
 class MHTransport(GenericFileMailbox):
     _variant = MH
+
+    def get_modified_date(self, repository, key):
+        return get_file_modified_date(os.path.join(self._path, str(key)))
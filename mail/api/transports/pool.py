@@ -0,0 +1,186 @@
+import time
+import atexit
+import logging
+import threading
+
+from collections import deque
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class ConnectionPoolError(Exception):
+    pass
+
+
+class ImapConnectionPool(object):
+    """
+    Authenticated IMAP sessions kept open between polls.
+
+    Sessions are keyed by mailbox URI and checked with NOOP before they
+    are handed out again. At most `max_per_host` sessions, idle or in
+    use, are open to a server at once; idle sessions are kept alive with
+    NOOP every `keepalive_interval` seconds and logged out after
+    `max_idle` seconds without use.
+    """
+    def __init__(self, max_per_host, max_idle, keepalive_interval, timeout):
+        self.max_per_host = max_per_host
+        self.max_idle = max_idle
+        self.keepalive_interval = keepalive_interval
+        self.timeout = timeout
+        # key: deque of (transport, last used, last checked)
+        self._idle = {}
+        self._hosts = {}
+        self._open = {}
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def acquire(self, key, host, connect):
+        """Returns an open session for `key`.
+
+        `connect()` opens a new session to `host` when no idle one is
+        usable. Waits up to `timeout` seconds for a free slot when the
+        server already has `max_per_host` sessions open.
+
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            evicted = None
+            with self._condition:
+                if self._closed:
+                    raise ConnectionPoolError("Connection pool is closed")
+                idle = self._idle.get(key)
+                if idle:
+                    transport, _, _ = idle.pop()
+                else:
+                    transport = None
+                    if self._open.get(host, 0) < self.max_per_host:
+                        self._open[host] = self._open.get(host, 0) + 1
+                    else:
+                        # Take over the slot of another mailbox's idle session
+                        evicted = self._pop_idle(host)
+                        if evicted is None:
+                            remaining = deadline - time.monotonic()
+                            if remaining <= 0:
+                                raise ConnectionPoolError(
+                                    "No free connection to %s after %ss" % (host, self.timeout)
+                                )
+                            self._condition.wait(remaining)
+                            continue
+                self._hosts[key] = host
+            break
+
+        if evicted is not None:
+            evicted.close()
+        if transport is not None:
+            if transport.noop():
+                return transport
+            # The server dropped the session while it was idle; its slot
+            # goes to a new one
+            transport.close()
+        try:
+            return connect()
+        except Exception:
+            self._forget(host)
+            raise
+
+    def release(self, key, transport, discard=False):
+        """Returns `transport` to the pool, or logs it out if `discard`."""
+        with self._condition:
+            if not discard and not self._closed:
+                now = time.monotonic()
+                self._idle.setdefault(key, deque()).append((transport, now, now))
+                self._condition.notify()
+                return
+        self._forget(self._hosts[key])
+        transport.close()
+
+    def keepalive(self):
+        """Sends NOOP on idle sessions and logs out those unused too long."""
+        now = time.monotonic()
+        with self._condition:
+            due = []
+            for key, idle in self._idle.items():
+                for entry in list(idle):
+                    transport, used, checked = entry
+                    if now - used > self.max_idle or now - checked > self.keepalive_interval:
+                        idle.remove(entry)
+                        due.append((key, entry))
+
+        for key, (transport, used, checked) in due:
+            if now - used <= self.max_idle and transport.noop():
+                with self._condition:
+                    if not self._closed:
+                        self._idle[key].appendleft((transport, used, time.monotonic()))
+                        continue
+            self._forget(self._hosts[key])
+            transport.close()
+
+    def close(self):
+        """Logs out of every idle session; sessions in use are logged out
+        when they are released."""
+        with self._condition:
+            self._closed = True
+            sessions = [
+                (key, transport)
+                for key, idle in self._idle.items() for transport, _, _ in idle
+            ]
+            self._idle.clear()
+            self._condition.notify_all()
+        for key, transport in sessions:
+            self._forget(self._hosts[key])
+            transport.close()
+
+    def _pop_idle(self, host):
+        """Removes the least recently used idle session to `host`."""
+        oldest = None
+        for key, idle in self._idle.items():
+            if idle and self._hosts[key] == host:
+                if oldest is None or idle[0][1] < self._idle[oldest][0][1]:
+                    oldest = key
+        if oldest is None:
+            return None
+        transport, _, _ = self._idle[oldest].popleft()
+        return transport
+
+    def _forget(self, host):
+        with self._condition:
+            self._open[host] -= 1
+            self._condition.notify()
+
+
+def get_connection_pool():
+    """Returns the process-wide IMAP connection pool, or None if pooling
+    is disabled with ``DJANGO_MAILBOX_IMAP_POOL_SIZE = 0``."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            max_per_host = getattr(settings, 'DJANGO_MAILBOX_IMAP_POOL_SIZE', 4)
+            if not max_per_host:
+                return None
+            _pool = ImapConnectionPool(
+                max_per_host,
+                max_idle=getattr(settings, 'DJANGO_MAILBOX_IMAP_POOL_MAX_IDLE', 30 * 60),
+                keepalive_interval=getattr(settings, 'DJANGO_MAILBOX_IMAP_POOL_KEEPALIVE', 5 * 60),
+                timeout=getattr(settings, 'DJANGO_MAILBOX_IMAP_POOL_TIMEOUT', 60),
+            )
+            _start_keepalive(_pool)
+            atexit.register(_pool.close)
+    return _pool
+
+
+def _start_keepalive(pool):
+    def run():
+        while not pool._closed:
+            time.sleep(min(pool.keepalive_interval, pool.max_idle) / 2)
+            try:
+                pool.keepalive()
+            except Exception:
+                logger.exception("IMAP connection keepalive failed")
+
+    threading.Thread(target=run, name='imap-keepalive', daemon=True).start()
@@ -1,20 +1,114 @@
 import six
 
-from poplib import POP3, POP3_SSL
+from poplib import POP3, POP3_SSL, error_proto
 
-from .base import EmailTransport, MessageParseError
+from django.conf import settings
+
+from .base import EmailTransport, MessageParseError, MessageSpool, RawMessageFile
+
+# Longest response line accepted, as in poplib
+MAXLINE = 2048
+
+
+class PipeliningPop3Mixin(object):
+    """
+    Lets a `poplib.POP3` client send commands without waiting for their
+    responses.
+
+    `send_command` writes a command line; `read_response` and
+    `read_long_response` read the oldest response not yet read, the
+    latter with its dot-terminated body, in the format `poplib` returns.
+    `read_long_response_into` writes the body to a file instead. A -ERR
+    response raises `error_proto`.
+    """
+    def send_command(self, line):
+        self.sock.sendall(line.encode(self.encoding) + b'\r\n')
+
+    def _read_line(self):
+        line = self.file.readline(MAXLINE + 1)
+        if len(line) > MAXLINE:
+            raise error_proto('line too long')
+        if not line:
+            raise error_proto('-ERR EOF')
+        if line.endswith(b'\r\n'):
+            return line[:-2], len(line)
+        return line[:-1], len(line)
+
+    def read_response(self):
+        response, octets = self._read_line()
+        if not response.startswith(b'+'):
+            raise error_proto(response)
+        return response
+
+    def read_long_response(self):
+        lines = []
+        response, total = self._read_long_response(lines.append)
+        return response, lines, total
+
+    def read_long_response_into(self, fp):
+        """Writes the body of a long response to `fp`, its lines joined by
+        CRLF; returns the response line and the size of the body."""
+        def write(line):
+            if write.started:
+                fp.write(b'\r\n')
+            fp.write(line)
+            write.started = True
+        write.started = False
+        return self._read_long_response(write)
+
+    def _read_long_response(self, handle_line):
+        response = self.read_response()
+        total = 0
+        line, octets = self._read_line()
+        while line != b'.':
+            if line.startswith(b'..'):
+                octets -= 1
+                line = line[1:]
+            total += octets
+            handle_line(line)
+            line, octets = self._read_line()
+        return response, total
+
+
+class PipeliningPOP3(PipeliningPop3Mixin, POP3):
+    pass
+
+
+class PipeliningPOP3_SSL(PipeliningPop3Mixin, POP3_SSL):
+    pass
 
 
 class Pop3Transport(EmailTransport):
-    def __init__(self, hostname, port=None, ssl=False):
+    raw_messages = True
+    # Message numbers to delete and UIDLs to remember on the next commit
+    _pending_deletes = ()
+    _pending_uidls = frozenset()
+    _uidls = None
+
+    def __init__(self, hostname, port=None, ssl=False, sync_state=None, since=None):
+        self.pipeline_size = getattr(
+            settings,
+            'DJANGO_MAILBOX_POP3_PIPELINE_SIZE',
+            20
+        )
+        # Messages larger than this many bytes are spooled to disk
+        self.message_spool_size = getattr(
+            settings,
+            'DJANGO_MAILBOX_MESSAGE_SPOOL_SIZE',
+            1024 * 1024
+        )
         self.hostname = hostname
         self.port = port
+        self.since = since
+        # UIDLs of messages already ingested or rejected by the condition
+        self.sync_state = dict(sync_state or {})
+        self.pipelining = False
         if ssl:
-            self.transport = POP3_SSL
+            self.transport = PipeliningPOP3_SSL
             if not self.port:
                 self.port = 995
         else:
-            self.transport = POP3
+            self.transport = PipeliningPOP3
             if not self.port:
                 self.port = 110
 
@@ -22,27 +116,160 @@ class Pop3Transport(EmailTransport):
         self.server = self.transport(self.hostname, self.port)
         self.server.user(username)
         self.server.pass_(password)
+        self.pipelining = self._has_capability('PIPELINING')
+
+    def _has_capability(self, name):
+        try:
+            return name in self.server.capa()
+        except error_proto:
+            return False
 
     def get_message_body(self, message_lines):
         if six.PY3:
             return six.binary_type('\r\n', 'ascii').join(message_lines)
         return '\r\n'.join(message_lines)
 
-    def get_message(self, condition=None):
-        message_count = len(self.server.list()[1])
-        for i in range(message_count):
+    def _get_uidls(self):
+        """Returns UIDLs by message number, or None if UIDL is unsupported."""
+        try:
+            response, listings, octets = self.server.uidl()
+        except error_proto:
+            return None
+
+        uidls = {}
+        for listing in listings:
+            number, uidl = listing.decode().split(' ', 1)
+            uidls[int(number)] = uidl.strip()
+        return uidls
+
+    def _pipeline(self, commands, read_response):
+        """Sends `commands` and returns their responses in order.
+
+        When the server advertises PIPELINING (RFC 2449) all commands go
+        out before the first response is read. A failed command yields
+        None instead of its response.
+
+        """
+        def read():
             try:
-                msg_contents = self.get_message_body(
-                    self.server.retr(i + 1)[1]
-                )
-                message = self.get_email_from_bytes(msg_contents)
+                return read_response()
+            except error_proto:
+                return None
 
-                if condition and not condition(message):
-                    continue
+        if self.pipelining:
+            for command in commands:
+                self.server.send_command(command)
+            return [read() for command in commands]
 
-                yield message
+        responses = []
+        for command in commands:
+            self.server.send_command(command)
+            responses.append(read())
+        return responses
+
+    def _read_message(self):
+        spool = MessageSpool(self.message_spool_size)
+        self.server.read_long_response_into(spool)
+        return spool.finish()
+
+    def _filter_by_headers(self, numbers, condition):
+        # TOP n 0 returns just the headers, so rejected messages are
+        # never downloaded in full.
+        responses = self._pipeline(
+            ['TOP %d 0' % number for number in numbers],
+            self.server.read_long_response
+        )
+
+        accepted, rejected = [], []
+        for number, response in zip(numbers, responses):
+            if response is None:
+                accepted.append(number)
+                continue
+            try:
+                headers = self.get_email_from_bytes(
+                    self.get_message_body(response[1])
+                )
             except MessageParseError:
+                accepted.append(number)
                 continue
-            self.server.dele(i + 1)
-        self.server.quit()
-        return
+            if not self.is_too_old(headers) \
+                    and (condition is None or condition(headers)):
+                accepted.append(number)
+            else:
+                rejected.append(number)
+        return accepted, rejected
+
+    def get_message(self, condition=None):
+        return self._get_messages(condition, raw=False)
+
+    def get_raw_message(self, condition=None):
+        return self._get_messages(condition, raw=True)
+
+    def _get_messages(self, condition, raw):
+        self._pending_deletes, self._pending_uidls = [], set()
+        message_count = len(self.server.list()[1])
+        numbers = list(range(1, message_count + 1))
+
+        self._uidls = self._get_uidls()
+        seen = set(self.sync_state.get('uidls', []))
+        if self._uidls is not None:
+            numbers = [number for number in numbers if self._uidls.get(number) not in seen]
+
+        def mark_handled(number):
+            if self._uidls is not None and number in self._uidls:
+                self._pending_uidls.add(self._uidls[number])
+
+        for start in range(0, len(numbers), self.pipeline_size):
+            chunk = numbers[start:start + self.pipeline_size]
+
+            if condition or self.since:
+                chunk, rejected = self._filter_by_headers(chunk, condition)
+                for number in rejected:
+                    mark_handled(number)
+
+            responses = self._pipeline(
+                ['RETR %d' % number for number in chunk],
+                self._read_message
+            )
+
+            for number, contents in zip(chunk, responses):
+                if contents is None:
+                    continue
+                if condition or not raw:
+                    try:
+                        message = self.get_email_from_bytes(contents)
+                    except MessageParseError:
+                        self._discard(contents)
+                        continue
+
+                    if condition and not condition(message):
+                        self._discard(contents)
+                        mark_handled(number)
+                        continue
+
+                mark_handled(number)
+                self._pending_deletes.append(number)
+                yield contents if raw else message
+
+    def _discard(self, contents):
+        if isinstance(contents, RawMessageFile):
+            contents.discard()
+
+    def commit(self):
+        deletes, self._pending_deletes = self._pending_deletes, []
+        # Deletions only take effect once the session ends with QUIT
+        self._pipeline(['DELE %d' % number for number in deletes], self.server.read_response)
+
+        if self._uidls is not None:
+            handled = set(self.sync_state.get('uidls', [])) | self._pending_uidls
+            # Forget UIDLs of messages that are gone from the server
+            self.sync_state = {
+                'uidls': sorted(handled & set(self._uidls.values()))
+            }
+        self._pending_uidls = set()
+
+    def close(self):
+        try:
+            self.server.quit()
+        except (error_proto, OSError):
+            pass
@@ -0,0 +1,124 @@
+"""
+Background upload of staged attachment payloads.
+
+With ``DJANGO_MAILBOX_DEFER_ATTACHMENT_UPLOADS``, ingest writes new
+attachment blobs to a local staging area and leaves them *staged*;
+`schedule_uploads` hands them to a thread pool which moves them to the
+configured file storage once the ingest transaction has committed.
+Attachments are read from staging until then. Blobs whose upload failed
+or was interrupted stay staged and are retried by `upload_staged_blobs`.
+"""
+import os
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings as django_settings
+from django.core.files.base import File
+from django.core.files.storage import FileSystemStorage
+from django.db import close_old_connections, transaction
+
+import mail.api.utils as utils
+from mail.api.models import Attachment, AttachmentBlob
+
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_staging_storage():
+    return FileSystemStorage(location=os.path.join(
+        django_settings.MEDIA_ROOT, utils.get_settings()['attachment_staging_dir']
+    ))
+
+
+def get_upload_executor():
+    """Returns the process-wide pool uploading staged blobs."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=utils.get_settings()['attachment_upload_workers'],
+                thread_name_prefix='mail-upload'
+            )
+    return _executor
+
+
+def schedule_uploads(blob_ids):
+    """Uploads the blobs `blob_ids` in the background once the current
+    transaction commits."""
+    def submit():
+        executor = get_upload_executor()
+        for blob_id in blob_ids:
+            executor.submit(_run_upload, blob_id)
+
+    transaction.on_commit(submit)
+
+
+def _run_upload(blob_id):
+    close_old_connections()
+    try:
+        upload_blob(blob_id)
+    except Exception:
+        logger.exception("Uploading attachment blob %s failed", blob_id)
+    finally:
+        close_old_connections()
+
+
+def upload_blob(blob_id):
+    """Moves the payload of a staged blob to the file storage.
+
+    Returns whether the blob was uploaded by this call.
+
+    """
+    blob = AttachmentBlob.objects.filter(
+        pk=blob_id, upload_status=AttachmentBlob.STAGED
+    ).first()
+    if blob is None:
+        return False
+
+    staging = get_staging_storage()
+    staged_path = blob.staged_path
+    try:
+        payload = staging.open(staged_path)
+    except FileNotFoundError:
+        # Deleted with its last attachment meanwhile
+        return False
+    with payload:
+        blob.document.save(os.path.basename(staged_path), File(payload), save=False)
+
+    with transaction.atomic():
+        uploaded = AttachmentBlob.objects.filter(
+            pk=blob_id, upload_status=AttachmentBlob.STAGED
+        ).update(
+            document=blob.document.name, upload_status=AttachmentBlob.STORED, staged_path=''
+        )
+        if uploaded:
+            Attachment.objects.filter(blob_id=blob_id).update(document=blob.document.name)
+
+    if not uploaded:
+        # The blob was deleted, or uploaded by another worker, meanwhile
+        blob.document.delete(save=False)
+        return False
+    staging.delete(staged_path)
+    return True
+
+
+def upload_staged_blobs(limit=None):
+    """Uploads blobs left staged; returns how many were uploaded."""
+    blob_ids = AttachmentBlob.objects.filter(
+        upload_status=AttachmentBlob.STAGED
+    ).order_by('pk').values_list('pk', flat=True)
+    if limit:
+        blob_ids = blob_ids[:limit]
+
+    uploaded = 0
+    for blob_id in list(blob_ids):
+        try:
+            uploaded += upload_blob(blob_id)
+        except Exception:
+            logger.exception("Uploading attachment blob %s failed", blob_id)
+    return uploaded
@@ -1,18 +1,35 @@
 import urllib.parse
-from email.utils import parsedate_to_datetime
 
+import quopri
+import binascii
 import datetime
 import email.header
+import gzip
+import hashlib
+import itertools
 import logging
 import os
+import re
+import shutil
+import tempfile
 
 import six
+import zlib
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 logger = logging.getLogger(__name__)
 
+# Characters outside the base64 alphabet, which decoders skip
+BASE64_IGNORED_RE = re.compile(r'[^A-Za-z0-9+/=]')
+
 
 def get_settings():
     return {
@@ -52,21 +69,118 @@ def get_settings():
             'DJANGO_MAILBOX_ATTACHMENT_UPLOAD_TO',
             'mailbox_attachments/%Y/%m/%d/'
         ),
+        'attachment_blob_upload_to': getattr(
+            settings,
+            'DJANGO_MAILBOX_ATTACHMENT_BLOB_UPLOAD_TO',
+            'mailbox_attachments/blobs/'
+        ),
         'store_original_message': getattr(
             settings,
             'DJANGO_MAILBOX_STORE_ORIGINAL_MESSAGE',
             False
         ),
+        # Keep no body in the database for mails whose original is stored
+        'single_copy_original_message': getattr(
+            settings,
+            'DJANGO_MAILBOX_SINGLE_COPY_ORIGINAL_MESSAGE',
+            False
+        ),
         'compress_original_message': getattr(
             settings,
             'DJANGO_MAILBOX_COMPRESS_ORIGINAL_MESSAGE',
             False
         ),
+        # Level of the compression below
         'original_message_compression': getattr(
             settings,
             'DJANGO_MAILBOX_ORIGINAL_MESSAGE_COMPRESSION',
             6
         ),
+        # 'gzip' or 'zstd' (needs the zstandard package)
+        'original_message_compression_method': getattr(
+            settings,
+            'DJANGO_MAILBOX_ORIGINAL_MESSAGE_COMPRESSION_METHOD',
+            'gzip'
+        ),
+        # 'zlib', 'zstd' (needs the zstandard package) or None
+        'body_compression': getattr(
+            settings,
+            'DJANGO_MAILBOX_BODY_COMPRESSION',
+            'zlib'
+        ),
+        'body_compression_level': getattr(
+            settings,
+            'DJANGO_MAILBOX_BODY_COMPRESSION_LEVEL',
+            6
+        ),
+        # Bodies of mails older than this many days go to cold storage
+        # with `archive_mail_bodies`
+        'cold_body_age': getattr(
+            settings,
+            'DJANGO_MAILBOX_COLD_BODY_AGE',
+            365
+        ),
+        'cold_body_upload_to': getattr(
+            settings,
+            'DJANGO_MAILBOX_COLD_BODY_UPLOAD_TO',
+            'mailbox_cold_bodies/%Y/%m/'
+        ),
+        'attachment_spool_size': getattr(
+            settings,
+            'DJANGO_MAILBOX_ATTACHMENT_SPOOL_SIZE',
+            1024 * 1024
+        ),
+        # Write attachment payloads to a local staging area and upload
+        # them to the file storage in the background
+        'defer_attachment_uploads': getattr(
+            settings,
+            'DJANGO_MAILBOX_DEFER_ATTACHMENT_UPLOADS',
+            False
+        ),
+        'attachment_staging_dir': getattr(
+            settings,
+            'DJANGO_MAILBOX_ATTACHMENT_STAGING_DIR',
+            'mailbox_staging'
+        ),
+        'attachment_upload_workers': getattr(
+            settings,
+            'DJANGO_MAILBOX_ATTACHMENT_UPLOAD_WORKERS',
+            4
+        ),
+        'ingest_batch_size': getattr(
+            settings,
+            'DJANGO_MAILBOX_INGEST_BATCH_SIZE',
+            100
+        ),
+        # Seconds a fetch may hold a mailbox without renewing its lease
+        'fetch_lease_ttl': getattr(
+            settings,
+            'DJANGO_MAILBOX_FETCH_LEASE_TTL',
+            600
+        ),
+        # Processes parsing fetched messages; 0 parses them inline
+        'parse_workers': getattr(
+            settings,
+            'DJANGO_MAILBOX_PARSE_WORKERS',
+            0
+        ),
+        'chain_cache_size': getattr(
+            settings,
+            'DJANGO_MAILBOX_CHAIN_CACHE_SIZE',
+            10000
+        ),
+        # Days within which a reply joins a chain by subject alone
+        'chain_subject_window': getattr(
+            settings,
+            'DJANGO_MAILBOX_CHAIN_SUBJECT_WINDOW',
+            14
+        ),
+        # Days a missing referenced message is waited for
+        'chain_relink_window': getattr(
+            settings,
+            'DJANGO_MAILBOX_CHAIN_RELINK_WINDOW',
+            30
+        ),
         'default_charset': getattr(
             settings,
             'DJANGO_MAILBOX_default_charset',
@@ -75,6 +189,131 @@ def get_settings():
     }
 
 
+def chunked(iterable, size):
+    """Yields lists of at most `size` items taken from `iterable`."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def serialize_message(message):
+    try:
+        return message.as_bytes()
+    except UnicodeError:
+        return message.as_string().encode('utf-8', 'surrogateescape')
+
+
+def get_content_hash(message):
+    """Returns the SHA-256 hex digest of the raw `message`."""
+    return hashlib.sha256(serialize_message(message)).hexdigest()
+
+
+def get_message_bytes(message):
+    """Returns `message` as the transport fetched it if it kept its
+    bytes, or serialized again otherwise."""
+    raw = getattr(message, 'raw_bytes', None)
+    if raw is not None:
+        return raw
+    return serialize_message(message)
+
+
+def compress_original_message(raw, method, level):
+    """Returns the original message `raw` compressed with `method`,
+    ``'gzip'`` or ``'zstd'``, and the extension of its file."""
+    if method == 'gzip':
+        return gzip.compress(raw, compresslevel=level), '.eml.gz'
+    if method == 'zstd':
+        if zstandard is None:
+            raise ImproperlyConfigured("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor(level=level).compress(raw), '.eml.zst'
+    raise ImproperlyConfigured("Unknown original message compression %r" % method)
+
+
+def spool_original_message(fp, method=None, level=None):
+    """Copies the original message in `fp` to a temporary file, compressed
+    with `method` unless it is None, a chunk at a time; returns the path
+    and extension of the file."""
+    fd, path = tempfile.mkstemp(prefix='mail-original-')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            if method is None:
+                shutil.copyfileobj(fp, out)
+                return path, '.eml'
+            if method == 'gzip':
+                with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=level) as compressed:
+                    shutil.copyfileobj(fp, compressed)
+                return path, '.eml.gz'
+            if method == 'zstd':
+                if zstandard is None:
+                    raise ImproperlyConfigured("zstd compression needs the zstandard package")
+                zstandard.ZstdCompressor(level=level).copy_stream(fp, out)
+                return path, '.eml.zst'
+            raise ImproperlyConfigured("Unknown original message compression %r" % method)
+    except BaseException:
+        os.remove(path)
+        raise
+
+
+def open_original_message(fp, name):
+    """Returns a stream of the original message stored in `fp` as file
+    `name`, decompressed as its extension says."""
+    if name.endswith('.gz'):
+        return gzip.GzipFile(fileobj=fp, mode='rb')
+    if name.endswith('.zst'):
+        if zstandard is None:
+            raise ImproperlyConfigured("zstd compression needs the zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(fp)
+    return fp
+
+
+def get_file_hash(fp, chunk_size=64 * 1024):
+    """Returns the SHA-256 hex digest of the contents of `fp`."""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fp.read(chunk_size), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+# First byte of a stored body, naming how the rest is compressed
+BODY_RAW = b'r'
+BODY_ZLIB = b'z'
+BODY_ZSTD = b's'
+
+
+def compress_body(body):
+    """Returns `body` bytes compressed as ``body_compression`` says,
+    prefixed with the byte `decompress_body` reads the method from."""
+    settings = get_settings()
+    method = settings['body_compression']
+    level = settings['body_compression_level']
+    if not method:
+        return BODY_RAW + body
+    if method == 'zlib':
+        return BODY_ZLIB + zlib.compress(body, level)
+    if method == 'zstd':
+        if zstandard is None:
+            raise ImproperlyConfigured("zstd body compression needs the zstandard package")
+        return BODY_ZSTD + zstandard.ZstdCompressor(level=level).compress(body)
+    raise ImproperlyConfigured("Unknown body compression %r" % method)
+
+
+def decompress_body(data):
+    data = bytes(data)
+    method, data = data[:1], data[1:]
+    if method == BODY_RAW:
+        return data
+    if method == BODY_ZLIB:
+        return zlib.decompress(data)
+    if method == BODY_ZSTD:
+        if zstandard is None:
+            raise ImproperlyConfigured("zstd body compression needs the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError("Unknown body compression %r" % method)
+
+
 def convert_header_to_unicode(header):
     default_charset = get_settings()['default_charset']
 
@@ -145,6 +384,70 @@ def get_body_from_message(message, maintype, subtype):
 
     return body
 
+def _iter_lines(text):
+    start = 0
+    while start < len(text):
+        end = text.find('\n', start)
+        if end == -1:
+            end = len(text) - 1
+        yield text[start:end + 1]
+        start = end + 1
+
+
+def _iter_line_chunks(text, size=64 * 1024):
+    chunk = []
+    length = 0
+    for line in _iter_lines(text):
+        chunk.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def _payload_bytes(text):
+    try:
+        return text.encode('ascii', 'surrogateescape')
+    except UnicodeError:
+        return text.encode('raw-unicode-escape')
+
+
+def write_decoded_payload(message, fp):
+    """
+    Writes the transfer-decoded payload of a non-multipart `message` to
+    `fp` chunk by chunk, instead of building the whole decoded payload
+    the way `get_payload(decode=True)` does.
+    """
+    payload = message.get_payload()
+    encoding = message.get('content-transfer-encoding', '').lower()
+
+    if not isinstance(payload, str) or encoding not in ('base64', 'quoted-printable'):
+        fp.write(message.get_payload(decode=True) or b'')
+        return
+
+    if encoding == 'quoted-printable':
+        for chunk in _iter_line_chunks(payload):
+            fp.write(quopri.decodestring(_payload_bytes(chunk)))
+        return
+
+    try:
+        pending = ''
+        for chunk in _iter_line_chunks(payload):
+            pending += BASE64_IGNORED_RE.sub('', chunk)
+            cut = len(pending) - len(pending) % 4
+            fp.write(binascii.a2b_base64(pending[:cut]))
+            pending = pending[cut:]
+        if pending:
+            fp.write(binascii.a2b_base64(pending + '=' * (-len(pending) % 4)))
+    except (binascii.Error, ValueError):
+        # Leave malformed payloads to the email package
+        fp.seek(0)
+        fp.truncate()
+        fp.write(message.get_payload(decode=True) or b'')
+
+
 def get_attachment_save_path(instance, filename):
     settings = get_settings()
 
@@ -158,6 +461,30 @@ def get_attachment_save_path(instance, filename):
     )
 
 
+def get_cold_body_save_path(instance, filename):
+    settings = get_settings()
+
+    path = settings['cold_body_upload_to']
+    if '%' in path:
+        path = datetime.datetime.utcnow().strftime(path)
+
+    return os.path.join(
+        path,
+        filename,
+    )
+
+
+def get_attachment_blob_save_path(instance, filename):
+    settings = get_settings()
+
+    return os.path.join(
+        settings['attachment_blob_upload_to'],
+        instance.content_hash[:2],
+        instance.content_hash,
+        filename,
+    )
+
+
 def build_absolute_url(host, path, trailing_slash=True):
     """
     Miising slash fault tolerant absolute url builder
@@ -166,12 +493,3 @@ def build_absolute_url(host, path, trailing_slash=True):
     if trailing_slash:
         joined_url = joined_url + '/'
     return joined_url
-
-
-def mail_fetching_filter(message):
-    if 'date' in message:
-        date = parsedate_to_datetime(message['date']).date()
-        if date < settings.SKIP_MAILS_BEFORE:
-            return False
-
-    return True
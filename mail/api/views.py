@@ -2,22 +2,24 @@ import itertools
 import logging
 
 from django.core.exceptions import ObjectDoesNotExist
-from django.conf import settings
 from django.db import transaction
 from django.db.models import Count, Q, Max, Min, OuterRef, Subquery, F
+from django.http import FileResponse
 from django.shortcuts import get_object_or_404
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
-from rest_framework.exceptions import ValidationError, ParseError
+from rest_framework.exceptions import ValidationError, ParseError, NotFound
 from rest_framework.response import Response
-from rest_framework.status import HTTP_200_OK, HTTP_201_CREATED
+from rest_framework.status import HTTP_200_OK, HTTP_201_CREATED, HTTP_202_ACCEPTED
 
 from mail.api.filters import ChainsFilter
-from mail.api.models import Folder, Contact, ModelApiError, Mail, Mailbox, Chain, Template
+from mail.api.jobs import start_fetch_job, fail_stale_fetches
+from mail.api.models import Folder, Contact, ModelApiError, Mail, Mailbox, Chain, Template, FetchJob
 from mail.api.pagination import PageNumberPagination
 from mail.api.serializers import MailSerializer, \
     FolderSerializer, ContactSerializer, MoveMailsToFolderSerializer, \
-    BulkAssignSerializer, TroodMailboxSerializer, TemplateSerializer
+    BulkAssignSerializer, TroodMailboxSerializer, TemplateSerializer, \
+    FetchJobSerializer
 
 logger = logging.getLogger("mail_info")
 
@@ -30,7 +32,7 @@ class MailboxViewSet(viewsets.ModelViewSet):
     def fetch(self, request, pk=None):
         mailbox = self.get_object()
 
-        mails, new_contacts = self._fetch_mailbox(mailbox)
+        mails, new_contacts = mailbox.fetch_new_mail()
 
         data = {
             "mails_received": mails,
@@ -43,58 +45,9 @@ class MailboxViewSet(viewsets.ModelViewSet):
     def fetchall(self, request):
         queryset = self.get_queryset()
 
-        mails_total = contast_total = 0
-        failed = []
-        for mailbox in queryset.filter(active=True):
+        job = start_fetch_job(queryset.filter(active=True), owner=request.user.id)
 
-            try:
-                mails_count, new_contacts = self._fetch_mailbox(mailbox)
-                mails_total += mails_count
-                contast_total += new_contacts
-            except Exception as e:
-                failed.append({
-                    "mailbox": mailbox.id,
-                    "error": str(e)
-                })
-
-        data = {
-            "mails_received": mails_total,
-            "contact_added": contast_total,
-            "fails": failed
-        }
-
-        return Response(data, status=HTTP_200_OK)
-
-    def _fetch_mailbox(self, mailbox):
-        # @todo: find better way of filter overriding
-        if mailbox.type == 'imap':
-            mails = mailbox.get_new_mail(mailbox.custom_query or settings.DEFAULT_IMAP_QUERY)
-        else:
-            mails = mailbox.get_new_mail()
-
-        new_contacts = 0
-        mails_count = 0
-        for mail in mails:
-            mails_count +=1
-            for address in mail.address:
-                contact, created = Contact.objects.get_or_create(email=address)
-                mail, contact = \
-                    self._move_mail_to_folder_assigned_to(mail, contact)
-                if created:
-                    new_contacts += 1
-
-        return mails_count, new_contacts
-
-    def _move_mail_to_folder_assigned_to(self, mail, contact):
-        try:
-            folder = contact.folder
-            folder.messages.add(mail)
-            folder.save()
-        except Exception:
-            # TODO Log here
-            pass
-        finally:
-            return mail, contact
+        return Response(FetchJobSerializer(job).data, status=HTTP_202_ACCEPTED)
 
     def create(self, request, *args, **kwargs):
         mailbox = TroodMailboxSerializer(data=request.data)
@@ -112,6 +65,15 @@ class MailboxViewSet(viewsets.ModelViewSet):
         return Response(mailbox.data)
 
 
+class FetchJobViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = FetchJob.objects.prefetch_related('mailboxes')
+    serializer_class = FetchJobSerializer
+
+    def get_queryset(self):
+        fail_stale_fetches()
+        return super().get_queryset().filter(owner=self.request.user.id)
+
+
 class MailViewSet(viewsets.ModelViewSet):
     queryset = Mail.objects.all()
     serializer_class = MailSerializer
@@ -137,6 +99,18 @@ class MailViewSet(viewsets.ModelViewSet):
 
         return Response(serializer.data, HTTP_201_CREATED)
 
+    @action(detail=True, methods=["GET"], url_path=r'attachments/(?P<attachment_id>\d+)')
+    def attachment(self, request, pk=None, attachment_id=None):
+        attachment = get_object_or_404(self.get_object().attachments.all(), pk=attachment_id)
+        meta = attachment.get_metadata()
+        if meta is None:
+            raise NotFound()
+
+        return FileResponse(
+            attachment.open_document(), as_attachment=True,
+            filename=meta['filename'], content_type=meta['mimetype']
+        )
+
     def perform_create(self, serializer):
         self.perform_save(serializer)
 
@@ -166,6 +166,24 @@ class BaseConfiguration(Configuration):
 
     DEFAULT_IMAP_QUERY =  os.environ.get('DEFAULT_IMAP_QUERY', "NEW")
 
+    # Number of mailboxes fetched at once by background fetch jobs
+    MAIL_FETCH_CONCURRENCY = int(os.environ.get('MAIL_FETCH_CONCURRENCY', 10))
+    # Seconds after which fetches still pending or running are taken as
+    # lost with a restarted worker and marked failed
+    MAIL_FETCH_TIMEOUT = int(os.environ.get('MAIL_FETCH_TIMEOUT', 3600))
+
+    # Adaptive polling scheduler bounds, in seconds
+    MAIL_POLLING_CONCURRENCY = int(os.environ.get('MAIL_POLLING_CONCURRENCY', 10))
+    MAIL_POLLING_MIN_INTERVAL = int(os.environ.get('MAIL_POLLING_MIN_INTERVAL', 5))
+    MAIL_POLLING_MAX_INTERVAL = int(os.environ.get('MAIL_POLLING_MAX_INTERVAL', 300))
+    MAIL_POLLING_MAX_BACKOFF = int(os.environ.get('MAIL_POLLING_MAX_BACKOFF', 3600))
+
+    # Event loop polling: IMAP sessions at once, overall and per server,
+    # and batches of fetched messages waiting to be written
+    MAIL_ASYNC_POLLING_CONCURRENCY = int(os.environ.get('MAIL_ASYNC_POLLING_CONCURRENCY', 1000))
+    MAIL_ASYNC_POLLING_PER_HOST = int(os.environ.get('MAIL_ASYNC_POLLING_PER_HOST', 20))
+    MAIL_ASYNC_POLLING_QUEUE_SIZE = int(os.environ.get('MAIL_ASYNC_POLLING_QUEUE_SIZE', 100))
+
     # @todo: replace with configurable app from TroodLib
     GLOBAL_CONFIGURABLE = {
         "PUBLIC_URL": os.environ.get('PUBLIC_URL')
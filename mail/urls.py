@@ -6,7 +6,8 @@ from django.views.generic import TemplateView
 from rest_framework import routers
 from trood.contrib.django.apps.fixtures.views import TroodFixturesViewSet
 
-from mail.api.views import MailboxViewSet, MailViewSet, FolderViewSet, ContactViewSet, ChainViewSet, TemplateViewSet
+from mail.api.views import MailboxViewSet, MailViewSet, FolderViewSet, ContactViewSet, ChainViewSet, TemplateViewSet, \
+    FetchJobViewSet
 from trood.contrib.django.apps.meta.views import TroodMetaView
 
 router = routers.DefaultRouter()
@@ -17,6 +18,7 @@ router.register(r'folders', FolderViewSet, base_name="folders")
 router.register(r'contacts', ContactViewSet, base_name="contacts")
 router.register(r'chains', ChainViewSet,  base_name="chains")
 router.register(r'templates', TemplateViewSet,  base_name="templates")
+router.register(r'fetch-jobs', FetchJobViewSet,  base_name="fetch-jobs")
 
 if settings.DEBUG:
     router.register(r'fixtures', TroodFixturesViewSet, base_name='fixtures')